@@ -0,0 +1,311 @@
+"""
+Runs the yearly update for synthetic stations against the local
+stand-in server and reports stations per minute for each stage
+
+The stations are set up as if last year's update had been run: the
+station lists, the C-HPD station inventory and the ISD history are
+written to a temporary working directory laid out like src, and last
+year's data to a temporary DATA_BASE_DIR. yearly_update.update_coop_data
+and update_isd_data then run from that working directory as they do
+for a real update; only the D4EM file is not made
+The time for each stage comes from the journal
+
+Example: python benchmark.py --stations 50 --latency 0.05
+"""
+import argparse
+import csv
+import dataclasses
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+import common
+import common_fill
+import common_http
+import get_coop_precip
+import get_isd
+import journal
+import stand_in_server
+import storage
+import yearly_update
+
+
+# the station inventory fill_coop_data.get_offset reads the UTC offset from
+OFFSET_INVENTORY_FILENAME = 'HPD_v02r02_stationinv_c20200909.csv'
+
+
+def make_stations(count, network, start_date, end_date, per_cell=1):
+    """
+    Makes count synthetic stations, two thirds of them in the NLDAS
+    domain and the rest in Alaska and Hawaii where GLDAS is used
+    Stations in the NLDAS domain come in groups of per_cell that share
+    a grid cell
+    """
+    stations = []
+    for index in range(count):
+        if index % 3 == 2:
+            latitude = 61.0 + (index % 7) * 0.3 if index % 2 else 21.3
+            longitude = -150.0 + (index % 5) * 0.3 if index % 2 else -157.9
+            state = 'AK' if index % 2 else 'HI'
+        else:
+            cell = index // per_cell
+            latitude = 30.0 + (cell % 20) * 0.9 + (index % per_cell) * 0.01
+            longitude = -120.0 + (cell % 40) * 1.3
+            state = 'XX'
+
+        if network == 'coop':
+            station_id = f'USC00{index:06d}'
+        else:
+            station_id = f'72{index:04d}{index:05d}'
+
+        stations.append(common.Station(
+            station_id, 'STAND IN', state, start_date, end_date,
+            f'{latitude:.4f}', f'{longitude:.4f}', False, False, network,
+            start_date, end_date))
+
+    return stations
+
+
+def pick_no_data_cells(stations, count):
+    """
+    Returns the NLDAS cells of the first count stations in the NLDAS
+    domain and the GLDAS cells of the first count stations outside it
+    """
+    water_cells = set()
+    empty_gldas_cells = set()
+    for station in stations:
+        lat, lon = float(station.latitude), float(station.longitude)
+        if common_fill.in_nldas_domain(station):
+            if len(water_cells) < count:
+                x, y = common_fill.NLDAS.grid_cell_from_lat_lon(lat, lon)
+                water_cells.add((int(x), int(y)))
+        elif len(empty_gldas_cells) < count:
+            empty_gldas_cells.add(common_fill.get_gldas_cell(lat, lon)[1:])
+
+    return water_cells, empty_gldas_cells
+
+
+def write_station_list(filename, stations):
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(dataclasses.asdict(stations[0]).keys())
+        for station in stations:
+            writer.writerow(dataclasses.asdict(station).values())
+
+
+def write_working_directory(coop_stations, isd_stations):
+    """
+    Writes the files the update reads from the working directory
+    """
+    write_station_list('coop_stations_to_use.csv', coop_stations)
+    write_station_list('isd_subset.csv', isd_stations)
+
+    with open('percent_missing.csv', 'w') as file:
+        for station in isd_stations:
+            file.write(f'{station.station_id},10.0\n')
+
+
+def write_previous_data(coop_stations, isd_stations):
+    """
+    Writes the raw, processed and combined data last year's update left
+    in DATA_BASE_DIR for stations, which end on their end_date_to_use
+    """
+    for short_dir in ('raw_coop_data', 'raw_isd_data', 'processed_isd_data',
+                      'combined_data'):
+        os.makedirs(os.path.join(common.DATA_BASE_DIR, short_dir),
+                    exist_ok=True)
+
+    for station in coop_stations:
+        with storage.write(yearly_update.get_raw_filename(
+                station, 'coop', original=True), 'wb') as file:
+            file.write(stand_in_server.make_chpd_csv(
+                station.station_id, station.start_date_to_use,
+                station.end_date_to_use))
+        # processed into this year's directory, which the update
+        # writes over, and kept as last year's combined data
+        get_coop_precip.process_data(
+            station, station.start_date_to_use, station.end_date_to_use,
+            old=True)
+        processed_path = storage.find(yearly_update.get_processed_filename(
+            station, 'coop'))
+        os.replace(processed_path, storage.get_path(
+            yearly_update.get_combined_filename(station, original=True),
+            storage.get_method(processed_path)))
+
+    for station in isd_stations:
+        last_hour = station.end_date_to_use + datetime.timedelta(hours=23)
+        with storage.write(yearly_update.get_raw_filename(
+                station, 'isd', original=True), 'wb') as file:
+            file.write(stand_in_server.make_global_hourly(
+                station.station_id, station.start_date_to_use, last_hour))
+        get_isd.read_raw(station, station.start_date_to_use, last_hour)
+        processed_path = storage.find(yearly_update.get_processed_filename(
+            station, 'isd', original=True))
+        shutil.copyfile(processed_path, storage.get_path(
+            yearly_update.get_combined_filename(station, original=True),
+            storage.get_method(processed_path)))
+
+
+def get_busy_seconds(intervals):
+    """
+    Returns the seconds covered by a list of (start, end), counting the
+    time covered by more than one of them once
+    """
+    busy = 0.0
+    covered_to = float('-inf')
+    for start, end in sorted(intervals):
+        if end > covered_to:
+            busy += end - max(start, covered_to)
+            covered_to = end
+
+    return busy
+
+
+def report(seconds):
+    """
+    Prints the stations done and failed in each stage of the journal,
+    and the time spent in that stage
+    seconds is the total time for each network
+    Stations downloaded or filled together overlap in the journal, so
+    the time for a stage is the time any station was in it
+    """
+    rows = journal.get_journal().execute(
+        'SELECT network, stage, status, started, finished FROM stages '
+        'WHERE finished IS NOT NULL')
+
+    print(f'{"stage":<16}{"stations":>10}{"seconds":>10}'
+          f'{"failed":>8}{"per minute":>12}')
+    for network in seconds:
+        for stage in journal.STAGES:
+            stage_rows = [x for x in rows if x[0:2] == (network, stage)]
+            if not stage_rows:
+                continue
+            done = sum(1 for x in stage_rows if x[2] == 'done')
+            failed = sum(1 for x in stage_rows if x[2] == 'failed')
+            busy = get_busy_seconds([x[3:5] for x in stage_rows])
+            per_minute = done / busy * 60 if busy else float('inf')
+            print(f'{network + " " + stage:<16}{done:>10}{busy:>10.2f}'
+                  f'{failed:>8}{per_minute:>12.1f}')
+        print(f'{network + " total":<16}{"":>10}{seconds[network]:>10.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stations', type=int, default=12,
+                        help='number of stations for each network')
+    parser.add_argument('--years', type=int, default=2,
+                        help='years of record each station had last year')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the server waits before responding')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of requests that get a 503')
+    parser.add_argument('--virtual-rod-rate', type=float, default=0.0,
+                        help='fraction of LDAS requests that get the '
+                             'virtual rod error')
+    parser.add_argument('--retry-delay', type=float,
+                        default=common_http.RETRY_POLICY.base_delay,
+                        help='seconds before the first retry; the circuit '
+                             'breakers pause for 60 times this')
+    parser.add_argument('--stations-per-cell', type=int, default=2,
+                        help='stations sharing each NLDAS grid cell')
+    parser.add_argument('--download-workers', type=int,
+                        default=get_coop_precip.DOWNLOAD_WORKERS)
+    parser.add_argument('--no-data-cells', type=int, default=0,
+                        help='NLDAS cells over water and GLDAS cells '
+                             'without data')
+    parser.add_argument('--jobs', type=int, default=common_fill.FILL_JOBS,
+                        help='number of processes filling stations')
+    parser.add_argument('--append-downloads', action='store_true',
+                        help='download only the data added to each C-HPD '
+                             'file since last year')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working and data directories '
+                             'afterwards')
+    parser.add_argument('--compress', choices=list(storage.SUFFIXES),
+                        help='write the data files compressed')
+    args = parser.parse_args()
+
+    storage.COMPRESSION = args.compress
+
+    end_date = common.CURRENT_END_DATE
+    previous_end_date = datetime.datetime(end_date.year - 1, 12, 31)
+    start_date = datetime.datetime(end_date.year - args.years, 1, 1)
+
+    # the stations as the inventories have them now, and as the station
+    # lists have them from last year
+    coop_stations = make_stations(args.stations, 'coop', start_date,
+                                  end_date, args.stations_per_cell)
+    isd_stations = make_stations(args.stations, 'isd', start_date, end_date,
+                                 args.stations_per_cell)
+    previous_coops = [dataclasses.replace(
+        x, end_date=previous_end_date, end_date_to_use=previous_end_date)
+        for x in coop_stations]
+    previous_isds = [dataclasses.replace(
+        x, end_date=previous_end_date, end_date_to_use=previous_end_date)
+        for x in isd_stations]
+
+    water_cells, empty_gldas_cells = pick_no_data_cells(
+        isd_stations, args.no_data_cells)
+    config = stand_in_server.StandInConfig(
+        stations=coop_stations, latency=args.latency,
+        failure_rate=args.failure_rate,
+        virtual_rod_rate=args.virtual_rod_rate, water_cells=water_cells,
+        empty_gldas_cells=empty_gldas_cells, start_date=start_date,
+        end_date=end_date)
+    server = stand_in_server.start_server(config)
+    stand_in_server.point_at(server)
+
+    common_http.RETRY_POLICY = common_http.RetryPolicy(
+        base_delay=args.retry_delay, max_delay=60 * args.retry_delay)
+    common_http.BREAKER_COOLDOWN = 60 * args.retry_delay
+
+    # laid out like the repository: the scripts run from src, and the
+    # data are somewhere else
+    base_dir = tempfile.mkdtemp(prefix='get_ncei_benchmark_')
+    work_dir = os.path.join(base_dir, 'src')
+    os.mkdir(work_dir)
+    common.DATA_BASE_DIR = os.path.join(base_dir, 'data')
+    os.mkdir(common.DATA_BASE_DIR)
+    common_http.CACHE_DIR = os.path.join(common.DATA_BASE_DIR, 'http_cache')
+    yearly_update.make_directories(common.CURRENT_END_YEAR)
+
+    old_dir = os.getcwd()
+    os.chdir(work_dir)
+    seconds = {}
+    try:
+        write_working_directory(previous_coops, previous_isds)
+        with open('isd-history_' + str(common.CURRENT_END_YEAR) + '.txt',
+                  'wb') as file:
+            file.write(stand_in_server.make_isd_history(isd_stations))
+        with open(OFFSET_INVENTORY_FILENAME, 'wb') as file:
+            file.write(stand_in_server.make_inventory(coop_stations))
+        write_previous_data(previous_coops, previous_isds)
+        config.request_counts.clear()
+
+        start = time.perf_counter()
+        yearly_update.update_coop_data(
+            yearly_update.make_updated_coops(), args.download_workers,
+            args.jobs, args.append_downloads)
+        seconds['coop'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        yearly_update.update_isd_data(args.jobs)
+        seconds['isd'] = time.perf_counter() - start
+    finally:
+        os.chdir(old_dir)
+        server.shutdown()
+
+    report(seconds)
+    print(f'requests: {config.request_counts}')
+
+    if args.keep:
+        print(f'working directory is {work_dir}, data are in '
+              f'{common.DATA_BASE_DIR}')
+    else:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,10 @@ import datetime
 import os
 
 import common
+import dat_file
 import get_isd_stations
 import check_isd_data
 
-import shutil
-
 
 
 BASINS_DIR = os.path.join(
@@ -114,11 +113,7 @@ def combine_two_isds(first_isd, second_isd):
     return both_data
 
 def write_file(o_file, combined_data):
-
-    with open(o_file, 'w') as file:
-        for item in combined_data:
-            to_file = f'{item[0]}\t{item[1]}\t{item[2]}\t{item[3]}\t{item[4]}\t{item[5]}\t{item[6]}\n'
-            file.write(to_file)
+    dat_file.write_blocks(o_file, dat_file.format_tab(combined_data))
 
 
 if __name__ == '__main__':
@@ -132,10 +127,10 @@ if __name__ == '__main__':
             if the_data:
                 write_file(filename, the_data)
             else:
-                shutil.copyfile(os.path.join(
+                dat_file.carry_forward(os.path.join(
                     common.DATA_BASE_DIR, 'filled_coop_data', station.station_id + '.dat'), filename)
         else:
-            shutil.copyfile(os.path.join(
+            dat_file.carry_forward(os.path.join(
                 common.DATA_BASE_DIR, 'filled_coop_data', station.station_id + '.dat'), filename)
 
 
@@ -164,10 +159,10 @@ if __name__ == '__main__':
                 if the_data:
                     write_file(filename, the_data)
                 else:
-                    shutil.copyfile(os.path.join(
+                    dat_file.carry_forward(os.path.join(
                         common.DATA_BASE_DIR, 'filled_isd_data', station.station_id + '.dat'), filename)
             else:
-                shutil.copyfile(os.path.join(
+                dat_file.carry_forward(os.path.join(
                     common.DATA_BASE_DIR, 'filled_isd_data', station.station_id + '.dat'), filename)
 
     for item in prefix_full_ids:
@@ -193,7 +188,7 @@ if __name__ == '__main__':
 
             if (second_station.start_date_to_use - first_station.end_date_to_use).days > 1:
                 # no combination but we do need to do something
-                    shutil.copyfile(os.path.join(
+                    dat_file.carry_forward(os.path.join(
                         common.DATA_BASE_DIR, 'filled_isd_data', station.station_id + '.dat'), filename)
             else:
                 the_data = combine_two_isds(first_station, second_station)
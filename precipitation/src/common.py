@@ -1,8 +1,13 @@
 import csv
 import datetime
 import os
+
 from dataclasses import dataclass
 
+import numpy as np
+
+import storage
+
 
 CHPD_BASE_URL = 'http://ncei.noaa.gov/data/coop-hourly-precipitation/v2/'
 
@@ -138,7 +143,7 @@ def get_stations(short_filename):
 
 def read_precip(start_date, end_date, station_file):
 
-    with open(station_file, 'r') as file:
+    with storage.open_file(station_file) as file:
         data = file.readlines()
 
     split_data = [item.split() for item in data]
@@ -157,17 +162,124 @@ def read_precip(start_date, end_date, station_file):
     return (split_data, years)
 
 
-def get_date_dict(value, first_date, last_date):
+ONE_HOUR = datetime.timedelta(hours=1)
+
+
+def hours_between(first_date, last_date):
+    """
+    Returns the number of whole hours from first_date to last_date
+    """
+    return (last_date - first_date) // ONE_HOUR
 
-    delta = datetime.timedelta(hours=1)
-    date_list = [first_date]
 
-    iterate_date = first_date
-    while iterate_date < last_date:
-        iterate_date += delta
-        date_list.append(iterate_date)
+class HourlySeries:
+    """
+    Hourly values starting at the hour start
+
+    values is a float array with one entry per hour and missing is a
+    boolean array that is True for hours without data
+    Index with a datetime to get one hour or with a slice of datetimes
+    (both ends included) to get a new HourlySeries
+    """
 
-    return {key:value for key in date_list}
+    def __init__(self, start, values, missing):
+        assert len(values) == len(missing)
+        self.start = start
+        self.values = values
+        self.missing = missing
+
+    @classmethod
+    def empty(cls, first_date, last_date, missing=True):
+        """
+        Returns a series from first_date to last_date with every value 0
+        and every hour marked missing (or not missing)
+        """
+        length = hours_between(first_date, last_date) + 1
+        return cls(first_date, np.zeros(length),
+                   np.full(length, missing, dtype=bool))
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def end(self):
+        return self.start + (len(self) - 1) * ONE_HOUR
+
+    def index(self, the_date):
+        """
+        Returns the array position of the_date
+        Raises KeyError if the_date is not in the series
+        """
+        position = hours_between(self.start, the_date)
+        if not 0 <= position < len(self):
+            raise KeyError(the_date)
+        return position
+
+    def positions(self, hours):
+        """
+        Returns the array positions of a numpy datetime64 array of hours
+        """
+        return (hours.astype('datetime64[h]') -
+                np.datetime64(self.start, 'h')).astype(np.int64)
+
+    def __contains__(self, the_date):
+        return 0 <= hours_between(self.start, the_date) < len(self)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            first = 0 if key.start is None else self.index(key.start)
+            last = len(self) - 1 if key.stop is None else self.index(key.stop)
+            return HourlySeries(self.start + first * ONE_HOUR,
+                                self.values[first:last + 1],
+                                self.missing[first:last + 1])
+
+        position = self.index(key)
+        if self.missing[position]:
+            return None
+        return self.values[position]
+
+    def __setitem__(self, the_date, value):
+        """
+        Sets the value for the_date; a value of None marks it missing
+        """
+        position = self.index(the_date)
+        if value is None:
+            self.missing[position] = True
+        else:
+            self.values[position] = value
+            self.missing[position] = False
+
+    def concatenate(self, other):
+        """
+        Returns a new series with other appended to this one
+        Any hours between the end of this series and the start of other
+        are marked missing
+        """
+        gap = hours_between(self.end, other.start) - 1
+        assert gap >= 0
+        return HourlySeries(
+            self.start,
+            np.concatenate([self.values, np.zeros(gap), other.values]),
+            np.concatenate([self.missing, np.ones(gap, dtype=bool),
+                            other.missing]))
+
+    def hours(self):
+        """
+        Yields the datetime of each hour in the series
+        """
+        the_date = self.start
+        for _ in range(len(self)):
+            yield the_date
+            the_date += ONE_HOUR
+
+    def hour_array(self):
+        """
+        Returns the hour of each value as a datetime64[h] array
+        """
+        return np.datetime64(self.start, 'h') + np.arange(len(self))
+
+    def missing_count(self):
+        return int(np.count_nonzero(self.missing))
 
 
 KNOWN_NO_DATA = [
@@ -1,10 +1,32 @@
+import csv
 import datetime
+import heapq
+import importlib
+import itertools
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
 
-import requests
 import numpy as np
 
 import common
+import common_http
+import dat_file
+import storage
+
+
+NLDAS_URL = 'https://hydro1.sci.gsfc.nasa.gov/daac-bin/access/timeseries.cgi'
+GLDAS_URL = 'https://hydro1.gesdisc.eosdis.nasa.gov/daac-bin/access/timeseries.cgi'
+
+# NLDAS and GLDAS error messages have this in them, in any case
+LDAS_ERROR_MARKER = b'error'
+
+# LDAS cells found to have no data, kept next to the station lists in
+# the working directory (src)
+NO_DATA_CELLS_FILE = 'no_data_cells.csv'
 
 
 class NLDAS:
@@ -31,25 +53,192 @@ def read_data(filename):
     """
     Reads precipitation data
     """
-    with open(filename, 'r') as file:
+    with storage.open_file(filename) as file:
         precip_data = file.readlines()
 
     return [item.split() for item in precip_data]
 
 
+def get_hours(years, months, days, hours):
+    """
+    Returns a datetime64[h] array from integer arrays of years, months,
+    days and hours; hour 24 is hour 0 of the next day
+    """
+    dates = ((years - 1970).astype('datetime64[Y]').astype('datetime64[M]') +
+             (months - 1)).astype('datetime64[D]') + (days - 1)
+    return dates.astype('datetime64[h]') + hours
+
+
+class PrecipRecords:
+    """
+    The rows of a processed precipitation file as columns
+
+    columns is a list with the strings in each field, hours the local
+    hour of each row as datetime64[h] and values the value of each row
+    as a string array
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.hours = get_hours(
+            *(np.array(x, dtype=np.int64) for x in columns[1:5]))
+        self.values = np.array(columns[-1], dtype=str)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls(dat_file.get_columns(rows))
+
+    @classmethod
+    def read(cls, filename):
+        with storage.open_file(filename) as file:
+            text = file.read()
+
+        # every line has the same fields, so split the whole file at
+        # once and take every FIELDS-th field for each column
+        fields = text.split()
+        lines = text.count('\n') + (not text.endswith('\n') and bool(text))
+        if len(fields) != lines * dat_file.FIELDS:
+            return cls.from_rows([x.split() for x in text.splitlines()])
+
+        return cls([fields[i::dat_file.FIELDS]
+                    for i in range(dat_file.FIELDS)])
+
+    def __len__(self):
+        return len(self.values)
+
+    def missing(self, missing_value):
+        """
+        Returns a boolean array that is True for rows with missing_value
+        """
+        return self.values == missing_value
+
+    def missing_dates(self, missing_value):
+        """
+        Returns the datetime of each row with missing_value
+        """
+        return self.hours[self.missing(missing_value)].tolist()
+
+
+class NoDataCells:
+    """
+    LDAS grid cells known to have no data, so they are never requested
+
+    Keys are ('nldas', x, y) for NLDAS cells and ('gldas', lat, lon) of
+    the cell center for GLDAS cells. common.KNOWN_NO_DATA is always
+    included; cells found during a run are appended to filename so the
+    next run skips them too
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.cells = {('gldas',) + x: 'known' for x in common.KNOWN_NO_DATA}
+        self.read()
+
+    def read(self):
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename, 'r', newline='') as file:
+                for row in csv.DictReader(file):
+                    self.cells[self.make_key(
+                        row['dataset'], row['a'], row['b'])] = row['reason']
+
+    def make_key(self, dataset, a, b):
+        if dataset == 'nldas':
+            return dataset, int(a), int(b)
+        return dataset, float(a), float(b)
+
+    def __contains__(self, key):
+        return key in self.cells
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add(self, key, reason):
+        """
+        Records key as a cell with no data
+        """
+        with self.lock:
+            if key in self.cells:
+                return
+            # another fill process may have recorded it since
+            self.read()
+            if key in self.cells:
+                return
+            self.cells[key] = reason
+            if not self.filename:
+                return
+
+            new_file = not os.path.exists(self.filename)
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, 'a', newline='') as file:
+                writer = csv.writer(file)
+                if new_file:
+                    writer.writerow(['dataset', 'a', 'b', 'reason', 'recorded'])
+                writer.writerow(list(key) + [
+                    reason, f'{datetime.datetime.now():%Y-%m-%d}'])
+
+
+_no_data_cells = {}
+
+
+def get_no_data_cells():
+    """
+    Returns the NoDataCells for NO_DATA_CELLS_FILE, which is relative to
+    the working directory like the station lists
+    """
+    filename = os.path.join(os.getcwd(), NO_DATA_CELLS_FILE)
+    if filename not in _no_data_cells:
+        _no_data_cells[filename] = NoDataCells(filename)
+    return _no_data_cells[filename]
+
+
 def get_nldas_data(data_type, start_date_str, end_date_str, x_str, y_str):
     """
     Gets data from NLDAS
     """
 
-    precip_url = "https://hydro1.sci.gsfc.nasa.gov/daac-bin/access/" \
-                  + "timeseries.cgi?variable=NLDAS:NLDAS_FORA0125_H.002:" \
+    precip_url = NLDAS_URL \
+                  + "?variable=NLDAS:NLDAS_FORA0125_H.002:" \
                   + data_type + "&startDate=" + start_date_str \
                   + "&endDate=" + end_date_str \
                   + "&location=NLDAS:X" + x_str + "-Y" + y_str + "&type=asc2"
 
-    r = requests.get(precip_url)
+    return get_ldas(precip_url)
+
+
+class LdasError(ValueError):
+    """
+    An error message from NLDAS or GLDAS in place of data; unless the
+    cell is over water, it is probably worth trying again later
+    """
+
+
+def is_ldas_data(content):
+    """
+    False for the error messages NLDAS and GLDAS send with status 200,
+    which are never cached: most of them are temporary
+    """
+    return LDAS_ERROR_MARKER not in content.lower()
+
 
+def get_ldas(url):
+    """
+    Gets url from NLDAS or GLDAS
+
+    The server says it did not get a virtual rod when it is busy; that
+    is requested again like any busy server, following
+    common_http.RETRY_POLICY
+    Raises common_http.TransientError once every attempt has failed and
+    requests.HTTPError for any other status that is not 2xx
+    """
+    def check(content):
+        if b'virtual rod' in content:
+            raise common_http.TransientError(
+                f'did not get a virtual rod successfully: {url}')
+        return is_ldas_data(content)
+
+    r = common_http.get(url, check=check)
+    r.raise_for_status()
     return r.content
 
 
@@ -91,15 +280,14 @@ def get_gldas_data(data_type, start_date, end_date, lat, lon):
                     start_date_str = '2000-01-01T00'
                 end_date_str = f'{end_date + end_date_delta:%Y-%m-%dT00}'
 
-            precip_url = "https://hydro1.gesdisc.eosdis.nasa.gov/daac-bin/" \
-                + "access/timeseries.cgi?variable=" + condition \
+            precip_url = GLDAS_URL \
+                + "?variable=" + condition \
                 + data_type + "&startDate=" + start_date_str \
                 + "&endDate=" + end_date_str \
                 + "&location=GEOM:POINT(" + lon + ",%20" + lat + ")" \
                 + "&type=asc2"
 
-            r = requests.get(precip_url)
-            data[index] = r.content
+            data[index] = get_ldas(precip_url)
 
     return data
 
@@ -112,7 +300,7 @@ def process_nldas_data(data):
     for line in split_data:
         ls = line.strip()
         if "error" in ls.lower():
-            raise ValueError(ls.lower())
+            raise LdasError(ls.lower())
         date_time_data = ls.split()
         if (len(date_time_data) == 3 and len(date_time_data[0]) == 10
                 and len(date_time_data[1]) == 3):
@@ -139,7 +327,7 @@ def process_gldas_data(data):
             for line in split_data:
                 ls = line.strip()
                 if "error" in ls.lower():
-                    raise ValueError(ls.lower())
+                    raise LdasError(ls.lower())
                 date_time_data = ls.split()
                 if (len(date_time_data) == 2 and len(date_time_data[0]) == 19):
                     ymd = date_time_data[0].split('-')
@@ -158,260 +346,723 @@ def process_gldas_data(data):
     return gldas_dict
 
 
-def get_missing_dates(data_1, missing_value):
-    missing_dates = []
-    for x in data_1:
-        if x[-1] == missing_value:
-            try:
-                missing_dates.append(
-                    datetime.datetime(int(x[1]), int(x[2]), int(x[3]),
-                                      int(x[4])))
-            except ValueError:
-                missing_dates.append(
-                    datetime.datetime(int(x[1]), int(x[2]), int(x[3])) +
-                    datetime.timedelta(days=1))
+# ordinal of 1970-01-01, where datetime64 counts from
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def to_hours(dates):
+    """
+    Returns a datetime64[h] array for a list of datetimes on the hour
+    Ten times faster than np.array(dates, dtype='datetime64[h]')
+    """
+    return (np.array([x.toordinal() * 24 + x.hour for x in dates],
+                     dtype=np.int64) -
+            EPOCH_ORDINAL * 24).astype('datetime64[h]')
+
+
+def get_ldas_hours(ldas_data, offset=False):
+    """
+    Returns the hours of ldas_data, which are in UTC, moved offset hours
+    to local time as a sorted datetime64[h] array, and the values in the
+    same order
+    """
+    hours = to_hours(ldas_data.keys())
+    values = np.array(list(ldas_data.values()), dtype=float)
+    order = np.argsort(hours, kind='stable')
+
+    return hours[order] + (offset or 0), values[order]
+
+
+def get_corresponding_nldas(missing_hours, nldas_hours):
+    """
+    Returns the position in nldas_hours of each of missing_hours
+    Raises KeyError for the first hour NLDAS has no value for
+    """
+    positions = np.searchsorted(nldas_hours, missing_hours)
+    found = positions < len(nldas_hours)
+    found[found] = nldas_hours[positions[found]] == missing_hours[found]
+    if not found.all():
+        raise KeyError(missing_hours[~found][0].tolist())
+
+    return positions
+
+
+# a missing hour takes the GLDAS step at most this many hours before it
+GLDAS_STEP_HOURS = 2
+
+
+def get_corresponding_gldas(missing_hours, gldas_hours):
+    """
+    Returns the position in gldas_hours of the GLDAS step for each of
+    missing_hours
+    GLDAS is 3-hourly, so each missing hour takes the most recent step
+    at or before it; raises ValueError if that is more than
+    GLDAS_STEP_HOURS before it
+    """
+    positions = np.searchsorted(gldas_hours, missing_hours, side='right') - 1
+    found = positions >= 0
+    if len(gldas_hours):
+        found &= (missing_hours - gldas_hours[np.maximum(positions, 0)] <=
+                  np.timedelta64(GLDAS_STEP_HOURS, 'h'))
+    if not found.all():
+        raise ValueError
 
-    return missing_dates
+    return positions
 
 
-def get_corresponding_nldas(missing_dates, nldas_data):
+def fill_records(records, missing_value, ldas_data, offset=False,
+                 first_ldas_date=None,
+                 get_corresponding=get_corresponding_nldas):
+    """
+    Fills the rows of records that have missing_value with ldas_data
 
-    first_nldas_date = list(nldas_data.items())[0][0]
+    Rows before first_ldas_date (by default the first hour of ldas_data)
+    are dropped, and so are rows that end up with no precipitation
+    get_corresponding finds the LDAS hour for each missing hour
+    Returns the rows to write
+    """
+    ldas_hours, ldas_values = get_ldas_hours(ldas_data, offset)
+
+    if first_ldas_date is None:
+        first_ldas_date = next(iter(ldas_data)) + datetime.timedelta(
+            hours=offset or 0)
     # this will be some number of hours after the start_date,
     # with a different hour depending on the UTC offset
     # for EST for a start date of 1979/1/1,  the first available date
     # should be 1979/1/1 19:00
 
-    missing = {}
-
-    for missing_date in missing_dates:
-        if missing_date >= first_nldas_date:
-            missing[missing_date] = nldas_data[missing_date]
-
-    return first_nldas_date, missing
+    kept = records.hours >= np.datetime64(first_ldas_date, 'h')
+    missing = kept & records.missing(missing_value)
+    positions = get_corresponding(records.hours[missing], ldas_hours)
 
+    str_precip = list(records.columns[6])
+    for index, ldas_precip in zip(np.flatnonzero(missing).tolist(),
+                                  ldas_values[positions].tolist()):
+        if ldas_precip == 0:
+            str_precip[index] = '0.0'
+        else:
+            str_precip[index] = str(round(ldas_precip, 3))
 
-def get_corresponding_gldas(missing_dates, gldas_data):
+    return [x for x in itertools.compress(
+        zip(*records.columns[0:6], str_precip), kept.tolist())
+        if x[6] != '0.0']
 
-    first_gldas_date = list(gldas_data.items())[0][0]
-    # this will be approximately 1/1/1979, with a different hour depending
-    # on the UTC offset
-    # for EST, the first available date should be 1979/1/1 19:00
 
-    missing = {}
+def write_file(o_file, rows):
+    dat_file.write_blocks(o_file, dat_file.format_tab(rows))
 
-    gldas_keys = list(gldas_data.keys())
 
-    for missing_date in missing_dates:
-        if missing_date >= first_gldas_date:
-            if missing_date in gldas_keys:
-                missing[missing_date] = gldas_data[missing_date]
-            else:
-                subtracted_date = missing_date - datetime.timedelta(hours=1)
-                if subtracted_date in gldas_keys:
-                    missing[missing_date] = gldas_data[subtracted_date]
-                else:
-                    subtracted_date = missing_date - datetime.timedelta(
-                        hours=2)
-                    if subtracted_date in gldas_keys:
-                        missing[missing_date] = gldas_data[subtracted_date]
-                    else:
-                        raise ValueError
+# GLDAS 0.25 degree grid cell centers
+GLDAS_DEGREES_PER_GRID_CELL = 0.25
+GLDAS_SOUTHMOST_GRID_CENTER = -59.875
+GLDAS_WESTMOST_GRID_CENTER = -179.875
+GLDAS_LAT_CELLS = 599
+GLDAS_LON_CELLS = 1439
 
-    return first_gldas_date, missing
+# number of cells get_ordered_pairs tries before giving up
+MAX_ORDERED_PAIRS = 1000
 
 
-def fill_data(missing, raw_data, first_ldas_date, missing_value):
+def get_grid_center(first_center, index):
+    return first_center + index * GLDAS_DEGREES_PER_GRID_CELL
 
-    filled_data = []
-    for x in raw_data:
-        try:
-            local_date = datetime.datetime(
-                int(x[1]), int(x[2]), int(x[3]), int(x[4]))
-        except ValueError:
-            local_date = datetime.datetime(
-                int(x[1]), int(x[2]), int(x[3])) + datetime.timedelta(days=1)
-
-        if local_date >= first_ldas_date:
-            if x[-1] == missing_value:
-                ldas_precip = missing[local_date]
-                local_thing = x[0:-1]
-                local_thing.append(ldas_precip)
-                filled_data.append(local_thing)
-            else:
-                filled_data.append(x)
 
-    return filled_data
+def get_nearest_index(first_center, cells, value):
+    index = int(round((value - first_center) / GLDAS_DEGREES_PER_GRID_CELL))
+    return min(max(index, 0), cells - 1)
 
 
-def write_file(o_file, filled_data):
-    with open(o_file, 'w') as file:
-        for item in filled_data:
-            if type(item[6]) == str:
-                str_precip = item[6]
-            elif item[6] == 0:
-                str_precip = '0.0'
-            else:
-                str_precip = str(round(item[6], 3))
+def get_gldas_cell(lat, lon):
+    """
+    Returns the key in NoDataCells of the GLDAS cell nearest lat/lon
+    """
+    return ('gldas',
+            get_grid_center(GLDAS_SOUTHMOST_GRID_CENTER, get_nearest_index(
+                GLDAS_SOUTHMOST_GRID_CENTER, GLDAS_LAT_CELLS, lat)),
+            get_grid_center(GLDAS_WESTMOST_GRID_CENTER, get_nearest_index(
+                GLDAS_WESTMOST_GRID_CENTER, GLDAS_LON_CELLS, lon)))
 
-            if str_precip == '0.0':
-                pass
-            else:
-                to_file = f'{item[0]}\t{item[1]}\t{item[2]}\t{item[3]}\t{item[4]}\t{item[5]}\t{str_precip}\n'
-                file.write(to_file)
 
+def get_ring_bound(first_center, cells, nearest, value, ring):
+    """
+    Returns the smallest distance along one axis to a cell ring cells
+    away from nearest, or None if there are no such cells
+    """
+    distances = [abs(get_grid_center(first_center, index) - value)
+                 for index in (nearest - ring, nearest + ring)
+                 if 0 <= index < cells]
 
-def get_ordered_pairs(station):
-    latitude = np.arange(-59.875, 89.875, 0.25)
-    longitude = np.arange(-179.875, 179.875, 0.25)
+    return min(distances) if distances else None
 
-    lats, lons = np.meshgrid(latitude, longitude)
 
+def get_ordered_pairs(station, max_pairs=MAX_ORDERED_PAIRS):
+    """
+    Yields (lat, lon) of GLDAS grid cells in order of increasing
+    distance (the larger of the lat and lon distances) from station,
+    skipping cells known to have no data
+
+    Cells are generated one ring at a time around the nearest cell and
+    yielded once no later ring can hold a closer cell; ties are broken
+    by longitude, then latitude. Stops after max_pairs cells, finishing
+    any cells as far away as the last one
+    Cells are checked against NoDataCells as they are yielded, so cells
+    found empty while trying earlier ones are skipped as well
+    """
+    no_data_cells = get_no_data_cells()
     stn_lat = float(station.latitude)
     stn_lon = float(station.longitude)
 
-    abs_lat = np.abs(lats-stn_lat)
-    abs_lon = np.abs(lons-stn_lon)
+    nearest_lat = get_nearest_index(
+        GLDAS_SOUTHMOST_GRID_CENTER, GLDAS_LAT_CELLS, stn_lat)
+    nearest_lon = get_nearest_index(
+        GLDAS_WESTMOST_GRID_CENTER, GLDAS_LON_CELLS, stn_lon)
+
+    pending = []
+    count = 0
+    last_distance = None
+    ring = 0
+    while True:
+        lat_range = range(max(nearest_lat - ring, 0),
+                          min(nearest_lat + ring, GLDAS_LAT_CELLS - 1) + 1)
+        lon_range = range(max(nearest_lon - ring, 0),
+                          min(nearest_lon + ring, GLDAS_LON_CELLS - 1) + 1)
+        for lon_index in lon_range:
+            on_edge = abs(lon_index - nearest_lon) == ring
+            for lat_index in lat_range:
+                if on_edge or abs(lat_index - nearest_lat) == ring:
+                    grid_lat = get_grid_center(
+                        GLDAS_SOUTHMOST_GRID_CENTER, lat_index)
+                    grid_lon = get_grid_center(
+                        GLDAS_WESTMOST_GRID_CENTER, lon_index)
+                    distance = max(abs(grid_lon - stn_lon),
+                                   abs(grid_lat - stn_lat))
+                    heapq.heappush(
+                        pending, (distance, lon_index, lat_index,
+                                  grid_lat, grid_lon))
+
+        # every cell in a later ring is at least this far away
+        bounds = [x for x in (
+            get_ring_bound(GLDAS_SOUTHMOST_GRID_CENTER, GLDAS_LAT_CELLS,
+                           nearest_lat, stn_lat, ring + 1),
+            get_ring_bound(GLDAS_WESTMOST_GRID_CENTER, GLDAS_LON_CELLS,
+                           nearest_lon, stn_lon, ring + 1)) if x is not None]
+        bound = min(bounds) if bounds else float('inf')
+
+        while pending and pending[0][0] < bound:
+            distance, lon_index, lat_index, grid_lat, grid_lon = \
+                heapq.heappop(pending)
+            if count >= max_pairs and distance != last_distance:
+                return
+            count += 1
+            last_distance = distance
+            if ('gldas', grid_lat, grid_lon) not in no_data_cells:
+                yield grid_lat, grid_lon
+
+        if not bounds:
+            return
+        ring += 1
+
 
-    c = np.maximum(abs_lon, abs_lat)
+def get_nldas_window(start_date, end_date):
+    """
+    Returns the first and last UTC hours NLDAS returns when asked for
+    start_date through end_date with the T24 date strings used here
+    """
+    first_hour = datetime.datetime(
+        start_date.year, start_date.month, start_date.day) + \
+        datetime.timedelta(days=1)
+    last_hour = datetime.datetime(
+        end_date.year, end_date.month, end_date.day) + \
+        datetime.timedelta(days=2)
 
-    x, y = np.where(c == np.min(c))
-    grid_lat = lats[x[0], y[0]]
-    grid_lon = lons[x[0], y[0]]
+    return first_hour, last_hour
 
-    test = np.sort(c, axis=None)[:1000]
 
-    pairs = []
-    for a in test:
-        x_index, y_index = np.where(c == a)
-        for (x_, y_) in zip(x_index, y_index):
-            if (x_, y_) not in pairs:
-                pairs.append((x_, y_))
+# (x, y): (first hour, last hour) to request for each NLDAS cell,
+# set by plan_nldas_fills
+_nldas_plan = {}
 
-    ordered_lat_lons = []
-    for pair in pairs:
+# parsed NLDAS data for the most recently used cells
+NLDAS_CELL_CACHE_SIZE = 4
+_nldas_cells = OrderedDict()
 
-        grid_lat = lats[0, pair[1]]
-        grid_lon = lons[pair[0], 0]
 
-        ordered_lat_lons.append((grid_lat, grid_lon))
+def plan_nldas_fills(stations):
+    """
+    Groups stations by NLDAS grid cell so each cell is fetched once
 
-    filtered_lat_lons = [x for x in ordered_lat_lons if x not in common.KNOWN_NO_DATA]
+    Pass the stations about to be filled, with the dates each one is
+    filled for. A cell with more than one station is requested for the
+    union of their date ranges and nldas_routine takes each station's
+    range out of it; any other cell is requested for its station only
+    Returns dict of (x, y): list of stations
+    """
+    groups = {}
+    _nldas_plan.clear()
+    for station in stations:
+        cell = NLDAS.grid_cell_from_lat_lon(
+            float(station.latitude), float(station.longitude))
+        groups.setdefault(cell, []).append(station)
 
-    return filtered_lat_lons
+    for cell, group in groups.items():
+        if len(group) < 2:
+            continue
+        windows = [get_nldas_window(x.start_date_to_use, x.end_date_to_use)
+                   for x in group]
+        _nldas_plan[cell] = (min(x[0] for x in windows),
+                             max(x[1] for x in windows))
 
+    shared = sum(len(x) for x in groups.values() if len(x) > 1)
+    print(f'{len(stations)} stations in {len(groups)} NLDAS cells; '
+          f'{shared} stations share a cell')
 
-def adjust_dates(ldas, utc):
-    # used for COOP stations only
+    return groups
 
-    ldas_dict = {}
-    for x in ldas:
-        adjusted_date = x + datetime.timedelta(hours=utc)
-        ldas_dict[adjusted_date] = ldas[x]
 
-    return ldas_dict
+def get_cell_nldas_data(x_grid, y_grid, start_date, end_date):
+    """
+    Returns processed NLDAS data for one cell from start_date through
+    end_date (in the form nldas_routine requests them)
+
+    Uses the planned range for the cell when it covers these dates so
+    stations sharing the cell share one request
+    """
+    first_hour, last_hour = get_nldas_window(start_date, end_date)
 
-def nldas_routine(filename, station, station_network, missing_value, offset=False):
+    planned = _nldas_plan.get((x_grid, y_grid))
+    if planned and planned[0] <= first_hour and last_hour <= planned[1]:
+        request_hours = planned
+    else:
+        request_hours = (first_hour, last_hour)
+
+    key = (x_grid, y_grid) + request_hours
+    if key in _nldas_cells:
+        _nldas_cells.move_to_end(key)
+    else:
+        start_date_str = f'{request_hours[0] - datetime.timedelta(days=1):%Y-%m-%dT24}'
+        end_date_str = f'{request_hours[1] - datetime.timedelta(days=1):%Y-%m-%dT24}'
+        raw_nldas_data = get_nldas_data(
+            'APCPsfc', start_date_str, end_date_str, x_grid, y_grid)
+        _nldas_cells[key] = process_nldas_data(raw_nldas_data)
+        while len(_nldas_cells) > NLDAS_CELL_CACHE_SIZE:
+            _nldas_cells.popitem(last=False)
+
+    nldas_data = _nldas_cells[key]
+    if request_hours == (first_hour, last_hour):
+        return nldas_data
+
+    return {k: v for k, v in nldas_data.items()
+            if first_hour <= k <= last_hour}
+
+
+# missing hours closer together than this are filled with one request
+GAP_MERGE_HOURS = 72
+
+# once the gap windows would cover more than this fraction of the
+# station's period, request the whole period instead
+GAP_FULL_FRACTION = 0.5
+
+# ...and the same once there are more windows than this, since every
+# request costs a round trip
+GAP_MAX_WINDOWS = 12
+
+
+def get_missing_runs(missing_dates):
+    """
+    Run-length encodes missing hours
+
+    Returns a list of (first hour, last hour) for each run of
+    consecutive missing hours
+    """
+    one_hour = datetime.timedelta(hours=1)
+    runs = []
+    for missing_date in sorted(missing_dates):
+        if runs and missing_date - runs[-1][1] <= one_hour:
+            runs[-1][1] = missing_date
+        else:
+            runs.append([missing_date, missing_date])
+
+    return [tuple(x) for x in runs]
+
+
+def merge_runs(runs, merge_hours=GAP_MERGE_HOURS):
+    """
+    Merges runs that are no more than merge_hours apart
+    """
+    merge_distance = datetime.timedelta(hours=merge_hours)
+    windows = []
+    for first, last in runs:
+        if windows and first - windows[-1][1] <= merge_distance:
+            windows[-1][1] = max(windows[-1][1], last)
+        else:
+            windows.append([first, last])
+
+    return [tuple(x) for x in windows]
+
+
+def get_gap_windows(missing_dates, offset, first_hour, last_hour,
+                    hours_before=0, merge_hours=GAP_MERGE_HOURS):
+    """
+    Returns the UTC windows that cover the missing local hours
+
+    Each run of missing hours is moved from local time to UTC, extended
+    hours_before hours earlier (GLDAS values for an hour can come from
+    up to two hours before it) and clipped to first_hour and last_hour,
+    the UTC hours a request for the whole period would return
+    Returns None when requesting the whole period is cheaper
+    """
+    utc_offset = datetime.timedelta(hours=offset or 0)
+    before = datetime.timedelta(hours=hours_before)
+
+    runs = []
+    for first, last in get_missing_runs(missing_dates):
+        first = max(first - utc_offset - before, first_hour)
+        last = min(last - utc_offset, last_hour)
+        if first <= last:
+            runs.append((first, last))
+    windows = merge_runs(runs, merge_hours)
+
+    covered = sum((last - first for first, last in windows),
+                  datetime.timedelta(0))
+    if (len(windows) > GAP_MAX_WINDOWS or
+            covered > (last_hour - first_hour) * GAP_FULL_FRACTION):
+        return None
+
+    return windows
+
+
+def get_nldas_gap_data(x_grid, y_grid, windows):
+    """
+    Returns processed NLDAS data for the hours in windows only
+    """
+    nldas_data = {}
+    for first, last in windows:
+        raw_nldas_data = get_nldas_data(
+            'APCPsfc', f'{first:%Y-%m-%dT%H}', f'{last:%Y-%m-%dT%H}',
+            x_grid, y_grid)
+        nldas_data.update(process_nldas_data(raw_nldas_data))
+
+    return nldas_data
+
+
+def nldas_routine(filename, station, station_network, missing_value, offset=False, gaps_only=False):
     # read precip data with missing values present
-    unfilled_precip_data = read_data(filename)
+    records = PrecipRecords.read(filename)
 
-    # get parameters for calling NLDAS
     x_grid, y_grid = NLDAS.grid_cell_from_lat_lon(
         float(station.latitude), float(station.longitude))
-    start_date_str = f'{station.start_date_to_use:%Y-%m-%dT24}'
-    end_date_str = f'{station.end_date_to_use + datetime.timedelta(days=1):%Y-%m-%dT24}'
 
-    # get and process corresponding NLDAS data
-    raw_nldas_data = get_nldas_data(
-        'APCPsfc', start_date_str, end_date_str, x_grid, y_grid)
-    nldas_precip_data = process_nldas_data(raw_nldas_data)
+    windows = None
+    first_nldas_date = None
+    if gaps_only:
+        # only request the hours that are missing
+        first_hour, last_hour = get_nldas_window(
+            station.start_date_to_use, station.end_date_to_use)
+        windows = get_gap_windows(
+            records.missing_dates(missing_value), offset, first_hour,
+            last_hour)
+        first_nldas_date = first_hour + datetime.timedelta(hours=offset or 0)
+
+    # water cells have no data; don't ask again for ones already found
+    cell = ('nldas', int(x_grid), int(y_grid))
+    no_data_cells = get_no_data_cells()
+    if cell in no_data_cells:
+        raise LdasError(f'nldas cell x{x_grid}-y{y_grid} is over water '
+                        f'(known no-data cell)')
+
+    # get and process corresponding NLDAS data;
+    # stations in the same grid cell share one request
+    try:
+        if windows is None:
+            nldas_precip_data = get_cell_nldas_data(
+                x_grid, y_grid, station.start_date_to_use,
+                station.end_date_to_use)
+        else:
+            nldas_precip_data = get_nldas_gap_data(x_grid, y_grid, windows)
+    except LdasError as e:
+        if 'water' in e.args[0]:
+            no_data_cells.add(cell, 'water')
+        raise
 
     # data returned from NLDAS is in UTC
-    # for COOP, adjust this by utc_offset
-    if offset:
-        adjusted_nldas_data = adjust_dates(nldas_precip_data, offset)
-    else:
-        adjusted_nldas_data = nldas_precip_data
-
-    # find missing dates and corresponding NLDAS data
-    missing_dates = get_missing_dates(
-        unfilled_precip_data, missing_value)
-    first_missing_date, missing_dict = get_corresponding_nldas(
-        missing_dates, adjusted_nldas_data)
-
+    # for COOP, fill_records adjusts this by utc_offset
     # fill data and write to file
-    filled_data = fill_data(
-        missing_dict, unfilled_precip_data, first_missing_date, missing_value)
+    filled_data = fill_records(
+        records, missing_value, nldas_precip_data, offset, first_nldas_date)
     out_file = os.path.join(
         common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR)  + '_filled_' + station_network + '_data', station.station_id + '.dat')
     write_file(out_file, filled_data)
 
 
-def gldas_routine(filename, station, station_network, missing_value, offset=False):
-    unfilled_precip_data = read_data(filename)
+def get_gldas_gap_windows(records, station, missing_value, offset):
+    """
+    Returns the days to request from GLDAS to fill only the missing
+    hours, or None to request the whole period
+    Also returns the first date a request for the whole period returns
+    """
+    start_day = datetime.datetime(
+        station.start_date_to_use.year, station.start_date_to_use.month,
+        station.start_date_to_use.day)
+    end_day = datetime.datetime(
+        station.end_date_to_use.year, station.end_date_to_use.month,
+        station.end_date_to_use.day)
+    first_gldas_date = start_day + datetime.timedelta(hours=offset or 0)
+
+    # get_gldas_data pads the end by two days, so the last hour the
+    # whole period covers is the end of the day after end_day
+    windows = get_gap_windows(
+        records.missing_dates(missing_value), offset,
+        start_day, end_day + datetime.timedelta(days=1, hours=23),
+        hours_before=2)
 
-    while True:
+    if windows is None:
+        return None, first_gldas_date
+
+    days = merge_runs(
+        [(datetime.datetime(first.year, first.month, first.day),
+          datetime.datetime(last.year, last.month, last.day))
+         for first, last in windows], merge_hours=24)
+
+    return days, first_gldas_date
+
+
+def get_gldas_precip(station, lat, lon, windows=None):
+    """
+    Gets and processes GLDAS data for lat/lon for the station's whole
+    period, or for each (first day, last day) in windows
+    Returns None for an error in the data or if the cell has no data
+    Cells that only return missing values for the whole period are
+    added to NoDataCells; a few windows of missing values are not
+    enough to say that
+    """
+    cell = get_gldas_cell(float(lat), float(lon))
+    no_data_cells = get_no_data_cells()
+    if cell in no_data_cells:
+        return None
+
+    if windows is None:
         raw_gldas_data = get_gldas_data(
-            'Rainf_tavg', station.start_date_to_use, station.end_date_to_use,
-            str(station.latitude), str(station.longitude))
+            'Rainf_tavg', station.start_date_to_use,
+            station.end_date_to_use, lat, lon)
+    else:
+        raw_gldas_data = []
+        for first, last in windows:
+            raw_gldas_data += get_gldas_data(
+                'Rainf_tavg', first, last, lat, lon)
 
-        try:
-            gldas_precip_data = process_gldas_data(raw_gldas_data)
-            break
-        except ValueError as e:
-            if 'did not get a virtual rod successfully' in str(e):
-                pass
-            else:
-                gldas_precip_data = None
-                break
+    try:
+        gldas_precip_data = process_gldas_data(raw_gldas_data)
+    except ValueError:
+        return None
+
+    # every value was -9999
+    if windows is None and not gldas_precip_data and any(
+            b' -9999' in x for x in raw_gldas_data if x):
+        no_data_cells.add(cell, 'empty series')
+
+    return gldas_precip_data
+
+
+def gldas_routine(filename, station, station_network, missing_value, offset=False, gaps_only=False):
+    records = PrecipRecords.read(filename)
+
+    windows = None
+    first_gldas_date = None
+    if gaps_only:
+        # only request the days with missing hours
+        windows, first_gldas_date = get_gldas_gap_windows(
+            records, station, missing_value, offset)
+        if windows == []:
+            # nothing to fill
+            gldas_subset({}, records, station, station_network, missing_value, offset, first_gldas_date)
+            return
+
+    gldas_precip_data = get_gldas_precip(
+        station, str(station.latitude), str(station.longitude), windows)
 
     if gldas_precip_data:
-        gldas_subset(gldas_precip_data, unfilled_precip_data, station, station_network, missing_value, offset)
+        gldas_subset(gldas_precip_data, records, station, station_network, missing_value, offset, first_gldas_date)
 
     else:
         # try GLDAS routine with next-nearest grid cell
         pairs_to_try = get_ordered_pairs(station)
         for a_pair in pairs_to_try:
             print(a_pair)
-            while True:
-
-                raw_gldas_data = get_gldas_data(
-                    'Rainf_tavg', station.start_date_to_use, station.end_date_to_use,
-                    str(a_pair[0]), str(a_pair[1]))
-
-                try:
-                    gldas_precip_data = process_gldas_data(raw_gldas_data)
-                    break
-                except ValueError as e:
-                    if 'did not get a virtual rod successfully' in str(e):
-                        pass
-                    else:
-                        gldas_precip_data = None
-                        break
+            gldas_precip_data = get_gldas_precip(
+                station, str(a_pair[0]), str(a_pair[1]), windows)
 
             if gldas_precip_data:
-                gldas_subset(gldas_precip_data, unfilled_precip_data, station, station_network, missing_value, offset)
+                gldas_subset(gldas_precip_data, records, station, station_network, missing_value, offset, first_gldas_date)
                 return
 
 
-def gldas_subset(gldas_precip_data, unfilled_precip_data, station, station_network, missing_value, offset=False):
+def gldas_subset(gldas_precip_data, records, station, station_network, missing_value, offset=False, first_gldas_date=None):
 
     no_gldas_date = datetime.datetime(2020, 1, 1, 0, 0)
-    if no_gldas_date not in list(gldas_precip_data.keys()):
+    if no_gldas_date not in gldas_precip_data:
         gldas_precip_data[no_gldas_date] = 0.0
 
-    adjusted_gldas_data = adjust_dates(gldas_precip_data, offset)
-    missing_dates = get_missing_dates(
-        unfilled_precip_data, missing_value)
-
-    first_missing_date, missing_dict = get_corresponding_gldas(
-        missing_dates, adjusted_gldas_data)
-
-    filled_data = fill_data(
-        missing_dict, unfilled_precip_data, first_missing_date, missing_value)
+    filled_data = fill_records(
+        records, missing_value, gldas_precip_data, offset, first_gldas_date,
+        get_corresponding_gldas)
 
     out_file = os.path.join(
         common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_filled_' + station_network + '_data', station.station_id + '.dat')
 
     write_file(out_file, filled_data)
 
+
+def in_nldas_domain(station):
+    return (25 < float(station.latitude) < 53 and
+            -125 < float(station.longitude) < -63)
+
+
+def fill_station(filename, station, station_network, missing_value, offset=False, gaps_only=False):
+    """
+    Fills station with NLDAS, or with GLDAS outside the NLDAS domain
+    and for NLDAS cells over water
+    Other NLDAS errors are raised; they are probably just an error on
+    the NLDAS side, so try again later
+    """
+    if in_nldas_domain(station):
+        try:
+            nldas_routine(filename, station, station_network, missing_value,
+                          offset, gaps_only)
+        except LdasError as e:
+            if 'water' in e.args[0]:
+                gldas_routine(filename, station, station_network,
+                              missing_value, offset, gaps_only)
+            else:
+                raise
+
+    else:
+        gldas_routine(filename, station, station_network, missing_value,
+                      offset, gaps_only)
+
+
+# default number of processes for fill_stations
+FILL_JOBS = os.cpu_count() or 1
+
+# module settings copied into each fill process, since with the spawn
+# start method (the only one on Windows) they would start from the
+# defaults in the source
+WORKER_SETTINGS = {
+    'common': ('DATA_BASE_DIR', 'CURRENT_END_YEAR', 'CURRENT_END_DATE'),
+    'common_http': ('CACHE_DIR', 'MAX_AGE', 'MAX_CACHE_BYTES', 'OFFLINE',
+                    'RETRY_POLICY', 'BREAKER_THRESHOLD', 'BREAKER_COOLDOWN'),
+    'common_fill': ('NLDAS_URL', 'GLDAS_URL', 'NO_DATA_CELLS_FILE',
+                    'GAP_MERGE_HOURS', 'GAP_FULL_FRACTION', 'GAP_MAX_WINDOWS',
+                    '_nldas_plan'),
+    'storage': ('COMPRESSION',),
+}
+
+
+@dataclass
+class FillTask:
+    """
+    Arguments for fill_station for one station
+    """
+    filename: str
+    station: common.Station
+    station_network: str
+    missing_value: str
+    offset: int = False
+    gaps_only: bool = False
+
+
+@dataclass
+class FillResult:
+    """
+    What happened to one station in fill_stations
+    error is the repr of the exception if the fill failed
+    """
+    station_id: str
+    seconds: float
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def get_worker_settings():
+    return {name: {x: getattr(importlib.import_module(name), x)
+                   for x in names}
+            for name, names in WORKER_SETTINGS.items()}
+
+
+def init_worker(settings):
+    for name, values in settings.items():
+        module = importlib.import_module(name)
+        for x, value in values.items():
+            setattr(module, x, value)
+
+
+def fill_task(task):
+    start = time.perf_counter()
+    try:
+        fill_station(task.filename, task.station, task.station_network,
+                     task.missing_value, task.offset, task.gaps_only)
+    except Exception as e:
+        return FillResult(task.station.station_id,
+                          time.perf_counter() - start, repr(e))
+
+    return FillResult(task.station.station_id, time.perf_counter() - start)
+
+
+def fill_group(tasks):
+    """
+    Fills tasks one after another in a worker process
+    Returns a list of FillResult
+    """
+    return [fill_task(x) for x in tasks]
+
+
+def group_fill_tasks(tasks):
+    """
+    Puts the tasks for stations in the same NLDAS cell together so one
+    process fetches the cell once; every other task is its own group
+    """
+    groups = {}
+    for index, task in enumerate(tasks):
+        if in_nldas_domain(task.station):
+            key = NLDAS.grid_cell_from_lat_lon(
+                float(task.station.latitude), float(task.station.longitude))
+        else:
+            key = index
+        groups.setdefault(key, []).append(task)
+
+    return list(groups.values())
+
+
+def fill_stations(tasks, jobs=FILL_JOBS):
+    """
+    Fills the stations for a list of FillTask across jobs processes
+
+    Each process has its own HTTP session and writes its output files
+    itself; call plan_nldas_fills first so stations in a cell share
+    one request
+    Returns a dict of station_id: FillResult
+    """
+    results = {}
+    groups = group_fill_tasks(tasks)
+
+    if jobs <= 1:
+        for group in groups:
+            for result in fill_group(group):
+                results[result.station_id] = result
+    else:
+        with ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker,
+                initargs=(get_worker_settings(),)) as executor:
+            futures = [executor.submit(fill_group, x) for x in groups]
+            for future in as_completed(futures):
+                for result in future.result():
+                    results[result.station_id] = result
+
+    failed = [x for x in results.values() if not x.ok]
+    print(f'filled {len(results) - len(failed)} of {len(results)} stations')
+    for result in failed:
+        print(f'  {result.station_id}: {result.error}')
+
+    return results
@@ -0,0 +1,713 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import common
+import dat_file
+
+
+# number of connections kept alive per host
+DEFAULT_POOL_SIZE = 8
+
+# write downloads to disk in 1 MB pieces
+CHUNK_SIZE = 1024 * 1024
+
+# Responses are cached on disk so that a rerun does not download
+# everything again. Set CACHE_DIR to None to turn the cache off.
+# Cached responses older than MAX_AGE seconds are revalidated with a
+# conditional GET; set MAX_AGE to None to never revalidate.
+# The least recently used responses are removed once the cache is
+# larger than MAX_CACHE_BYTES. A cache hit only records when the entry
+# was used if that was more than USED_INTERVAL seconds ago, so most hits
+# write nothing to the share.
+CACHE_DIR = os.path.join(common.DATA_BASE_DIR, 'http_cache')
+MAX_AGE = 7 * 24 * 3600
+MAX_CACHE_BYTES = 50 * 1024 ** 3
+USED_INTERVAL = 24 * 3600
+
+# With OFFLINE = True nothing is requested; everything comes from the
+# cache and anything not in the cache raises OfflineError
+OFFLINE = False
+
+# download_appended asks for this many bytes from before the end of the
+# earlier copy along with the new bytes, and only appends the new ones
+# if those match
+APPEND_CHECK_BYTES = 64 * 1024
+
+# status codes that mean the server is busy or failing, not that the
+# request is wrong
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# after BREAKER_THRESHOLD failures in a row, stop sending requests to
+# that endpoint for BREAKER_COOLDOWN seconds
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60.0
+
+
+class OfflineError(requests.ConnectionError):
+    """
+    Raised in offline mode when a response is not in the cache
+    """
+
+
+class TransientError(Exception):
+    """
+    Raised for a failure that is worth retrying later: a busy or failing
+    server, or an error body such as the LDAS virtual rod message
+    response is the last response, if there was one
+    """
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+# errors RetryPolicy retries
+RETRYABLE_ERRORS = (TransientError, requests.ConnectionError,
+                    requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class CircuitBreaker:
+    """
+    Pauses every request to one endpoint while the server is failing
+
+    After threshold failures in a row the breaker opens and wait()
+    blocks every caller for cooldown seconds; the next request after
+    that either closes it again or reopens it
+    """
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            delay = self.open_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            now = time.time()
+            if self.failures >= self.threshold and self.open_until <= now:
+                self.open_until = now + self.cooldown
+                print(f'{self.name} is failing; pausing requests for '
+                      f'{self.cooldown:.0f} seconds')
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url):
+    """
+    Returns the CircuitBreaker for the host and path of url
+    """
+    parts = urlsplit(url)
+    name = parts.netloc.lower() + parts.path
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        return _breakers[name]
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Exponential backoff with jitter and a cap on attempts
+
+    The delay before retry n (from 0) is base_delay * 2 ** n, at most
+    max_delay, less a random fraction of up to jitter of it
+    """
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    jitter: float = 0.5
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, function, *args, breaker=None, retry_on=RETRYABLE_ERRORS,
+             **kwargs):
+        """
+        Calls function until it does not raise one of retry_on,
+        sleeping between attempts and waiting on breaker if it is open
+        Raises the last error once every attempt has failed
+        """
+        for attempt in range(self.max_attempts):
+            if breaker:
+                breaker.wait()
+            try:
+                result = function(*args, **kwargs)
+            except retry_on as e:
+                if breaker:
+                    breaker.record_failure()
+                if attempt + 1 == self.max_attempts:
+                    raise
+                print(f'{e}; attempt {attempt + 1} of {self.max_attempts}')
+                time.sleep(self.delay(attempt))
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+@dataclass
+class CachedResponse:
+    """
+    The parts of a requests Response the rest of the code uses
+    """
+    url: str
+    status_code: int
+    content: bytes
+    headers: dict = field(default_factory=dict)
+    from_cache: bool = False
+    body_path: str = None
+
+    def raise_for_status(self):
+        if not 200 <= self.status_code < 300:
+            raise requests.HTTPError(
+                f'{self.status_code} for url: {self.url}', response=self)
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Returns a requests Session that reuses keep-alive connections
+
+    pool_size should be at least the number of threads sharing the session
+    so that no thread has to open a new connection
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """
+    Returns the session shared by everything in this process
+
+    A new session is made after a fork so that processes never share
+    a connection
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = make_session()
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def normalize_url(url):
+    """
+    Returns url with the scheme and host in lower case, default ports
+    removed and the query parameters sorted
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if ((scheme == 'http' and netloc.endswith(':80')) or
+            (scheme == 'https' and netloc.endswith(':443'))):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)),
+                      safe=':,()')
+
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+class ResponseCache:
+    """
+    Content-addressed store of response bodies keyed by normalized URL
+
+    Each entry is a .body file with the response body and a .json file
+    with the URL, status code, fetch time, size and the ETag and
+    Last-Modified headers used for conditional GETs
+    """
+
+    def __init__(self, cache_dir, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    def paths(self, url):
+        key = hashlib.sha256(normalize_url(url).encode()).hexdigest()
+        prefix = os.path.join(self.cache_dir, key[0:2], key)
+        return prefix + '.body', prefix + '.json'
+
+    def read_metadata(self, url):
+        body_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, 'r') as file:
+                metadata = json.load(file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+        if not os.path.exists(body_path):
+            return None
+
+        return metadata
+
+    def touch(self, url, metadata, **changes):
+        """
+        Records that an entry was used and updates its metadata
+        The metadata is only written with changes or once the time it
+        was last used is more than USED_INTERVAL old
+        """
+        if not changes and time.time() - metadata['used'] < USED_INTERVAL:
+            return
+        body_path, meta_path = self.paths(url)
+        metadata.update(changes)
+        metadata['used'] = time.time()
+        self.write_json(meta_path, metadata)
+
+    def store(self, url, response, body_file):
+        """
+        Moves body_file into the cache as the body for url
+        """
+        body_path, meta_path = self.paths(url)
+        size = os.path.getsize(body_file)
+        metadata = {
+            'url': normalize_url(url),
+            'status_code': response.status_code,
+            'fetched': time.time(),
+            'used': time.time(),
+            'size': size,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+        old_size = get_size(body_path)
+        os.replace(body_file, body_path)
+        self.write_json(meta_path, metadata)
+
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes += size - old_size
+        if self.max_bytes and self.size() > self.max_bytes:
+            self.evict(self.max_bytes)
+
+        return metadata
+
+    def temp_file(self, url):
+        """
+        Returns a new temporary file next to the entry for url
+        """
+        body_path, meta_path = self.paths(url)
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(body_path), suffix='.part')
+        os.close(handle)
+        return temp_path
+
+    def write_json(self, path, data):
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.part')
+        with os.fdopen(handle, 'w') as file:
+            json.dump(data, file)
+        os.replace(temp_path, path)
+
+    def invalidate(self, url):
+        body_path, meta_path = self.paths(url)
+        try:
+            size = os.path.getsize(body_path)
+            os.remove(body_path)
+        except FileNotFoundError:
+            # not cached, or another thread removed it first
+            size = 0
+        try:
+            os.remove(meta_path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            if self.total_bytes is not None:
+                self.total_bytes -= size
+
+    def entries(self):
+        """
+        Yields (body path, metadata) for every entry in the cache
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for prefix_dir in os.scandir(self.cache_dir):
+            if not prefix_dir.is_dir():
+                continue
+            for entry in os.scandir(prefix_dir.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        with open(entry.path, 'r') as file:
+                            metadata = json.load(file)
+                    except (OSError, json.decoder.JSONDecodeError):
+                        continue
+                    yield entry.path[:-len('.json')] + '.body', metadata
+
+    def size(self):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(
+                    metadata['size'] for body_path, metadata in self.entries())
+            return self.total_bytes
+
+    def evict(self, max_bytes):
+        """
+        Removes the least recently used entries until the cache holds
+        no more than max_bytes
+        """
+        with self.lock:
+            entries = sorted(self.entries(), key=lambda x: x[1]['used'])
+            total_bytes = sum(metadata['size'] for body_path, metadata in entries)
+            for body_path, metadata in entries:
+                if total_bytes <= max_bytes:
+                    break
+                for path in (body_path, body_path[:-len('.body')] + '.json'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total_bytes -= metadata['size']
+            self.total_bytes = total_bytes
+
+
+def get_size(path):
+    """
+    Returns the size of the file at path, or 0 if there is none
+    """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+_caches = {}
+
+
+def get_cache():
+    """
+    Returns the ResponseCache for CACHE_DIR or None if caching is off
+    """
+    if CACHE_DIR is None:
+        return None
+    if CACHE_DIR not in _caches:
+        _caches[CACHE_DIR] = ResponseCache(CACHE_DIR, MAX_CACHE_BYTES)
+    return _caches[CACHE_DIR]
+
+
+def is_fresh(metadata, max_age):
+    """
+    Returns True if the entry was fetched less than max_age seconds ago
+    """
+    return max_age is None or time.time() - metadata['fetched'] < max_age
+
+
+def conditional_headers(metadata):
+    headers = {}
+    if metadata and metadata['etag']:
+        headers['If-None-Match'] = metadata['etag']
+    if metadata and metadata['last_modified']:
+        headers['If-Modified-Since'] = metadata['last_modified']
+    return headers
+
+
+def stream_to_file(r, out_file):
+    """
+    Writes the body of a streamed response to out_file through a
+    temporary file so a failed download never leaves a partial file
+    """
+    temp_file = out_file + '.part'
+    try:
+        with open(temp_file, 'wb') as file:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                file.write(chunk)
+        os.replace(temp_file, out_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def fetch(url, session=None, max_age=None, out_file=None, check=None):
+    """
+    Gets url through the cache
+    max_age defaults to MAX_AGE
+    check is called with the body of a new 2xx response and returns
+    False for one that should not be cached, such as an error message
+    sent with status 200; the response then has its content. check can
+    also raise TransientError for a body worth requesting again
+
+    Connection errors and busy or failing servers are retried following
+    RETRY_POLICY; TransientError is raised once every attempt has failed
+    Returns a CachedResponse whose content is None when the body is
+    on disk: body_path is then either the cache entry or out_file
+    Only 2xx responses are cached; others are returned with content
+    """
+    if session is None:
+        session = get_session()
+    if max_age is None:
+        max_age = MAX_AGE
+
+    cache = get_cache()
+    metadata = cache.read_metadata(url) if cache else None
+
+    if metadata and (OFFLINE or is_fresh(metadata, max_age)):
+        cache.touch(url, metadata)
+        return cached_response(url, metadata)
+
+    if OFFLINE:
+        raise OfflineError(f'not in the cache: {url}')
+
+    return RETRY_POLICY.call(fetch_once, url, session, cache, metadata,
+                             out_file, check, breaker=get_breaker(url))
+
+
+def fetch_once(url, session, cache, metadata, out_file, check=None):
+    """
+    Makes one request for fetch
+    Raises TransientError if the server is busy or failing, or if check
+    does
+    """
+    with session.get(url, headers=conditional_headers(metadata),
+                     stream=True) as r:
+        if r.status_code == 304 and metadata:
+            cache.touch(url, metadata, fetched=time.time())
+            return cached_response(url, metadata)
+
+        if not 200 <= r.status_code < 300:
+            response = CachedResponse(url, r.status_code, r.content,
+                                      dict(r.headers))
+            if r.status_code in TRANSIENT_STATUS_CODES:
+                raise TransientError(f'{r.status_code} for url: {url}',
+                                     response)
+            return response
+
+        if check is not None and not check(r.content):
+            return CachedResponse(url, r.status_code, r.content,
+                                  dict(r.headers))
+
+        if cache is None:
+            if out_file is None:
+                return CachedResponse(url, r.status_code, r.content,
+                                      dict(r.headers))
+            stream_to_file(r, out_file)
+            return CachedResponse(url, r.status_code, None, dict(r.headers),
+                                  body_path=out_file)
+
+        temp_file = cache.temp_file(url)
+        try:
+            with open(temp_file, 'wb') as file:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    file.write(chunk)
+            metadata = cache.store(url, r, temp_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    response = cached_response(url, metadata)
+    response.from_cache = False
+    return response
+
+
+def cached_response(url, metadata):
+    body_path, meta_path = get_cache().paths(url)
+    headers = {}
+    if metadata['etag']:
+        headers['ETag'] = metadata['etag']
+    if metadata['last_modified']:
+        headers['Last-Modified'] = metadata['last_modified']
+    return CachedResponse(url, metadata['status_code'], None, headers,
+                          from_cache=True, body_path=body_path)
+
+
+def get(url, session=None, max_age=None, check=None):
+    """
+    Gets url, using the cache when possible
+    check is as for fetch
+
+    Returns a CachedResponse with the body in content
+    """
+    response = fetch(url, session, max_age, check=check)
+
+    if response.content is None:
+        with open(response.body_path, 'rb') as file:
+            response.content = file.read()
+
+    return response
+
+
+def invalidate(url):
+    """
+    Removes url from the cache, e.g. when its body was an error message
+    """
+    cache = get_cache()
+    if cache:
+        cache.invalidate(url)
+
+
+def download(url, out_file, session=None, max_age=None):
+    """
+    Streams the response body for url to out_file
+
+    The body goes through the cache when it is on; either way it is
+    written to a temporary file first and moved into place once it is
+    complete so a failed download never leaves a partial file behind
+    out_file is carried forward from the cache entry like an unchanged
+    station file (see dat_file.carry_forward), so with links the body
+    is only on disk once
+    Raises requests.HTTPError if the status code is not 2xx
+    """
+    response = fetch(url, session, max_age, out_file)
+    response.raise_for_status()
+
+    if response.body_path != out_file:
+        dat_file.carry_forward(response.body_path, out_file)
+
+
+def get_validator(headers):
+    """
+    Returns the ETag, or else the Last-Modified date, for If-Range
+    """
+    return headers.get('ETag') or headers.get('Last-Modified')
+
+
+def fetch_appended_once(url, session, old_file, out_file):
+    """
+    Makes the requests for download_appended
+    Returns 'appended' or 'unchanged' if out_file was made from old_file,
+    'downloaded' if the server sent the whole file instead, or None if
+    old_file is not the start of the file on the server
+    Raises TransientError if the server is busy or failing
+    """
+    # sizes and ranges are of the bytes as stored, not compressed
+    headers = {'Accept-Encoding': 'identity'}
+    r = session.head(url, headers=headers, allow_redirects=True)
+    if r.status_code in TRANSIENT_STATUS_CODES:
+        raise TransientError(f'{r.status_code} for url: {url}')
+    if (r.status_code != 200 or 'Content-Length' not in r.headers or
+            r.headers.get('Accept-Ranges') != 'bytes'):
+        return None
+
+    size = int(r.headers['Content-Length'])
+    old_size = os.path.getsize(old_file)
+    if size < old_size:
+        return None
+
+    check_start = max(old_size - APPEND_CHECK_BYTES, 0)
+    with open(old_file, 'rb') as file:
+        file.seek(check_start)
+        check = file.read()
+
+    headers['Range'] = f'bytes={check_start}-'
+    validator = get_validator(r.headers)
+    if validator:
+        # the whole file comes back instead if it changed since the HEAD
+        headers['If-Range'] = validator
+
+    with session.get(url, headers=headers, stream=True) as r:
+        if r.status_code in TRANSIENT_STATUS_CODES:
+            raise TransientError(f'{r.status_code} for url: {url}')
+        if r.status_code == 200:
+            stream_to_file(r, out_file)
+            return 'downloaded'
+        if (r.status_code != 206 or not r.headers.get(
+                'Content-Range', '').startswith(f'bytes {check_start}-')):
+            return None
+
+        chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+        start = b''
+        for chunk in chunks:
+            start += chunk
+            if len(start) >= len(check):
+                break
+        if start[:len(check)] != check:
+            return None
+
+        temp_file = out_file + '.part'
+        try:
+            shutil.copyfile(old_file, temp_file)
+            with open(temp_file, 'ab') as file:
+                file.write(start[len(check):])
+                for chunk in chunks:
+                    file.write(chunk)
+            if os.path.getsize(temp_file) != size:
+                return None
+            os.replace(temp_file, out_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    return 'appended' if size > old_size else 'unchanged'
+
+
+def download_appended(url, out_file, old_file, session=None, max_age=None):
+    """
+    Like download, for a file that only grows on the server, where
+    old_file is an earlier copy of it
+
+    The size comes from a HEAD request, and only the bytes after
+    old_file are requested, with a Range that starts APPEND_CHECK_BYTES
+    before its end so the overlap can be compared. If the server does
+    not take ranges or the overlap differs, the whole file is downloaded
+    An edit before the overlap that keeps the size of the file the same
+    is not noticed
+    Returns 'appended', 'unchanged', 'downloaded' or 'cached'
+    """
+    if session is None:
+        session = get_session()
+    if max_age is None:
+        max_age = MAX_AGE
+
+    cache = get_cache()
+    metadata = cache.read_metadata(url) if cache else None
+    if metadata and (OFFLINE or is_fresh(metadata, max_age)):
+        download(url, out_file, session, max_age)
+        return 'cached'
+    if OFFLINE or not os.path.exists(old_file):
+        download(url, out_file, session, max_age)
+        return 'downloaded'
+
+    how = RETRY_POLICY.call(fetch_appended_once, url, session, old_file,
+                            out_file, breaker=get_breaker(url))
+    if how is None:
+        download(url, out_file, session, max_age)
+        return 'downloaded'
+
+    if cache:
+        # so a rerun, or offline mode, finds it like any other download
+        temp_file = cache.temp_file(url)
+        try:
+            dat_file.carry_forward(out_file, temp_file)
+            cache.store(url, CachedResponse(url, 200, None), temp_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    return how
@@ -0,0 +1,286 @@
+"""
+Formats and writes SWMM .dat precipitation files
+
+Two layouts are used: the tab separated one (station, year, month,
+day, hour, minute, value) for processed ISD data and every filled and
+combined file, and the fixed width one get_coop_precip writes for
+processed COOP data
+The formatting functions turn whole arrays into text at once and yield
+it in blocks, and write_blocks writes them through one large buffer, so
+a file takes a few large writes instead of one per line
+
+Files that carry forward unchanged from one year's directory to the
+next are reflinks or hard links where the filesystem allows, and files
+made by joining others are copied in large chunks without decoding
+Every file is written to a temporary file and renamed into place, so a
+link is replaced rather than written through
+Files are written plain or compressed as storage.COMPRESSION says, and
+files read may be either (see storage.py)
+"""
+import os
+import shutil
+
+import numpy as np
+
+import storage
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where reflinks are not tried
+    fcntl = None
+
+
+# fields on each line: station, year, month, day, hour, minute, value
+FIELDS = 7
+
+# lines joined into each block of text
+BLOCK_LINES = 50000
+
+# bytes buffered before each write to disk
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# bytes copied at a time when joining files without os.sendfile
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# ways carry_forward tries to make a file, in order; 'reflink' shares
+# the blocks of the original until either file changes (btrfs, XFS),
+# 'link' makes a hard link and 'copy' copies the bytes
+CARRY_FORWARD_METHODS = ('reflink', 'link', 'copy')
+
+# Linux ioctl that makes one file share the blocks of another
+FICLONE = 0x40049409
+
+# in the fixed width COOP layout the date and hour and the padding
+# after the minute take 18 characters, with at least 2 spaces of padding
+COOP_DATE_WIDTH = 18
+COOP_MIN_PADDING = 2
+
+
+def get_columns(rows):
+    """
+    Returns the FIELDS columns of rows split from a .dat file
+    """
+    return [[x[i] for x in rows] for i in range(FIELDS)]
+
+
+def get_blocks(lines):
+    """
+    Joins a list of lines into blocks of up to BLOCK_LINES lines
+    """
+    for start in range(0, len(lines), BLOCK_LINES):
+        yield ''.join(lines[start:start + BLOCK_LINES])
+
+
+def format_tab(rows):
+    """
+    Yields the tab separated lines for a list of rows of strings in blocks
+    """
+    for start in range(0, len(rows), BLOCK_LINES):
+        block = rows[start:start + BLOCK_LINES]
+        yield '\n'.join(map('\t'.join, block)) + '\n'
+
+
+def to_strings(array, format_value=str):
+    """
+    Returns a list with format_value of each value in array
+    Values repeat a lot, so each distinct one is only formatted once
+    """
+    unique, inverse = np.unique(array, return_inverse=True)
+    strings = np.array([format_value(x) for x in unique.tolist()],
+                       dtype=object)
+    return strings[inverse.ravel()].tolist()
+
+
+def get_date_columns(hours, first_hour=0):
+    """
+    Returns lists of the year, month, day and hour of a datetime64[h]
+    array, as strings, numbering the hours of each day from first_hour
+    """
+    days = hours.astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    return (to_strings(years.astype(np.int64) + 1970),
+            to_strings(months.astype(np.int64) % 12 + 1),
+            to_strings((days - months).astype(np.int64) + 1),
+            to_strings((hours - days).astype(np.int64) + first_hour))
+
+
+def get_values(values, missing, missing_value, format_value):
+    """
+    Returns a list with format_value of each value, or missing_value
+    where missing is True
+    """
+    strings = to_strings(values, format_value)
+    for index in np.flatnonzero(missing).tolist():
+        strings[index] = missing_value
+    return strings
+
+
+def format_isd(station_id, hours, values, missing, missing_value):
+    """
+    Yields the tab separated lines of processed ISD data in blocks
+
+    hours is a datetime64[h] array, values a float array and missing a
+    boolean array; hours that are missing get missing_value and values
+    are rounded to 2 places, and hours with no precipitation are left out
+    """
+    kept = missing | (values != 0)
+    out_values = get_values(values[kept], missing[kept], missing_value,
+                            lambda x: str(round(x, 2)))
+    years, months, days, hours = get_date_columns(hours[kept])
+
+    count = len(out_values)
+    yield from format_tab(list(zip(
+        [station_id] * count, years, months, days, hours, ['0'] * count,
+        out_values)))
+
+
+def format_coop(station_id, hours, values, missing, missing_value):
+    """
+    Yields the fixed width lines of processed COOP data in blocks
+
+    Like format_isd, but hour 0 is written as hour 24 of the day before
+    and values are hundredths of an inch, written in inches to 3 places
+    """
+    kept = missing | (values != 0)
+    out_values = get_values(values[kept], missing[kept], missing_value,
+                            lambda x: f'{x / 100:.3f}')
+    # hour 0 belongs to the day before as hour 24, so number the hours
+    # of the hour before from 1
+    years, months, days, day_hours = get_date_columns(
+        hours[kept] - np.timedelta64(1, 'h'), first_hour=1)
+
+    lines = []
+    for year, month, day, hour, value in zip(
+            years, months, days, day_hours, out_values):
+        date = f'{year}  {month}  {day}  {hour}'
+        padding = max(COOP_DATE_WIDTH - len(date), COOP_MIN_PADDING)
+        lines.append(f'{station_id}           {date}  0{" " * padding}'
+                     f'{value}     \n')
+
+    yield from get_blocks(lines)
+
+
+def write_blocks(filename, blocks):
+    """
+    Writes blocks of text to filename through one large buffer
+
+    The text goes to a temporary file first so a crash never leaves a
+    partial file behind
+    """
+    with storage.write(filename, buffering=WRITE_BUFFER_SIZE) as file:
+        for block in blocks:
+            file.write(block)
+
+
+def reflink(original_filename, out_filename):
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this system')
+    with open(original_filename, 'rb') as original_file, \
+            open(out_filename, 'wb') as out_file:
+        fcntl.ioctl(out_file.fileno(), FICLONE, original_file.fileno())
+
+
+CARRY_FORWARD_FUNCTIONS = {
+    'reflink': reflink,
+    'link': os.link,
+    'copy': shutil.copyfile,
+}
+
+
+def remove_if_exists(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def carry_forward(original_filename, out_filename, methods=None):
+    """
+    Makes out_filename the same as original_filename with the first of
+    methods (CARRY_FORWARD_METHODS by default) that works here
+    out_filename keeps the compression of original_filename
+    Returns the method used
+    """
+    if methods is None:
+        methods = CARRY_FORWARD_METHODS
+
+    original_path = storage.find(original_filename) or original_filename
+    out_path = storage.get_path(out_filename,
+                                storage.get_method(original_path))
+    temp_file = out_path + '.part'
+    for method in methods:
+        remove_if_exists(temp_file)
+        try:
+            CARRY_FORWARD_FUNCTIONS[method](original_path, temp_file)
+        except OSError:
+            # cross-device links, network shares without links and
+            # filesystems without reflinks all end up here
+            remove_if_exists(temp_file)
+            if method == methods[-1]:
+                raise
+            continue
+        os.replace(temp_file, out_path)
+        storage.remove_others(out_filename, out_path)
+        return method
+
+
+def append_file(in_filename, out_file):
+    """
+    Appends the bytes of in_filename to out_file, an unbuffered binary
+    file, with os.sendfile where it works and large reads otherwise
+    """
+    with open(in_filename, 'rb') as in_file:
+        size = os.fstat(in_file.fileno()).st_size
+        offset = 0
+        if hasattr(os, 'sendfile'):
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_file.fileno(), in_file.fileno(),
+                                       offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                # not every filesystem can sendfile to a file; nothing
+                # has been sent if the first call fails
+                if offset:
+                    raise
+
+        in_file.seek(offset)
+        shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+
+
+def concatenate(in_filenames, out_filename):
+    """
+    Writes the contents of in_filenames one after another to out_filename
+
+    Files stored the same way are joined as they are, without decoding;
+    otherwise they are decoded and out_filename is written as
+    storage.COMPRESSION says
+    """
+    in_paths = []
+    for in_filename in in_filenames:
+        in_path = storage.find(in_filename)
+        if in_path is None:
+            raise FileNotFoundError(in_filename)
+        in_paths.append(in_path)
+
+    methods = {storage.get_method(x) for x in in_paths}
+    if len(methods) > 1:
+        with storage.write(out_filename, 'wb') as out_file:
+            for in_path in in_paths:
+                with storage.open_path(in_path, 'rb',
+                                       storage.get_method(in_path)) as in_file:
+                    shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+        return
+
+    out_path = storage.get_path(out_filename, methods.pop())
+    temp_file = out_path + '.part'
+    with open(temp_file, 'wb', buffering=0) as out_file:
+        for in_path in in_paths:
+            append_file(in_path, out_file)
+    os.replace(temp_file, out_path)
+    storage.remove_others(out_filename, out_path)
+
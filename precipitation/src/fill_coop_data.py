@@ -1,8 +1,10 @@
+import argparse
 import csv
 import os
 
 import common
 import common_fill
+import storage
 
 
 MISSING_VALUE = '-9999'
@@ -23,8 +25,19 @@ def get_offset(item):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=common_fill.FILL_JOBS,
+                        help='number of processes filling stations')
+    args = parser.parse_args()
+
     coop_stations_to_use = common.get_stations('coop_stations_to_use.csv')
 
+    # stations in the same NLDAS grid cell share one request
+    common_fill.plan_nldas_fills(
+        [x for x in coop_stations_to_use if 25 < float(x.latitude) < 53 and
+         -125 < float(x.longitude) < -63])
+
+    tasks = []
     for station_ in coop_stations_to_use:
         offset = get_offset(station_)
 
@@ -32,23 +45,11 @@ if __name__ == '__main__':
             common.DATA_BASE_DIR, 'processed_coop_data',
             station_.station_id + '.dat')
 
-        assert os.path.exists(c_filename)
-
-        if 25 < float(station_.latitude) < 53 and -125 < float(station_.longitude) < -63:
-            fill_type = 'nldas'
-        else:
-            fill_type = 'gldas'
-
-        if fill_type == 'nldas':
-            try:
-                common_fill.nldas_routine(c_filename, station_, 'coop', MISSING_VALUE, offset)
-            except ValueError as e:
-                if 'water' in e.args[0]:
-                    common_fill.gldas_routine(c_filename, station_, 'coop', MISSING_VALUE, offset)
-                else:
-                    pass
-                    # probably just an error on NLDAS side; try again later
+        assert storage.exists(c_filename)
 
-        elif fill_type == 'gldas':
-            common_fill.gldas_routine(c_filename, station_, 'coop', MISSING_VALUE, offset)
+        tasks.append(common_fill.FillTask(
+            c_filename, station_, 'coop', MISSING_VALUE, offset))
 
+    # stations that fail are probably just an error on the NLDAS side;
+    # try again later
+    common_fill.fill_stations(tasks, args.jobs)
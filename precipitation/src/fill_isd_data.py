@@ -1,37 +1,39 @@
+import argparse
 import os
 
 import common
 import common_fill
+import storage
 
 
 MISSING_VALUE = '9999'
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=common_fill.FILL_JOBS,
+                        help='number of processes filling stations')
+    args = parser.parse_args()
+
     isd_stations_to_use = common.get_stations('isd_herewegoagain.csv') # TODO
 
+    # stations in the same NLDAS grid cell share one request
+    common_fill.plan_nldas_fills(
+        [x for x in isd_stations_to_use if 25 < float(x.latitude) < 53 and
+         -125 < float(x.longitude) < -63])
+
+    tasks = []
     for station_ in isd_stations_to_use:
         if station_.station_id == '99999913752':
             i_filename = os.path.join(
                 common.DATA_BASE_DIR, 'processed_isd_data',
                 station_.station_id + '.dat')
 
-            assert os.path.exists(i_filename)
-
-            if 25 < float(station_.latitude) < 53 and -125 < float(station_.longitude) < -63:
-                fill_type = 'nldas'
-            else:
-                fill_type = 'gldas'
-
-            if fill_type == 'nldas':
-                try:
-                    common_fill.nldas_routine(i_filename, station_, 'isd', MISSING_VALUE)
-                except ValueError as e:
-                    if 'water' in e.args[0]:
-                        common_fill.gldas_routine(i_filename, station_, 'isd', MISSING_VALUE)
-                    else:
-                        pass
-                        # probably just an error on NLDAS side; try again later
-
-            elif fill_type == 'gldas':
-                common_fill.gldas_routine(i_filename, station_, 'isd', MISSING_VALUE)
+            assert storage.exists(i_filename)
+
+            tasks.append(common_fill.FillTask(
+                i_filename, station_, 'isd', MISSING_VALUE))
+
+    # stations that fail are probably just an error on the NLDAS side;
+    # try again later
+    common_fill.fill_stations(tasks, args.jobs)
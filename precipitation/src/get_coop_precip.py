@@ -2,68 +2,190 @@ import csv
 import os
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
 import numpy as np
 import matplotlib.pyplot as plt
 
 
 import common
+import common_http
+import dat_file
+import storage
+
+
+# number of C-HPD files to download at the same time
+DOWNLOAD_WORKERS = 8
 
 
-def get_data(station):
+def get_data(station, session=None, previous_dir=None):
+    """
+    Downloads the C-HPD v2 file for station
+    If previous_dir has an earlier copy of it, only the data added since
+    is downloaded when the server allows (see common_http.download_appended)
+    The file is then stored as storage.COMPRESSION says
+    Returns how the file was downloaded
+    """
     base_url = common.CHPD_BASE_URL + 'access/'
 
     the_url = base_url + station.station_id + '.csv'
 
-    r = requests.get(the_url)
-
     out_file = os.path.join(common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_coop_data', station.station_id + '.csv')
-    with open(out_file, 'wb') as file:
-        file.write(r.content)
-
-
-def get_str_date(input_date):
-    return str(input_date.year) + '  ' + str(input_date.month) + '  ' + str(input_date.day) + '  '
 
+    previous_file = None
+    if previous_dir:
+        previous_file = storage.find(
+            os.path.join(previous_dir, station.station_id + '.csv'))
+
+    if previous_file is None:
+        common_http.download(the_url, out_file, session)
+        how = 'downloaded'
+    elif storage.get_method(previous_file) is None:
+        how = common_http.download_appended(the_url, out_file, previous_file,
+                                            session)
+    else:
+        # the server has the plain bytes to compare with
+        plain_file = out_file + '.previous'
+        try:
+            storage.copy(previous_file, plain_file, None)
+            how = common_http.download_appended(the_url, out_file,
+                                                plain_file, session)
+        finally:
+            dat_file.remove_if_exists(plain_file)
+
+    storage.convert(out_file, storage.COMPRESSION)
+    return how
+
+
+def get_all_data(stations, max_workers=DOWNLOAD_WORKERS, previous_dir=None):
+    """
+    Downloads the C-HPD v2 files for many stations at once
+
+    Up to max_workers requests are in flight at the same time and all of
+    them share one pool of keep-alive connections
+    previous_dir is passed on to get_data
+    Prints a summary of the downloads that failed
+    Returns a dict of station_id: error for the downloads that failed
+    """
+    session = common_http.make_session(max_workers)
+    failed = {}
+    methods = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_data, station, session,
+                                   previous_dir): station
+                   for station in stations}
+        for future in as_completed(futures):
+            station = futures[future]
+            try:
+                method = future.result()
+            except (common_http.TransientError, requests.RequestException,
+                    OSError) as e:
+                failed[station.station_id] = e
+            else:
+                methods[method] = methods.get(method, 0) + 1
+
+    print(f'downloaded {len(stations) - len(failed)} of {len(stations)} '
+          f'C-HPD files')
+    if previous_dir:
+        print(', '.join(f'{count} {method}'
+                        for method, count in sorted(methods.items())))
+    for station_id, error in failed.items():
+        print(f'failed -- {station_id}: {error}')
+
+    return failed
+
+
+# allowed measurement flags for hourly values
+MEASUREMENT_FLAGS = [' ', 'Z', 'g']
+
+
+@dataclass
+class ChpdData:
+    """
+    The contents of a C-HPD v2 csv file as arrays with one row per day
+
+    values is a days x 24 array in hundredths of an inch and missing is
+    True where the value is blank or -9999
+    Each flags array is days x 24 and last_records holds the flags of
+    the daily sum
+    """
+    dates: np.ndarray
+    values: np.ndarray
+    missing: np.ndarray
+    measurement_flags: np.ndarray
+    quality_flags: np.ndarray
+    primary_source_flags: np.ndarray
+    secondary_source_flags: np.ndarray
+    last_records: np.ndarray
+
+
+def read_chpd_file(filename):
+    """
+    Reads a C-HPD v2 csv file into a ChpdData
+
+    Handles both the current header ('"STATION","NAME","LATITUDE",...')
+    and the old header without NAME ('STATION,LATITUDE,LONGITUDE,...')
+    """
+    with storage.open_file(filename) as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = [row for row in reader if row]
 
-def get_line(k, v, station_id):
-    to_file = ''
-    if v == 0:
-        return to_file
+    if 'NAME' in header:
+        date_column = 5
     else:
-        if k.hour == 0:
-            temp_date = k - datetime.timedelta(days=1)
-            str_date = get_str_date(temp_date)
-            str_hour = '24'
-        else:
-            str_date = get_str_date(k)
-            str_hour = str(k.hour)
-
-        to_file += station_id + '           '
-        to_file += str_date + str_hour + '  0'
-        if len(str_date) + len(str_hour) == 13:
-            to_file += '     '
-        elif len(str_date) + len(str_hour) == 14:
-            to_file += '    '
-        elif len(str_date) + len(str_hour) == 15:
-            to_file += '   '
-        else:
-            to_file += '  '
-        if v == '-9999':
-            to_file += v
-        else:
-            to_file += f'{v/100:.3f}'
-        to_file += '     \n'
-
-        return to_file
+        # old format
+        date_column = 4
+
+    dates = np.array([row[date_column] for row in rows],
+                     dtype='datetime64[D]')
+    # everything after the date: 24 hours of value and four flags,
+    # then the daily sum and its four flags
+    block = np.array([row[6:] for row in rows]).reshape(len(rows), -1)
+
+    precip_values = block[:, 0:-5:5]
+    missing = (precip_values == ' ') | (precip_values == '-9999')
+    precip_values = np.where(missing, '0', precip_values)
+
+    try:
+        values = precip_values.astype(np.int64)
+    except ValueError:
+        # treat anything that is not a number as missing
+        numeric = np.char.isdigit(np.char.lstrip(precip_values, '-'))
+        for bad_row in np.unique(np.nonzero(~numeric)[0]):
+            print(precip_values[bad_row].tolist())
+        missing |= ~numeric
+        values = np.where(numeric, precip_values, '0').astype(np.int64)
+
+    return ChpdData(dates, values, missing,
+                    block[:, 1:-5:5], block[:, 2:-5:5], block[:, 3:-5:5],
+                    block[:, 4:-5:5], block[:, -4:])
+
+
+def check_measurement_flags(station, dates, measurement_flags):
+    """
+    Prints the days where the first unexpected measurement flag is 'A'
+    """
+    invalid = ~np.isin(measurement_flags, MEASUREMENT_FLAGS)
+    for row in np.nonzero(invalid.any(axis=1))[0]:
+        first_invalid = measurement_flags[row, np.argmax(invalid[row])]
+        if first_invalid == 'A':
+            print(station.station_id)
+            print(dates[row].astype(datetime.datetime).strftime(
+                '%Y-%m-%d %H:%M:%S'))
+            print(measurement_flags[row].tolist())
 
 
 def check_last_records(val):
-    partial = 0
-    assert val[-4] == ' '
-    if val[-3] != ' ':  # 'P' is for partial
-        partial += 1
-    assert val[-2] == ' '
-    assert val[-1] == 'C' or val[-1] == ' '
+    """
+    val has a row for each day with the last four flags of the daily sum
+    """
+    partial = np.count_nonzero(val[:, -3] != ' ')  # 'P' is for partial
+    assert np.all(val[:, -4] == ' ')
+    assert np.all(val[:, -2] == ' ')
+    assert np.all((val[:, -1] == 'C') | (val[:, -1] == ' '))
 
 
 def process_data(station, start_date, end_date, old=False):
@@ -72,82 +194,38 @@ def process_data(station, start_date, end_date, old=False):
     else:
         out_file = os.path.join(common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_coop_data', station.station_id + '.csv')
 
-    data = []
-    with open(out_file, 'r') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            data.append(row)
-
-    header = data.pop(0)
-
-    debug_year_precip = 0
-    missing = 0
-    partial = 0
-
-    to_file = ''
-    previous_date = False
-
-    date_dict = common.get_date_dict('-9999', start_date, end_date)
-    for item in data:
-        if 'NAME' in header:
-            raw_date = item[5].split('-')
-        else:
-            # old format below
-            # split_item = item.split(b',')
-            raw_date = item[4].split('-')
-
-        actual_date = datetime.datetime(int(raw_date[0]), int(raw_date[1]),
-                                        int(raw_date[2]))
-
-        if actual_date >= start_date and actual_date <= end_date:
+    chpd_data = read_chpd_file(out_file)
 
-            # old format below
-            # the_value = item.decode().strip('\n').split(',')
-            the_value = item
+    # the 24 values for end_date run past end_date itself,
+    # so leave room for them and trim if end_date has no data
+    series = common.HourlySeries.empty(
+        start_date, end_date + datetime.timedelta(hours=23))
 
-            measurement_flag_values = the_value[7:-5:5]
-            try:
-                for x in measurement_flag_values:
-                    assert x == ' ' or x == 'Z' or x == 'g'
-            except:
-                if x == 'A':
-                    print(station.station_id)
-                    print(actual_date)
-                    print(measurement_flag_values)
-            quality_flag_values = the_value[8:-5:5]
-            primary_source_flag_values = the_value[9:-5:5]
-            secondary_source_flag_values = the_value[10:-5:5]
-            precip_values = the_value[6:-5:5]
-
-            check_last_records(the_value)
-
-            try:
-                float_precip = [int(x) if x != ' ' and x != '-9999' else '-9999' for x in precip_values]
-            except ValueError:
-                print(precip_values)
+    in_range = ((chpd_data.dates >= np.datetime64(start_date, 'D')) &
+                (chpd_data.dates <= np.datetime64(end_date, 'D')))
+    dates = chpd_data.dates[in_range]
 
-            counter = 0
-            for value in float_precip:
-                date_dict[actual_date] = value
-                actual_date = actual_date + datetime.timedelta(hours=1)
+    check_measurement_flags(
+        station, dates, chpd_data.measurement_flags[in_range])
+    check_last_records(chpd_data.last_records[in_range])
 
-    for key, value in date_dict.items():
-        to_file += get_line(key, value, station.station_id)
+    # position of every hour of every day in the series
+    positions = (series.positions(dates)[:, np.newaxis] +
+                 np.arange(24)).ravel()
+    series.values[positions] = chpd_data.values[in_range].ravel()
+    series.missing[positions] = chpd_data.missing[in_range].ravel()
 
-    missing = 0
-    counter = 0
-    for key, value in date_dict.items():
-        if value == '-9999':
-            missing += 1
-        counter += 1
+    if np.datetime64(end_date, 'D') not in dates:
+        series = series[:end_date]
 
-    missing_percent = missing/counter*100
+    missing_percent = series.missing_count()/len(series)*100
 
     out_file = os.path.join(
         common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_processed_coop_data', station.station_id + '.dat')
 
-    with open(out_file, 'w') as file:
-        file.write(to_file)
+    dat_file.write_blocks(out_file, dat_file.format_coop(
+        station.station_id, series.hour_array(), series.values,
+        series.missing, '-9999'))
 
 
 
@@ -211,7 +289,7 @@ if __name__ == '__main__':
     coop_stations_to_use = [x for x in coop_stations_to_use if x.station_id == 'USW00093809']
 
     for item in coop_stations_to_use:
-        if not os.path.exists(os.path.join(
+        if not storage.exists(os.path.join(
                 common.DATA_BASE_DIR, 'raw_coop_data', item.station_id + '.csv')):
             get_data(item)
         process_data(item, item.start_date_to_use, item.end_date_to_use)
@@ -4,9 +4,9 @@ from dataclasses import asdict
 import datetime
 from decimal import Decimal
 
-import requests
-
 import common
+import common_http
+import station_registry
 
 
 def download_station_inventory_file():
@@ -21,13 +21,13 @@ def download_station_inventory_file():
     """
 
     station_inv_base_url = common.CHPD_BASE_URL + 'station-inventory/'
-    r = requests.get(station_inv_base_url)
+    r = common_http.get(station_inv_base_url)
     raw_text = r.content.decode()
     start_index = raw_text.find('HPD_')
     end_index = raw_text.find('.csv')
     filename = raw_text[start_index:end_index + 4]
 
-    r_file = requests.get(station_inv_base_url + filename)
+    r_file = common_http.get(station_inv_base_url + filename)
     assert r_file.status_code == 200
 
     station_inv_file = os.path.join(filename)
@@ -66,26 +66,24 @@ def make_decimal(num):
 
 
 def check_lat_lon(basins, coops):
-    basins_ids = [item.station_id for item in basins]
+    basins_registry = station_registry.StationRegistry(basins)
 
     mismatched = 0
     for item in coops:
-        if item.station_id[-6:] in basins_ids:
-            for x in basins:
-                if item.station_id[-6:] == x.station_id:
-                    try:
-                        i_lat = make_decimal(item.latitude)
-                        x_lat = make_decimal(x.latitude)
-                        i_lon = make_decimal(item.longitude)
-                        x_lon = make_decimal(x.longitude)
-                        assert i_lat == x_lat
-                        assert i_lon == x_lon
-                    except AssertionError:
-                        if (abs(i_lat - x_lat) <= Decimal(0.02) and
-                                abs(i_lon - x_lon) <= Decimal(0.02)):
-                            pass
-                        else:
-                            mismatched += 1
+        for x in basins_registry.matches(item.station_id[-6:]):
+            try:
+                i_lat = make_decimal(item.latitude)
+                x_lat = make_decimal(x.latitude)
+                i_lon = make_decimal(item.longitude)
+                x_lon = make_decimal(x.longitude)
+                assert i_lat == x_lat
+                assert i_lon == x_lon
+            except AssertionError:
+                if (abs(i_lat - x_lat) <= Decimal(0.02) and
+                        abs(i_lon - x_lon) <= Decimal(0.02)):
+                    pass
+                else:
+                    mismatched += 1
 
     print(f'mismatched: {mismatched}')
 
@@ -101,21 +99,21 @@ def assign_in_basins_attribute(basins, coops):
     break_with_basins attributes assigned
     """
 
-    basins_ids = [item.station_id for item in basins]
+    basins_registry = station_registry.StationRegistry(basins)
 
     for coop in coops:
-        if coop.station_id[-6:] in basins_ids:
+        matching_basins = basins_registry.matches(coop.station_id[-6:])
+        if matching_basins:
             coop.in_basins = True
-            for x in basins:
-                if coop.station_id[-6:] == x.station_id:
-                    if coop.start_date > x.end_date:
-                        coop.break_with_basins = True
-                        coop.start_date_to_use = common.get_start_date_to_use(coop)
-                        coop.end_date_to_use = common.get_end_date_to_use(coop)
-                    else:
-                        coop.start_date_to_use = (
-                            x.end_date + datetime.timedelta(days=1))
-                        coop.end_date_to_use = common.get_end_date_to_use(coop)
+            for x in matching_basins:
+                if coop.start_date > x.end_date:
+                    coop.break_with_basins = True
+                    coop.start_date_to_use = common.get_start_date_to_use(coop)
+                    coop.end_date_to_use = common.get_end_date_to_use(coop)
+                else:
+                    coop.start_date_to_use = (
+                        x.end_date + datetime.timedelta(days=1))
+                    coop.end_date_to_use = common.get_end_date_to_use(coop)
         else:
             coop.start_date_to_use = common.get_start_date_to_use(coop)
             coop.end_date_to_use = common.get_end_date_to_use(coop)
@@ -243,7 +241,7 @@ def check_stations_handled_properly(data):
 
 
 def get_basins_not_in_coop(basins, coops):
-    coop_ids = [item.station_id[-6:] for item in coops]
+    coop_registry = station_registry.StationRegistry(coops)
     counter = 0
 
     filename = os.path.join('src', 'basins_not_in_chpd.csv')
@@ -251,7 +249,7 @@ def get_basins_not_in_coop(basins, coops):
         writer = csv.writer(file)
         writer.writerow(asdict(basins[0]).keys())
         for item in basins:
-            if item.station_id not in coop_ids:
+            if item.station_id not in coop_registry.by_coop_suffix:
                 writer.writerow(asdict(item).values())
 
 
@@ -1,16 +1,18 @@
 
 import csv
 import datetime
+import functools
 import json
 import os
-import requests
-import statistics
-import time
 
-from dataclasses import asdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 
 import common
+import common_http
+import dat_file
 import get_isd_stations
+import storage
 
 
 #FLD LEN: 3
@@ -25,153 +27,265 @@ import get_isd_stations
 
 # "01,0000,9,5"
 
-def get_raw_data(isd_station_id, start_date, end_date, year=None):
-    start_date_string = f"{start_date.year:04d}-{start_date.month:02d}-{start_date.day:02d}"
-    end_date_string = f"{end_date.year:04d}-{end_date.month:02d}-{end_date.day:02d}"
+ISD_BASE_URL = 'https://www.ncei.noaa.gov/access/services/data/v1'
 
-    url = 'https://www.ncei.noaa.gov/access/services/data/v1?dataset=global-hourly&' + \
+# number of year-sized windows to request at the same time
+CHUNK_WORKERS = 4
+
+
+def get_url(isd_station_id, start_date_string, end_date_string):
+    return ISD_BASE_URL + '?dataset=global-hourly&' + \
         'dataTypes=AA1&stations=' + isd_station_id + '&startDate=' + start_date_string + \
         '&endDate=' + end_date_string + '&format=json&options=includeAttributes:false'
 
-    r = requests.get(url)
 
-    try:
-        stuff = json.loads(r.content.decode())
-    except json.decoder.JSONDecodeError:
-        stuff = json.loads(r.content.decode() + ']')
+def get_date_string(input_date):
+    return f"{input_date.year:04d}-{input_date.month:02d}-{input_date.day:02d}"
 
-    if year:
-        raw_filename = os.path.join(
-            common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_isd_data', isd_station_id + '.json')
-    else:
-        raw_filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', isd_station_id + '.json')
 
-    out_json = json.dumps(stuff)
-    with open(raw_filename, 'w') as file:
-        file.write(out_json)
+def get_year_windows(start_date, end_date):
+    """
+    Splits start_date to end_date into one window per calendar year
 
+    Returns a list of (start_date_string, end_date_string) in order
+    The first and last windows use the same date strings a single
+    request for the whole period would use
+    """
+    windows = []
+    for window_year in range(start_date.year, end_date.year + 1):
+        if window_year == start_date.year:
+            start_date_string = get_date_string(start_date)
+        else:
+            start_date_string = f'{window_year:04d}-01-01'
 
-def get_dates(station_id, year=None):
-    if year:
-        filename = os.path.join(
-            common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_isd_data', station_id + '.json')
-    else:
-        filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', station_id + '.json')
+        if window_year == end_date.year:
+            end_date_string = get_date_string(end_date)
+        else:
+            end_date_string = f'{window_year:04d}-12-31T23:59:59'
 
-    with open(filename, 'r') as file:
-        data = json.load(file)
+        windows.append((start_date_string, end_date_string))
 
-    first_date = None
-    last_date = None
+    return windows
 
-    for item in data:
+
+def get_raw_window(isd_station_id, window, session):
+    """
+    Requests a single window of global-hourly data
+
+    Truncated responses are not cached and are requested again
+    following common_http.RETRY_POLICY instead of being patched
+    Returns the decoded list of records
+    """
+    url = get_url(isd_station_id, window[0], window[1])
+
+    def check(content):
         try:
-            item['AA1']
-            split_aa1 = item['AA1'].split(',')
-            if split_aa1[0] == '01':
-                the_date = item['DATE'].split('-')
-                day_hour = the_date[2].split('T')
-                hour_minute = day_hour[1].split(':')
-                actual_date = datetime.datetime(int(the_date[0]), int(the_date[1]),
-                                                int(day_hour[0]), int(hour_minute[0]),
-                                                int(hour_minute[1]))
+            json.loads(content.decode())
+        except json.decoder.JSONDecodeError as e:
+            raise common_http.TransientError(
+                f'{isd_station_id} {window[0]} response was truncated') from e
+        return True
 
-                rounded_date = actual_date.replace(minute=0)
+    r = common_http.get(url, session, check=check)
+    r.raise_for_status()
+    return json.loads(r.content.decode())
 
-                if split_aa1[-1] == '5':
-                    if not first_date:
-                        first_date = rounded_date
-                    last_date = rounded_date
 
-        except KeyError:
-            pass
+def get_raw_data_chunked(isd_station_id, start_date, end_date,
+                         max_workers=CHUNK_WORKERS):
+    """
+    Requests one window per year, up to max_workers at a time
 
-    return (first_date, last_date)
+    Returns the records from every window merged in date order
+    """
+    windows = get_year_windows(start_date, end_date)
 
+    with common_http.make_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(
+            lambda window: get_raw_window(isd_station_id, window, session),
+            windows)
+        stuff = [record for chunk in chunks for record in chunk]
 
+    return stuff
 
 
-def read_raw(station, year=None):
+def get_raw_data(isd_station_id, start_date, end_date, year=None,
+                 chunked=False, max_workers=CHUNK_WORKERS):
+    if chunked:
+        stuff = get_raw_data_chunked(
+            isd_station_id, start_date, end_date, max_workers)
+    else:
+        url = get_url(isd_station_id, get_date_string(start_date),
+                      get_date_string(end_date))
 
-    station_id = station.station_id
+        r = common_http.get(url)
+
+        try:
+            stuff = json.loads(r.content.decode())
+        except json.decoder.JSONDecodeError:
+            stuff = json.loads(r.content.decode() + ']')
 
     if year:
-        filename = os.path.join(common.DATA_BASE_DIR, str(year) + '_raw_isd_data', station_id + '.json')
+        raw_filename = os.path.join(
+            common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_isd_data', isd_station_id + '.json')
     else:
-        filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', station_id + '.json')
+        raw_filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', isd_station_id + '.json')
+
+    out_json = json.dumps(stuff)
+    with storage.write(raw_filename) as file:
+        file.write(out_json)
+
 
-    with open(filename, 'r') as file:
+@dataclass
+class ParsedIsd:
+    """
+    Everything the later stages need from one raw ISD file
+
+    first_date and last_date are the first and last hours with a
+    record that passed all quality checks
+    hourly maps each of those hours to its accumulated precipitation
+    qc_counts maps each quality code to its number of AA1 records
+    """
+    first_date: datetime.datetime
+    last_date: datetime.datetime
+    hourly: dict
+    qc_counts: dict
+
+
+# number of parsed raw files to keep in memory
+PARSE_CACHE_SIZE = 8
+
+# (filename, mtime): (first_date, last_date) for every file parsed so far
+_dates_cache = {}
+
+
+def parse_raw(filename):
+    """
+    Parses a raw ISD file
+
+    The result is cached by filename and modification time so that
+    get_dates and read_raw only decode each file once
+    """
+    path = storage.find(filename) or filename
+    return _parse_raw(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_raw(filename, mtime):
+    with storage.open_path(filename, 'r',
+                           storage.get_method(filename)) as file:
         data = json.load(file)
 
-    date_dict = common.get_date_dict('9999', station.start_date_to_use, station.end_date_to_use)
+    first_date = None
+    last_date = None
+    hourly = {}
+    qc_counts = {}
 
     for item in data:
         try:
-            item['AA1']
             split_aa1 = item['AA1'].split(',')
             if split_aa1[0] == '01':
-                the_date = item['DATE'].split('-')
-                day_hour = the_date[2].split('T')
-                hour_minute = day_hour[1].split(':')
-                actual_date = datetime.datetime(int(the_date[0]), int(the_date[1]),
-                                                int(day_hour[0]), int(hour_minute[0]),
-                                                int(hour_minute[1]))
-
-                rounded_date = actual_date.replace(minute=0)
+                qc_code = split_aa1[-1]
+                qc_counts[qc_code] = qc_counts.get(qc_code, 0) + 1
 
                 # missing data typically are not in the JSON file at all
                 # so you can't just do it in the parsing
                 # (they say 99 is the value for missing data but I can't find any instances where that's true)
 
-                if split_aa1[-1] == '5': # only records with QA flag = 5 (passed all quality checks) per Glenn Fernandez
+                if qc_code == '5': # only records with QA flag = 5 (passed all quality checks) per Glenn Fernandez
+                    # DATE looks like 2020-01-01T00:53:00
+                    the_date = item['DATE']
+                    rounded_date = datetime.datetime(
+                        int(the_date[0:4]), int(the_date[5:7]),
+                        int(the_date[8:10]), int(the_date[11:13]))
+
+                    if not first_date:
+                        first_date = rounded_date
+                    last_date = rounded_date
+
                     precip_ = int(split_aa1[1])
                     if precip_ != 0:
                         precip = precip_/254.0
                     else:
                         precip = precip_ # keep 0 as int for later
 
-                    if date_dict[rounded_date] == '9999':
-                        date_dict[rounded_date] = precip
+                    if rounded_date in hourly:
+                        hourly[rounded_date] += precip
                     else:
-                        date_dict[rounded_date] += precip
+                        hourly[rounded_date] = precip
 
         except KeyError:
             pass
 
+    _dates_cache[(filename, mtime)] = (first_date, last_date)
+
+    return ParsedIsd(first_date, last_date, hourly, qc_counts)
+
+
+def get_dates(station_id, year=None):
     if year:
-        out_filename = os.path.join(common.DATA_BASE_DIR, str(year) + '_processed_isd_data', station_id + '.dat')
+        filename = os.path.join(
+            common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_raw_isd_data', station_id + '.json')
     else:
-        os.path.join(common.DATA_BASE_DIR, 'processed_isd_data', station_id + '.dat')
+        filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', station_id + '.json')
 
-    with open(out_filename, 'w') as file:
+    path = storage.find(filename) or filename
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _dates_cache:
+        parse_raw(filename)
 
-        to_file = ''
-        for key, value in date_dict.items():
-            if value != 0:
-                if value == '9999':
-                    out_value = value
-                else:
-                    out_value = str(round(value, 2))
+    return _dates_cache[key]
 
-                to_file += station_id + '\t' + str(key.year) + '\t' + \
-                           str(key.month) + '\t' + str(key.day) + '\t' + \
-                           str(key.hour) + '\t0\t' + out_value + '\n'
-        file.write(to_file)
+
+def read_raw(station, start_date=None, end_date=None, year=None):
+
+    station_id = station.station_id
+
+    if not start_date:
+        start_date = station.start_date_to_use
+    if not end_date:
+        end_date = station.end_date_to_use
+
+    if year:
+        filename = os.path.join(common.DATA_BASE_DIR, str(year) + '_raw_isd_data', station_id + '.json')
+    else:
+        filename = os.path.join(common.DATA_BASE_DIR, 'raw_isd_data', station_id + '.json')
+
+    parsed = parse_raw(filename)
+
+    series = common.HourlySeries.empty(start_date, end_date)
+
+    for rounded_date, precip in parsed.hourly.items():
+        if rounded_date in series:
+            series[rounded_date] = precip
+
+    if year:
+        out_filename = os.path.join(common.DATA_BASE_DIR, str(year) + '_processed_isd_data', station_id + '.dat')
+    else:
+        out_filename = os.path.join(common.DATA_BASE_DIR, 'processed_isd_data', station_id + '.dat')
+
+    dat_file.write_blocks(out_filename, dat_file.format_isd(
+        station_id, series.hour_array(), series.values, series.missing,
+        '9999'))
 
     return
 
 def get_percent_missing(split_isd_data, dict_start_date, dict_end_date):
-    date_dict = common.get_date_dict('0', dict_start_date, dict_end_date)
+    series = common.HourlySeries.empty(
+        dict_start_date, dict_end_date, missing=False)
 
+    # records outside the date range still count towards the total
+    outside = {}
     for x in split_isd_data:
-        date_dict[datetime.datetime(int(x[1]), int(x[2]), int(x[3]), int(x[4]))] = x[-1]
+        the_date = datetime.datetime(int(x[1]), int(x[2]), int(x[3]), int(x[4]))
+        if the_date in series:
+            series.missing[series.index(the_date)] = x[-1] == '9999'
+        else:
+            outside[the_date] = x[-1] == '9999'
 
-    missing = 0
-    counter = 0
-    for key, value in date_dict.items():
-        if value == '9999':
-            missing += 1
-        counter += 1
+    missing = series.missing_count() + sum(outside.values())
+    counter = len(series) + len(outside)
 
     return missing/counter*100
 
@@ -186,7 +300,7 @@ if __name__ == '__main__':
 
     data = []
     for item in isd_stations_to_use:
-        if not os.path.exists(os.path.join(
+        if not storage.exists(os.path.join(
                 common.DATA_BASE_DIR, 'raw_isd_data',
                 item.station_id + '.json')):
             print(item.station_id)
@@ -199,9 +313,9 @@ if __name__ == '__main__':
             if not real_start_date and not real_end_date:
                 # all zero
                 print(item.station_id)
-                with open(os.path.join(
+                with storage.write(os.path.join(
                     common.DATA_BASE_DIR, 'processed_isd_data',
-                    item.station_id + '.dat'), 'w') as file:
+                    item.station_id + '.dat')) as file:
                         file.write('')
             else:
                 # assign real_start_date and real_end_date to station
@@ -5,13 +5,23 @@ import os
 from dataclasses import asdict
 from dateutil.relativedelta import relativedelta
 
-import requests
-
 import common
+import common_http
+import isd_history
+import spatial_index
+import station_registry
 
 
 BASEDIR = os.path.join(os.getcwd(), 'src')
 
+ISD_HISTORY_URL = 'http://www1.ncdc.noaa.gov/pub/data/noaa/isd-history.txt'
+
+
+def get_history_file(year=None):
+    if year:
+        return os.path.join(BASEDIR, 'isd-history_' + str(year) + '.txt')
+    return os.path.join(BASEDIR, 'isd-history.txt')
+
 
 def download_file(year=None):
     """
@@ -21,75 +31,14 @@ def download_file(year=None):
     Confirms the status_code is 200
     Writes the station inventory file to the src/ directory
     """
-    if year:
-        out_file = os.path.join(BASEDIR, 'isd-history_' + str(year) + '.txt')
-    else:
-        out_file = os.path.join(BASEDIR, 'isd-history.txt')
-
-    r = requests.get('http://www1.ncdc.noaa.gov/pub/data/noaa/isd-history.txt')
+    r = common_http.get(ISD_HISTORY_URL)
 
     assert r.status_code == 200
 
-    with open(out_file, 'wb') as file:
+    with open(get_history_file(year), 'wb') as file:
         file.write(r.content)
 
 
-def read_file(year=None):
-    """
-    Reads the ISD station inventory file
-
-    Returns a list of tuples representing each entry in file
-    """
-    if year:
-        history_file = os.path.join(BASEDIR, 'isd-history_' + str(year) + '.txt')
-    else:
-        history_file = os.path.join(BASEDIR, 'isd-history.txt')
-
-    with open(history_file, 'r',
-              encoding='utf-8') as file:
-        data = file.readlines()
-
-    opening_lines = data[0:20]
-    header = data[20:21]
-
-    isd_data = []
-    for item in data[22:]:
-        # neither USAF or WBAN are unique identifiers
-        usaf = item[0:6]
-        wban = item[7:12]
-        station_name = item[13:42]
-        country = item[43:47]
-        state = item[48:50]
-        call = item[51:56]
-        lat = item[57:64]
-        lon = item[65:73]
-        elev_m = item[74:81]
-        begin = item[82:90]
-        end = item[91:].strip('\n')
-
-        local_tup = (usaf, wban, station_name, country, state, call, lat, lon,
-                     elev_m, begin, end)
-
-        isd_data.append(local_tup)
-
-    return isd_data
-
-
-def parse_isd_data(isd_data, year=None):
-    if year:
-        parsed_history_file = os.path.join(BASEDIR, 'parsed_isd_history_' + str(year) + '.csv')
-    else:
-        parsed_history_file = os.path.join(BASEDIR, 'parsed_isd_history.csv')
-
-    with open(parsed_history_file, 'w', encoding='utf-8') as file:
-        for item in isd_data:
-            if 'US' in item[3]:
-                string_to_write = item[0] + ',' + item[1] + ',' + item[2].rstrip() + ',' + \
-                    item[3].rstrip() + ',' + item[4] + ',' + item[5] + ',' + \
-                    item[6] + ',' + item[7]+ ',' + item[8] + ',' + \
-                    item[9] + ',' + item[10] + '\n'
-                file.write(string_to_write)
-
 def assign_in_basins_attribute(basins, isds, codes):
     """
     Assigns in_basins attribute
@@ -102,15 +51,14 @@ def assign_in_basins_attribute(basins, isds, codes):
     break_with_basins attributes assigned
     """
 
-    # basins_ids = [item.station_id for item in basins]
+    basins_registry = station_registry.StationRegistry(basins)
 
     for isd in isds:
         if isd.station_id[-5:] in codes:
             isd.in_basins = True
-            for x in basins:
-                if codes[isd.station_id[-5:]] == x.station_id:
-                    if isd.start_date > x.end_date:
-                        isd.break_with_basins = True
+            for x in basins_registry.matches(codes[isd.station_id[-5:]]):
+                if isd.start_date > x.end_date:
+                    isd.break_with_basins = True
 
     # Can't do dates here as we do for COOP here because some stations
     # have ID changes and will need to be combined
@@ -118,44 +66,45 @@ def assign_in_basins_attribute(basins, isds, codes):
     return isds
 
 
-def look_at_isd_files(wban_basins_mapping, basins_stations, year=None):
+def get_colocated_without_codes(isds, basins, codes,
+                                radius_km=spatial_index.COLOCATED_KM):
+    """
+    Returns (isd, basins_station, km) for the ISD stations whose WBAN is
+    not in codes that are within radius_km of a BASINS station
+    These may be BASINS stations that HOMR has no WBAN for
+    """
+    without_codes = [x for x in isds if x.station_id[-5:] not in codes]
+    return spatial_index.find_colocated(without_codes, basins, radius_km)
 
-    stations = []
 
+def write_colocated_without_codes(colocated, year=None):
     if year:
-        csv_filename = os.path.join(BASEDIR, 'parsed_isd_history_' + str(year) + '.csv')
+        filename = os.path.join(BASEDIR, 'isd_colocated_with_basins_' + str(year) + '.csv')
     else:
-        csv_filename = os.path.join(BASEDIR, 'parsed_isd_history.csv')
-
-    with open(csv_filename, 'r') as csv_file:
-        station_inv_reader = csv.reader(csv_file)
-        for row in station_inv_reader:
-            if row[4] != '  ': # state
-                stations.append(common.Station(row[0] + row[1], row[2],
-                                row[4], common.make_date(row[-2]),
-                                common.make_date(row[-1]), row[6], row[7],
-                                False, False, 'isd', None, None))
-
-    stations_first_pass = []
+        filename = os.path.join(BASEDIR, 'isd_colocated_with_basins.csv')
+
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['isd_id', 'isd_name', 'basins_id', 'basins_name',
+                         'km'])
+        for isd, basins_station, km in colocated:
+            writer.writerow([isd.station_id, isd.station_name,
+                             basins_station.station_id,
+                             basins_station.station_name, round(km, 2)])
+
+
+def look_at_isd_files(wban_basins_mapping, basins_stations, year=None):
+
+    history = isd_history.IsdHistory.load(get_history_file(year))
+
     # For C-HPD, we can easily determine which stations are in BASINS and apply
     # the four criteria at this point to determine which stations should be included.
     # Because determining if an ISD station is in BASINS requires the HOMR API,
-    # we rule out some stations first to minimize API calls.
-    for station in stations:
-        # All stations with 'BUOY' in the station_name can be eliminated
-        if 'BUOY' in station.station_name:
-            pass
-        # All stations that end before 1/1/1990 can be eliminated
-        elif station.end_date < datetime.datetime(1990, 1, 1):
-            pass
-        # All stations with less than one year of data can be eliminated
-        elif (station.end_date - station.start_date).days < 365:
-            pass
-        # Eliminate stations without lat/lon
-        elif station.latitude == '       ' or station.longitude == '       ':
-            pass
-        else:
-            stations_first_pass.append(station)
+    # we rule out some stations first to minimize API calls:
+    # buoys, stations that end before 1/1/1990, stations with less than
+    # one year of data and stations without lat/lon
+    stations_first_pass = history.get_stations(
+        history.first_pass(datetime.datetime(1990, 1, 1)))
 
     print('\n')
 
@@ -169,6 +118,14 @@ def look_at_isd_files(wban_basins_mapping, basins_stations, year=None):
     # First assign in_basins and break_with_basins
     isd_stations = assign_in_basins_attribute(basins, stations_first_pass, wban_basins_mapping)
 
+    # HOMR only matches stations it has a WBAN for; list the others
+    # that are at the same place as a BASINS station to check by hand
+    colocated = get_colocated_without_codes(
+        isd_stations, basins_stations, wban_basins_mapping)
+    write_colocated_without_codes(colocated, year)
+    print(f'{len(colocated)} ISD stations without a HOMR code are '
+          f'within {spatial_index.COLOCATED_KM} km of a BASINS station')
+
 
     # 2. If a station is in BASINS and there is no gap between the BASINS
     #    end date and the C-HPD v2 start date, use the station as long as
@@ -180,6 +137,8 @@ def look_at_isd_files(wban_basins_mapping, basins_stations, year=None):
     # approximately 10 years
     ten_years = datetime.timedelta(days=3650)
 
+    basins_registry = station_registry.StationRegistry(basins_stations)
+
     data = []
     for isd in isd_stations:
 
@@ -194,9 +153,8 @@ def look_at_isd_files(wban_basins_mapping, basins_stations, year=None):
             if not isd.break_with_basins:
                 # Rule 2
 
-                basins_station = [
-                    x for x in basins_stations if x.station_id ==
-                    wban_basins_mapping[isd.station_id[-5:]]][0]
+                basins_station = basins_registry.matches(
+                    wban_basins_mapping[isd.station_id[-5:]])[0]
 
                 if isd.end_date <= basins_station.end_date:
                     pass
@@ -268,8 +226,6 @@ if __name__ == '__main__':
     wban_basins = read_homr_codes()
 
     # download_file()
-    out_isd_data = read_file()
-    parse_isd_data(out_isd_data)
 
     # chpd_stations = common.get_stations('coop')
 
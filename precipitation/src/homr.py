@@ -1,9 +1,14 @@
-import csv
+import argparse
 import json
 import os
-import requests
-
 import common
+import common_http
+import get_isd_stations
+import isd_history
+import spatial_index
+
+
+HOMR_URL = 'https://www.ncdc.noaa.gov/homr/services/station/search'
 
 
 def get_specific_code(identifiers, id_type):
@@ -27,8 +32,8 @@ def get_specific_code(identifiers, id_type):
 
 
 def get_codes(station_id, id_type):
-    base_url = 'https://www.ncdc.noaa.gov/homr/services/station/search?qid=' + id_type + ':'
-    r = requests.get(base_url + station_id)
+    base_url = HOMR_URL + '?qid=' + id_type + ':'
+    r = common_http.get(base_url + station_id)
     try:
         assert r.status_code == 200
     except:
@@ -51,7 +56,7 @@ def get_codes(station_id, id_type):
 def quick_check(other_s_id):
     url = 'https://www.ncei.noaa.gov/access/services/data/v1?dataset=global-hourly&stations=' + other_s_id + '&startDate=1970-01-01&endDate=2019-12-31'
     print(url)
-    r = requests.get(url)
+    r = common_http.get(url)
     # print(r.status_code)
     # print(r.content)
 
@@ -59,31 +64,48 @@ def quick_check(other_s_id):
 # stationCollection -> stations -> 0 -> identifiers -> idType -> WBAN + WMO
 
 def read_basins_not_in_chpd():
-    stations = []
-    with open(os.path.join('src', 'basins_not_in_chpd.csv'), 'r') as file:
-        coop_reader = csv.reader(file)
-        header = next(coop_reader)
-        for row in coop_reader:
-            if row[6] == 'True':
-                in_basins = True
-            else:
-                in_basins = False
-            if row[7] == 'True':
-                break_with_basins = True
-            else:
-                break_with_basins = False
-            stations.append(common.Station(row[0], row[1], row[2],
-                            common.str_date_to_datetime(row[3]),
-                            common.str_date_to_datetime(row[4]), row[5], row[6],
-                            in_basins, break_with_basins))
-
-    return stations
+    # written from the Station fields by get_coop_stations.get_basins_not_in_coop
+    return common.get_stations(os.path.join('src', 'basins_not_in_chpd.csv'))
+
+
+def get_stations_near_isd(stations, isd_stations, radius_km):
+    """
+    Returns the IDs of stations that have an ISD station within radius_km
+    Only these can match an ISD station, as long as both inventories
+    have the station in about the same place
+    """
+    index = spatial_index.GridIndex(isd_stations)
+    return {station.station_id
+            for station, found in zip(stations,
+                                      index.within_all(stations, radius_km))
+            if found}
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--nearby-km', type=float, default=None,
+        help='only look up the BASINS stations with an ISD station in '
+             'the parsed ISD history within this many km; the rest are '
+             'written without codes (default: look up every station)')
+    args = parser.parse_args()
+
+    coop_not_in_chpd_stations = read_basins_not_in_chpd()
+    if args.nearby_km is not None:
+        to_look_up = get_stations_near_isd(
+            coop_not_in_chpd_stations,
+            isd_history.IsdHistory.load(
+                get_isd_stations.get_history_file()).get_stations(),
+            args.nearby_km)
+        print(f'Looking up {len(to_look_up)} of '
+              f'{len(coop_not_in_chpd_stations)} stations')
+
     with open('homr_codes.csv', 'w') as file:
-        coop_not_in_chpd_stations = read_basins_not_in_chpd()
         for station in coop_not_in_chpd_stations:
             s_id = station.station_id
+            if args.nearby_km is not None and s_id not in to_look_up:
+                file.write(s_id + ',None,None,\n')
+                continue
             print(s_id)
             out_code = get_codes(s_id, 'COOP')
             file.write(s_id)
@@ -94,4 +116,3 @@ if __name__ == '__main__':
                 file.write(str(x[1]))
                 file.write(',')
             file.write('\n')
-
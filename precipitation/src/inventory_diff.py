@@ -0,0 +1,143 @@
+"""
+Compares two snapshots of a station inventory
+
+The snapshots are joined on station ID once, and each station in the
+newer one is sorted by how the end of its period of record moved, so
+the size of an update is known before anything is downloaded
+
+Run this file with two C-HPD station inventory files (.csv) or two ISD
+histories (.txt) to print what changed between them
+"""
+import argparse
+from dataclasses import dataclass
+
+import get_coop_stations
+import isd_history
+import station_registry
+
+
+# how a station in the newer snapshot compares to the older one
+ADDED = 'added'
+EXTENDED = 'extended'
+UNCHANGED = 'unchanged'
+SHORTENED = 'shortened'
+STATUSES = (ADDED, EXTENDED, UNCHANGED, SHORTENED)
+
+# Station fields besides the end date that a newer snapshot can change
+METADATA_FIELDS = ('station_name', 'state', 'start_date', 'latitude',
+                   'longitude')
+
+
+def get_end_date(station):
+    return station.end_date
+
+
+@dataclass
+class InventoryDiff:
+    """
+    rows has (status, new_station, old_station) for every station in the
+    newer snapshot, in its order; old_station is None for added stations
+    removed has the stations of the older snapshot whose ID is not in
+    the newer one, and metadata_changed (new_station, old_station,
+    fields) for the stations with different METADATA_FIELDS
+    """
+    rows: list
+    removed: list
+    metadata_changed: list
+
+    def get(self, status):
+        """
+        Returns (new_station, old_station) for the stations with status
+        """
+        return [(new, old) for x, new, old in self.rows if x == status]
+
+    def counts(self):
+        counts = {x: 0 for x in STATUSES}
+        for status, new_station, old_station in self.rows:
+            counts[status] += 1
+        counts['removed'] = len(self.removed)
+        counts['metadata changed'] = len(self.metadata_changed)
+        return counts
+
+    def summary(self):
+        return ', '.join(f'{count} {name}'
+                         for name, count in self.counts().items())
+
+
+def get_status(new_station, old_station, get_end):
+    if old_station is None:
+        return ADDED
+    new_end = get_end(new_station)
+    old_end = get_end(old_station)
+    if new_end > old_end:
+        return EXTENDED
+    if new_end == old_end:
+        return UNCHANGED
+    return SHORTENED
+
+
+def get_changed_fields(new_station, old_station):
+    return [x for x in METADATA_FIELDS
+            if getattr(new_station, x) != getattr(old_station, x)]
+
+
+def diff_stations(old_stations, new_stations, get_end=get_end_date):
+    """
+    Returns the InventoryDiff from old_stations to new_stations
+
+    Each new station is compared to the first old station with its ID;
+    get_end returns the date compared for the period of record
+    """
+    old_registry = station_registry.StationRegistry(old_stations)
+    new_ids = {x.station_id for x in new_stations}
+
+    rows = []
+    metadata_changed = []
+    for new_station in new_stations:
+        old_station = old_registry.get(new_station.station_id)
+        rows.append((get_status(new_station, old_station, get_end),
+                     new_station, old_station))
+        if old_station is not None:
+            fields = get_changed_fields(new_station, old_station)
+            if fields:
+                metadata_changed.append((new_station, old_station, fields))
+
+    removed = [x for x in old_registry.stations if x.station_id not in new_ids]
+
+    return InventoryDiff(rows, removed, metadata_changed)
+
+
+def read_snapshot(filename):
+    """
+    Returns the stations in an ISD history (.txt) or a C-HPD station
+    inventory file
+    """
+    if filename.endswith('.txt'):
+        history = isd_history.IsdHistory.load(filename)
+        return history.get_stations(history.in_us())
+    return get_coop_stations.read_coop_file(filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old_file')
+    parser.add_argument('new_file')
+    parser.add_argument('--list', action='store_true',
+                        help='also list every station that changed')
+    args = parser.parse_args()
+
+    diff = diff_stations(read_snapshot(args.old_file),
+                         read_snapshot(args.new_file))
+    print(diff.summary())
+
+    if args.list:
+        for status in (ADDED, EXTENDED, SHORTENED):
+            for new_station, old_station in diff.get(status):
+                print(f'{status:<10}{new_station.station_id:<13}'
+                      f'{new_station.station_name}')
+        for old_station in diff.removed:
+            print(f'{"removed":<10}{old_station.station_id:<13}'
+                  f'{old_station.station_name}')
+        for new_station, old_station, fields in diff.metadata_changed:
+            print(f'{"changed":<10}{new_station.station_id:<13}'
+                  f'{", ".join(fields)}')
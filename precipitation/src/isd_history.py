@@ -0,0 +1,188 @@
+"""
+Reads the ISD station inventory file (isd-history.txt) into columns
+
+Every line of the file has the same fixed width fields, so the lines
+are laid out as one character array and each field is a slice of its
+columns. The stations are filtered with array masks and only the ones
+kept become common.Station
+
+The columns are cached next to the file in a .npz file with the hash
+of the file they came from, so the file is only parsed again once it
+changes
+"""
+import datetime
+import hashlib
+import os
+
+import numpy as np
+
+import common
+
+
+# lines before the first station
+HEADER_LINES = 22
+
+# (name, first character, character after the last) of each field;
+# USAF and WBAN are not unique on their own
+FIELDS = (
+    ('usaf', 0, 6),
+    ('wban', 7, 12),
+    ('station_name', 13, 42),
+    ('country', 43, 47),
+    ('state', 48, 50),
+    ('call', 51, 56),
+    ('latitude', 57, 64),
+    ('longitude', 65, 73),
+    ('elevation', 74, 81),
+    ('begin', 82, 90),
+    ('end', 91, 99),
+)
+
+# columns kept in IsdHistory and the cache
+COLUMNS = ('station_id', 'station_name', 'country', 'state', 'latitude',
+           'longitude', 'begin', 'end')
+
+# change this when the columns change so old caches are parsed again
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = '.npz'
+
+# stations with less data than this are never used
+MIN_DAYS = 365
+
+
+def get_dates(strings):
+    """
+    Returns a datetime64[D] array from an array of YYYYMMDD strings
+    """
+    numbers = strings.astype(np.int64)
+    years = numbers // 10000
+    months = numbers // 100 % 100
+    days = numbers % 100
+    return ((years - 1970).astype('datetime64[Y]').astype('datetime64[M]') +
+            (months - 1)).astype('datetime64[D]') + (days - 1)
+
+
+def get_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class IsdHistory:
+    """
+    The stations in an ISD station inventory file as columns
+
+    station_id is the USAF and WBAN, station_name and country have no
+    trailing spaces, state, latitude and longitude are the fields as
+    they are in the file (blank when unknown) and begin and end are
+    datetime64[D] arrays
+    """
+
+    def __init__(self, columns):
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.station_id)
+
+    @classmethod
+    def parse(cls, text):
+        lines = text.splitlines()[HEADER_LINES:]
+        width = max([FIELDS[-1][2]] + [len(x) for x in lines])
+
+        # one row of characters per line; short lines are padded with
+        # nulls, which numpy drops from the end of each field
+        characters = np.array(lines, dtype=f'U{width}').view('U1').reshape(
+            len(lines), width)
+
+        fields = {}
+        for name, start, end in FIELDS:
+            fields[name] = np.ascontiguousarray(
+                characters[:, start:end]).view(f'U{end - start}').ravel()
+
+        return cls({
+            'station_id': np.char.add(fields['usaf'], fields['wban']),
+            'station_name': np.char.rstrip(fields['station_name']),
+            'country': np.char.rstrip(fields['country']),
+            'state': fields['state'],
+            'latitude': fields['latitude'],
+            'longitude': fields['longitude'],
+            'begin': get_dates(fields['begin']),
+            'end': get_dates(fields['end']),
+        })
+
+    @classmethod
+    def load(cls, history_file):
+        """
+        Returns the IsdHistory for history_file, from the cache if it was
+        made from the same contents
+        """
+        with open(history_file, 'rb') as file:
+            content = file.read()
+        source_hash = get_hash(content)
+
+        cache_file = history_file + CACHE_SUFFIX
+        try:
+            with np.load(cache_file, allow_pickle=False) as cache:
+                if (str(cache['source_hash']) == source_hash and
+                        int(cache['version']) == CACHE_VERSION):
+                    return cls({name: cache[name] for name in COLUMNS})
+        except (OSError, KeyError, ValueError):
+            # no cache yet, or one from an older version
+            pass
+
+        history = cls.parse(content.decode('utf-8'))
+        history.save(cache_file, source_hash)
+        return history
+
+    def save(self, cache_file, source_hash):
+        temp_file = cache_file + '.part'
+        with open(temp_file, 'wb') as file:
+            np.savez(file, source_hash=source_hash, version=CACHE_VERSION,
+                     **{name: getattr(self, name) for name in COLUMNS})
+        os.replace(temp_file, cache_file)
+
+    def has_coordinates(self):
+        return ((np.char.strip(self.latitude) != '') &
+                (np.char.strip(self.longitude) != ''))
+
+    def in_us(self):
+        """
+        Returns a mask of the stations in the US and its territories
+        that have a state
+        """
+        return (np.char.find(self.country, 'US') >= 0) & (self.state != '  ')
+
+    def first_pass(self, earliest_end):
+        """
+        Returns a mask of the US stations that could be used: not buoys,
+        with data after earliest_end (a datetime), at least MIN_DAYS of
+        data and coordinates
+        """
+        return (self.in_us() &
+                (np.char.find(self.station_name, 'BUOY') < 0) &
+                (self.end >= np.datetime64(earliest_end, 'D')) &
+                (self.end - self.begin >= np.timedelta64(MIN_DAYS, 'D')) &
+                self.has_coordinates())
+
+    def get_stations(self, mask=None):
+        """
+        Returns an ISD common.Station for each station in mask (all of
+        them by default)
+        """
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        begins = self.begin[mask].tolist()
+        ends = self.end[mask].tolist()
+        return [common.Station(station_id, station_name, state,
+                               datetime.datetime.combine(
+                                   begin, datetime.time()),
+                               datetime.datetime.combine(end, datetime.time()),
+                               latitude, longitude, False, False, 'isd',
+                               None, None)
+                for station_id, station_name, state, begin, end, latitude,
+                longitude in zip(
+                    self.station_id[mask].tolist(),
+                    self.station_name[mask].tolist(),
+                    self.state[mask].tolist(), begins, ends,
+                    self.latitude[mask].tolist(),
+                    self.longitude[mask].tolist())]
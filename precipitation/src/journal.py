@@ -0,0 +1,367 @@
+"""
+Records each station's progress through the yearly update so that a
+rerun picks up every station where it stopped
+
+Stages can also record hashes of the files they read and write and of
+the settings they use; such a stage only runs again once one of those
+changes (see Journal.stale_reason)
+
+Run this file to print a summary of the journal for CURRENT_END_YEAR
+"""
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import traceback
+
+import common
+import storage
+
+
+# the stages each station goes through, in order; 'd4em' is the D4EM
+# file made from every station, recorded as network 'all'
+STAGES = ('download', 'process', 'fill', 'combine', 'd4em')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stages (
+    network TEXT NOT NULL,
+    station_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    result TEXT,
+    inputs TEXT,
+    outputs TEXT,
+    PRIMARY KEY (network, station_id, stage)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    hash TEXT
+);
+'''
+
+# stale_reason for a stage with no row in the journal
+NEVER_RUN = 'never run'
+
+# key for the hash of the settings in a stage's inputs
+PARAMS_KEY = 'params'
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_journal_file(year=None):
+    if year is None:
+        year = common.CURRENT_END_YEAR
+    return os.path.join(common.DATA_BASE_DIR, str(year) + '_journal.sqlite')
+
+
+class Journal:
+    """
+    SQLite table with one row per station and stage
+
+    status is 'started', 'done' or 'failed'; started and finished are
+    Unix times, error is the traceback of a failure and result is the
+    JSON return value of the stage
+    inputs and outputs are JSON {filename: hash} of the files the stage
+    read and wrote; inputs also has the hash of its settings
+    Starting a stage again clears the later stages for that station
+    that have no hashes, since their outputs depend on it; the ones
+    with hashes notice for themselves if their inputs changed
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connection_pid = None
+
+    def connect(self):
+        # every process opens its own connection
+        if self.connection is None or self.connection_pid != os.getpid():
+            self.connection = sqlite3.connect(
+                self.filename, timeout=60, check_same_thread=False,
+                isolation_level=None)
+            # the journal is on the network share, where WAL does not
+            # work; this also turns WAL off in journals that had it
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+            self.connection.executescript(SCHEMA)
+            # journals from before stages recorded hashes
+            columns = [x[1] for x in self.connection.execute(
+                'PRAGMA table_info(stages)')]
+            for column in ('inputs', 'outputs'):
+                if column not in columns:
+                    self.connection.execute(
+                        f'ALTER TABLE stages ADD COLUMN {column} TEXT')
+            self.connection_pid = os.getpid()
+        return self.connection
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connect().execute(sql, parameters).fetchall()
+
+    def get(self, network, station_id, stage):
+        """
+        Returns (status, result) for a stage or None if it never started
+        """
+        rows = self.execute(
+            'SELECT status, result FROM stages '
+            'WHERE network = ? AND station_id = ? AND stage = ?',
+            (network, station_id, stage))
+        if not rows:
+            return None
+        status, result = rows[0]
+        return status, json.loads(result) if result else None
+
+    def is_done(self, network, station_id, stage):
+        row = self.get(network, station_id, stage)
+        return row is not None and row[0] == 'done'
+
+    def begin(self, network, station_id, stage):
+        later_stages = STAGES[STAGES.index(stage) + 1:]
+        with self.lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    'DELETE FROM stages WHERE network = ? AND station_id = ? '
+                    f'AND stage IN ({",".join("?" * len(later_stages))}) '
+                    'AND inputs IS NULL',
+                    (network, station_id) + later_stages)
+                connection.execute(
+                    'INSERT OR REPLACE INTO stages '
+                    '(network, station_id, stage, status, started) '
+                    "VALUES (?, ?, ?, 'started', ?)",
+                    (network, station_id, stage,
+                     datetime.datetime.now().timestamp()))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def end(self, network, station_id, stage, result=None, inputs=None,
+            outputs=None):
+        """
+        Marks a stage done
+        inputs and outputs are the digests from get_digest, taken before
+        and after the stage ran
+        """
+        try:
+            result = json.dumps(result) if result is not None else None
+        except TypeError:
+            result = None
+        self.execute(
+            "UPDATE stages SET status = 'done', finished = ?, error = NULL, "
+            'result = ?, inputs = ?, outputs = ? '
+            'WHERE network = ? AND station_id = ? AND stage = ?',
+            (datetime.datetime.now().timestamp(), result,
+             json.dumps(inputs) if inputs is not None else None,
+             json.dumps(outputs) if outputs is not None else None,
+             network, station_id, stage))
+
+    def record(self, network, station_id, stage, result=None, inputs=(),
+               outputs=(), params=None):
+        """
+        Marks a stage done with the hashes its files and params have now
+        For stages run in bulk rather than through run, and for outputs
+        made before the journal was kept
+        """
+        if self.get(network, station_id, stage) is None:
+            self.begin(network, station_id, stage)
+        self.end(network, station_id, stage, result,
+                 self.get_digest(inputs, params), self.get_digest(outputs))
+
+    def fail(self, network, station_id, stage, error):
+        self.execute(
+            "UPDATE stages SET status = 'failed', finished = ?, error = ? "
+            'WHERE network = ? AND station_id = ? AND stage = ?',
+            (datetime.datetime.now().timestamp(), error, network,
+             station_id, stage))
+
+    def has_hashes(self, network, station_id, stage):
+        rows = self.execute(
+            'SELECT inputs FROM stages '
+            'WHERE network = ? AND station_id = ? AND stage = ?',
+            (network, station_id, stage))
+        return bool(rows) and rows[0][0] is not None
+
+    def hash_file(self, filename):
+        """
+        Returns the SHA-256 of filename, or None if it does not exist
+        Hashes are kept with the size and modification time of the file,
+        so a file is only read again after it changes
+        A compressed file has the hash of its contents, so compressing a
+        file does not change it (see storage.py)
+        """
+        stored_path = storage.find(filename)
+        try:
+            stat = os.stat(stored_path or filename)
+        except FileNotFoundError:
+            return None
+
+        path = os.path.abspath(stored_path)
+        rows = self.execute(
+            'SELECT size, mtime_ns, hash FROM files WHERE path = ?', (path,))
+        if rows and rows[0][0:2] == (stat.st_size, stat.st_mtime_ns):
+            return rows[0][2]
+
+        digest = hashlib.sha256()
+        with storage.open_path(stored_path, 'rb',
+                               storage.get_method(stored_path)) as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+
+        self.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                     (path, stat.st_size, stat.st_mtime_ns,
+                      digest.hexdigest()))
+        return digest.hexdigest()
+
+    def get_digest(self, files=(), params=None):
+        """
+        Returns {filename: hash} for files, plus the hash of params under
+        PARAMS_KEY if there are any
+        """
+        digest = {x: self.hash_file(x) for x in files}
+        if params is not None:
+            digest[PARAMS_KEY] = hashlib.sha256(json.dumps(
+                params, sort_keys=True, default=str).encode()).hexdigest()
+        return digest
+
+    def stale_reason(self, network, station_id, stage, inputs=(),
+                     outputs=(), params=None):
+        """
+        Returns why a stage has to run, or None if it is up to date
+
+        A stage is up to date once it is done, as long as its inputs and
+        params hash the same as when it ran and its outputs have not
+        changed since. Stages recorded without hashes are up to date
+        once they are done
+        """
+        rows = self.execute(
+            'SELECT status, inputs, outputs FROM stages '
+            'WHERE network = ? AND station_id = ? AND stage = ?',
+            (network, station_id, stage))
+        if not rows:
+            return NEVER_RUN
+
+        status, recorded_inputs, recorded_outputs = rows[0]
+        if status != 'done':
+            return status
+        if recorded_inputs is None:
+            return None
+
+        changed = get_changes(json.loads(recorded_inputs),
+                              self.get_digest(inputs, params))
+        if changed:
+            return 'changed ' + ', '.join(changed)
+
+        changed = get_changes(json.loads(recorded_outputs or '{}'),
+                              self.get_digest(outputs))
+        if changed:
+            return 'output changed ' + ', '.join(changed)
+
+        return None
+
+    def run(self, network, station_id, stage, function, *args, inputs=(),
+            outputs=(), params=None):
+        """
+        Calls function(*args) unless the stage is up to date for
+        station_id (see stale_reason)
+        inputs and outputs are the files function reads and writes and
+        params the settings that change what it writes; leave them out
+        to run function only until it is done once
+        Returns what function returned, or what it returned last time
+        if the stage was up to date
+        """
+        tracked = bool(inputs or outputs or params is not None)
+        if tracked:
+            reason = self.stale_reason(network, station_id, stage, inputs,
+                                       outputs, params)
+        else:
+            reason = None if self.is_done(network, station_id,
+                                          stage) else NEVER_RUN
+        if reason is None:
+            result = self.get(network, station_id, stage)[1]
+            if tracked and not self.has_hashes(network, station_id, stage):
+                # done before the stage recorded hashes; take them now
+                self.record(network, station_id, stage, result, inputs,
+                            outputs, params)
+            return result
+
+        self.begin(network, station_id, stage)
+        input_digest = self.get_digest(inputs, params) if tracked else None
+        try:
+            result = function(*args)
+        except BaseException:
+            self.fail(network, station_id, stage, traceback.format_exc())
+            raise
+        self.end(network, station_id, stage, result, input_digest,
+                 self.get_digest(outputs) if tracked else None)
+
+        return result
+
+    def summary(self):
+        """
+        Returns {(network, stage, status): number of stations}
+        """
+        rows = self.execute(
+            'SELECT network, stage, status, COUNT(*) FROM stages '
+            'GROUP BY network, stage, status')
+        return {tuple(row[0:3]): row[3] for row in rows}
+
+    def failures(self):
+        """
+        Returns (network, station_id, stage, error) for every stage that
+        failed last time it ran
+        """
+        return self.execute(
+            'SELECT network, station_id, stage, error FROM stages '
+            "WHERE status = 'failed' ORDER BY network, station_id")
+
+
+def get_changes(old, new):
+    """
+    Returns the names whose hashes differ between two digests, with
+    files in DATA_BASE_DIR relative to it
+    """
+    base_dir = os.path.abspath(common.DATA_BASE_DIR)
+    changes = []
+    for name in sorted(set(old) | set(new)):
+        if old.get(name) == new.get(name):
+            continue
+        if os.path.abspath(name).startswith(base_dir + os.sep):
+            name = os.path.relpath(name, base_dir)
+        changes.append(name)
+    return changes
+
+
+_journals = {}
+
+
+def get_journal(year=None):
+    """
+    Returns the Journal for year (CURRENT_END_YEAR by default) in
+    DATA_BASE_DIR
+    """
+    filename = get_journal_file(year)
+    if filename not in _journals:
+        _journals[filename] = Journal(filename)
+    return _journals[filename]
+
+
+if __name__ == '__main__':
+    journal = get_journal()
+
+    for (network, stage, status), count in sorted(
+            journal.summary().items(),
+            key=lambda x: (x[0][0], STAGES.index(x[0][1]), x[0][2])):
+        print(f'{network:<6}{stage:<10}{status:<9}{count:>8}')
+
+    for network, station_id, stage, error in journal.failures():
+        print(f'{network} {station_id} failed in {stage}:')
+        print(error)
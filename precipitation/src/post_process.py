@@ -3,6 +3,8 @@ import datetime
 
 import common
 import get_isd_stations
+import station_registry
+import storage
 
 
 DATA_BASE_DIR = os.path.join('O:\\', 'PRIV', 'CPHEA', 'PESD',
@@ -15,7 +17,7 @@ DATA_PROCESSING_DIR = os.path.join(
 
 def read_data(filename):
 
-    with open(filename, 'r') as file:
+    with storage.open_file(filename) as file:
         precip_data = file.readlines()
 
     return [item.split() for item in precip_data]
@@ -27,7 +29,7 @@ def calculate_annual_precip(station_id):
         'combined_data',
         station_id + '.dat')
 
-    if os.path.exists(filename):
+    if storage.exists(filename):
 
         data = read_data(filename)
 
@@ -74,21 +76,25 @@ if __name__ == '__main__':
     coop_stations = common.get_stations('coop_stations_to_use.csv')
     isd_stations = common.get_stations('isd_subset.csv')
     wban_basins_mapping = get_isd_stations.read_homr_codes()
+    registry = station_registry.StationRegistry(
+        coop_stations + isd_stations, original_basins_data,
+        wban_basins_mapping)
 
+    # the row for each ID, as either the first or the second station
     combined_isd = read_combined_isd()
-    combined_isd_ids = []
+    combined_isd_rows = {}
     for x in combined_isd:
-        combined_isd_ids.append(x[0])
-        combined_isd_ids.append(x[3])
+        combined_isd_rows.setdefault(x[0], x)
+        combined_isd_rows.setdefault(x[3], x)
 
     for item in d4em_data[1:]:
         split_item = item.split('\t')
         split_name = split_item[2].split('.')
         local_id = split_name[0][2:]
 
-        matching_station = [x for x in coop_stations if x.station_id == local_id]
+        matching_station = registry.matches(local_id, 'coop')
         if not matching_station:
-            matching_station = [x for x in isd_stations if x.station_id == local_id]
+            matching_station = registry.matches(local_id, 'isd')
 
         assert len(matching_station) <= 1
 
@@ -109,12 +115,8 @@ if __name__ == '__main__':
             else:
                 if matching_station:
                     if matching_station[0].in_basins and not matching_station[0].break_with_basins:
-                        if matching_station[0].network == 'coop':
-                            the_basins = [x for x in original_basins_data if
-                                matching_station[0].station_id[-6:] == x[0]]
-                        elif matching_station[0].network == 'isd':
-                            basins_id = wban_basins_mapping[matching_station[0].station_id[-5:]]
-                            the_basins = [x for x in original_basins_data if x[0] == basins_id]
+                        the_basins = registry.get_basins_rows(
+                            matching_station[0])
 
                         original_basins_start = the_basins[0][8].strip("'")
                         if original_basins_start[5:7] == '01':
@@ -137,8 +139,8 @@ if __name__ == '__main__':
                         if end_date.month != 12:
                             end_date = datetime.datetime(end_date.year - 1, 12, 31)
 
-                    elif local_id in combined_isd_ids:
-                        relevant_row = [y for y in combined_isd if local_id in y][0]
+                    elif local_id in combined_isd_rows:
+                        relevant_row = combined_isd_rows[local_id]
                         true_start_date = datetime.datetime(
                             int(relevant_row[1][0:4]), int(relevant_row[1][5:7]), int(relevant_row[1][8:10]))
                         end_date = datetime.datetime(
@@ -0,0 +1,326 @@
+"""
+Finds stations near a point, or near each other, without comparing
+every pair
+
+GridIndex hashes stations into cells of CELL_DEGREES latitude and
+longitude, so a query only measures the distance to the stations in
+the few cells around it
+"""
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# size of the grid cells; queries are fastest for a radius about this size
+CELL_DEGREES = 0.1
+
+# stations this close are taken to be at the same place, allowing for
+# the coordinates being rounded differently in each inventory
+COLOCATED_KM = 2.0
+
+# latitude past which every longitude cell is searched
+POLAR_LATITUDE = 89.0
+
+# width of the bands of latitude searched together
+BAND_DEGREES = 10
+
+# looking up one cell takes about as long as measuring the distance to
+# this many stations
+CELL_SEARCH_COST = 4
+
+# most distances measured at once when measuring to every station
+MAX_PAIRS = 1000000
+
+
+def get_distance_km(latitude, longitude, latitudes, longitudes):
+    """
+    Returns the great circle distance in km from one point to each of
+    arrays of points
+    """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def get_lat_lon(station):
+    """
+    Returns the latitude and longitude of station as floats, or None if
+    it has no coordinates
+    """
+    try:
+        return float(station.latitude), float(station.longitude)
+    except ValueError:
+        return None
+
+
+def empty_result():
+    return (np.array([], dtype=np.int64), np.array([], dtype=np.int64),
+            np.array([], dtype=float))
+
+
+class GridIndex:
+    """
+    Stations hashed by the grid cell of their latitude and longitude
+
+    stations is a list of objects with latitude and longitude strings,
+    such as common.Station; stations without coordinates are left out
+    Queries take arrays of points and look in every cell around all of
+    them at once; results come back as (station, km) sorted by distance
+    """
+
+    def __init__(self, stations, cell_degrees=CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.lon_cells = math.ceil(360 / cell_degrees)
+        self.stations = []
+        coordinates = []
+        for station in stations:
+            lat_lon = get_lat_lon(station)
+            if lat_lon is not None:
+                self.stations.append(station)
+                coordinates.append(lat_lon)
+
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 2)
+        self.latitudes = coordinates[:, 0]
+        self.longitudes = coordinates[:, 1]
+
+        # the stations in order of their cell, so the stations in a cell
+        # are the ones between two binary searches
+        keys = self.get_keys(self.get_lat_cells(self.latitudes),
+                             self.get_lon_cells(self.longitudes))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.stations)
+
+    def get_lat_cells(self, latitudes):
+        return np.floor((np.asarray(latitudes) + 90) /
+                        self.cell_degrees).astype(np.int64)
+
+    def get_lon_cells(self, longitudes):
+        return (np.floor((np.asarray(longitudes) + 180) /
+                         self.cell_degrees).astype(np.int64) %
+                self.lon_cells)
+
+    def get_keys(self, lat_cells, lon_cells):
+        return lat_cells * self.lon_cells + lon_cells % self.lon_cells
+
+    def get_offsets(self, latitudes, radius_km):
+        """
+        Returns the (latitude, longitude) cell offsets that hold every
+        station within radius_km of any of latitudes, or None if that
+        would be slower than measuring the distance to every station
+        """
+        lat_degrees = math.degrees(radius_km / EARTH_RADIUS_KM)
+        lat_span = math.ceil(lat_degrees / self.cell_degrees)
+
+        # a degree of longitude shrinks towards the poles
+        widest_latitude = min(float(np.max(np.abs(latitudes))) +
+                              lat_degrees, 90.0)
+        if widest_latitude >= POLAR_LATITUDE:
+            lon_span = self.lon_cells
+        else:
+            lon_span = math.ceil(
+                lat_degrees / math.cos(math.radians(widest_latitude)) /
+                self.cell_degrees)
+        lon_offsets = range(-min(lon_span, self.lon_cells // 2),
+                            min(lon_span, (self.lon_cells - 1) // 2) + 1)
+
+        if ((2 * lat_span + 1) * len(lon_offsets) * CELL_SEARCH_COST >
+                len(self.stations)):
+            return None
+        return [(x, y) for x in range(-lat_span, lat_span + 1)
+                for y in lon_offsets]
+
+    def query(self, latitudes, longitudes, radius_km):
+        """
+        Finds the stations within radius_km of each point
+        Returns arrays of the position of the point, the position of the
+        station in self.stations and the km between them, sorted by
+        point and then distance
+        """
+        latitudes = np.asarray(latitudes, dtype=float).ravel()
+        longitudes = np.asarray(longitudes, dtype=float).ravel()
+
+        # points nearer the equator need fewer longitude cells searched,
+        # so each band of latitude is searched on its own
+        bands = np.floor(np.abs(latitudes) / BAND_DEGREES).astype(np.int64)
+        parts = [empty_result()]
+        for band in np.unique(bands).tolist():
+            in_band = np.flatnonzero(bands == band)
+            points, stations, distances = self.find_close(
+                latitudes[in_band], longitudes[in_band], radius_km)
+            parts.append((in_band[points], stations, distances))
+
+        points, stations, distances = (np.concatenate(x) for x in zip(*parts))
+        order = np.lexsort((stations, distances, points))
+        return points[order], stations[order], distances[order]
+
+    def find_close(self, latitudes, longitudes, radius_km):
+        """
+        Like query, but not sorted
+        """
+        if not len(self.stations):
+            return empty_result()
+
+        offsets = self.get_offsets(latitudes, radius_km)
+        if offsets is None:
+            # measure the distance to every station instead, a chunk of
+            # points at a time
+            chunk = max(1, MAX_PAIRS // len(self.stations))
+            parts = [empty_result()]
+            for start in range(0, len(latitudes), chunk):
+                count = min(chunk, len(latitudes) - start)
+                parts.append(self.measure(
+                    latitudes, longitudes,
+                    np.repeat(np.arange(start, start + count),
+                              len(self.stations)),
+                    np.tile(np.arange(len(self.stations)), count),
+                    radius_km))
+            return tuple(np.concatenate(x) for x in zip(*parts))
+
+        lat_cells = self.get_lat_cells(latitudes)
+        lon_cells = self.get_lon_cells(longitudes)
+        point_parts = [np.array([], dtype=np.int64)]
+        station_parts = [np.array([], dtype=np.int64)]
+        for lat_offset, lon_offset in offsets:
+            keys = self.get_keys(lat_cells + lat_offset,
+                                 lon_cells + lon_offset)
+            starts = np.searchsorted(self.keys, keys, side='left')
+            counts = np.searchsorted(self.keys, keys, side='right') - starts
+            found = np.flatnonzero(counts)
+            counts = counts[found]
+            # the position in self.keys of every station in the cells
+            firsts = np.repeat(starts[found] - np.cumsum(counts) + counts,
+                               counts)
+            point_parts.append(np.repeat(found, counts))
+            station_parts.append(self.order[firsts + np.arange(counts.sum())])
+
+        return self.measure(latitudes, longitudes,
+                            np.concatenate(point_parts),
+                            np.concatenate(station_parts), radius_km)
+
+    def measure(self, latitudes, longitudes, points, stations, radius_km):
+        """
+        Returns the pairs of points and stations within radius_km of each
+        other, and the km between them
+        """
+        distances = get_distance_km(latitudes[points], longitudes[points],
+                                    self.latitudes[stations],
+                                    self.longitudes[stations])
+        close = distances <= radius_km
+        return points[close], stations[close], distances[close]
+
+    def group(self, point_count, points, stations, distances):
+        """
+        Returns a list with the (station, km) found for each point
+        """
+        results = [[] for _ in range(point_count)]
+        for point, station, km in zip(points.tolist(), stations.tolist(),
+                                      distances.tolist()):
+            results[point].append((self.stations[station], km))
+        return results
+
+    def within(self, latitude, longitude, radius_km):
+        """
+        Returns (station, km) for every station within radius_km of the
+        point
+        """
+        return self.group(1, *self.query([latitude], [longitude],
+                                         radius_km))[0]
+
+    def nearest(self, latitude, longitude, max_km=None):
+        """
+        Returns (station, km) for the station nearest the point, or None
+        if there is none within max_km (anywhere if max_km is None)
+        """
+        return self.nearest_points([latitude], [longitude], max_km)[0]
+
+    def nearest_points(self, latitudes, longitudes, max_km=None):
+        """
+        Returns nearest for each point, looking in a radius that grows
+        until every point has a station or it reaches max_km
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        results = [None] * len(latitudes)
+        left = np.arange(len(latitudes))
+        radius_km = EARTH_RADIUS_KM * math.radians(self.cell_degrees)
+        while len(left) and self.stations:
+            if max_km is not None:
+                radius_km = min(radius_km, max_km)
+            points, stations, distances = self.query(
+                latitudes[left], longitudes[left], radius_km)
+            # the first station for each point is the nearest
+            first = np.ones(len(points), dtype=bool)
+            first[1:] = points[1:] != points[:-1]
+            for point, station, km in zip(points[first].tolist(),
+                                          stations[first].tolist(),
+                                          distances[first].tolist()):
+                results[left[point]] = (self.stations[station], km)
+            left = np.delete(left, points[first])
+
+            if max_km is not None and radius_km >= max_km:
+                break
+            if radius_km >= math.pi * EARTH_RADIUS_KM:
+                break
+            radius_km *= 2
+
+        return results
+
+    def get_points(self, stations):
+        """
+        Returns the positions in stations of the ones with coordinates,
+        and their latitudes and longitudes
+        """
+        positions = []
+        coordinates = []
+        for position, station in enumerate(stations):
+            lat_lon = get_lat_lon(station)
+            if lat_lon is not None:
+                positions.append(position)
+                coordinates.append(lat_lon)
+        coordinates = np.array(coordinates, dtype=float).reshape(-1, 2)
+        return positions, coordinates[:, 0], coordinates[:, 1]
+
+    def within_all(self, stations, radius_km):
+        """
+        Returns the result of within for each of stations, or [] for a
+        station without coordinates
+        """
+        positions, latitudes, longitudes = self.get_points(stations)
+        found = self.group(len(positions), *self.query(
+            latitudes, longitudes, radius_km))
+        results = [[] for _ in stations]
+        for position, result in zip(positions, found):
+            results[position] = result
+        return results
+
+    def nearest_all(self, stations, max_km=None):
+        """
+        Returns the result of nearest for each of stations, or None for a
+        station without coordinates
+        """
+        positions, latitudes, longitudes = self.get_points(stations)
+        found = self.nearest_points(latitudes, longitudes, max_km)
+        results = [None] * len(stations)
+        for position, result in zip(positions, found):
+            results[position] = result
+        return results
+
+
+def find_colocated(stations, others, radius_km=COLOCATED_KM):
+    """
+    Returns (station, other, km) for every pair of one of stations and
+    one of others within radius_km of each other, nearest first for
+    each station
+    """
+    index = GridIndex(others)
+    return [(station, other, km)
+            for station, found in zip(stations,
+                                      index.within_all(stations, radius_km))
+            for other, km in found]
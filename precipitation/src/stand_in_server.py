@@ -0,0 +1,464 @@
+"""
+A local stand-in for the NCEI, HOMR and NASA LDAS web services
+
+Serves synthetic responses in the same formats as
+- C-HPD v2 station csv files, which take HEAD and Range requests like
+  a static file server, and the station-inventory directory
+- the v1 data service (global-hourly JSON)
+- NLDAS and GLDAS timeseries.cgi asc2 output, including the
+  "virtual rod" and water-cell errors
+- HOMR station search
+
+make_isd_history makes the ISD station history that the yearly update
+reads from its working directory.
+
+Every response is made up from the request, so the same request always
+gets the same response. Responses can be delayed by a fixed latency and
+a fraction of them can fail with a 503 to mimic the real servers.
+"""
+import datetime
+import functools
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+CHPD_PATH = '/data/coop-hourly-precipitation/v2/'
+ISD_PATH = '/access/services/data/v1'
+LDAS_PATH = '/daac-bin/access/timeseries.cgi'
+HOMR_PATH = '/homr/services/station/search'
+
+INVENTORY_FILENAME = 'HPD_v02r02_stationinv_c20220320.csv'
+
+# lines before the first station in isd-history.txt
+HISTORY_HEADER_LINES = 22
+
+CHPD_HEADER = ['STATION', 'NAME', 'LATITUDE', 'LONGITUDE', 'ELEVATION',
+               'DATE']
+for hour in range(24):
+    CHPD_HEADER += [f'HR{hour:02d}Val', f'HR{hour:02d}MF', f'HR{hour:02d}QF',
+                    f'HR{hour:02d}S1', f'HR{hour:02d}S2']
+CHPD_HEADER += ['DlySum', 'DlySumMF', 'DlySumQF', 'DlySumS1', 'DlySumS2']
+
+GLDAS_21_START_DATE = datetime.datetime(2000, 1, 1)
+
+
+def seeded_random(*parts):
+    """
+    Returns a random.Random that is the same for the same parts
+    """
+    seed = hashlib.sha256('|'.join(str(x) for x in parts).encode()).digest()
+    return random.Random(int.from_bytes(seed[:8], 'big'))
+
+
+def parse_date(date_string):
+    """
+    Parses the date formats used in requests: 2020-01-01,
+    2020-01-01T00, 2020-01-01T24 and 2020-12-31T23:59:59
+    """
+    day = datetime.datetime.strptime(date_string[0:10], '%Y-%m-%d')
+    if len(date_string) == 10:
+        return day
+    hour = int(date_string[11:13])
+    the_date = day + datetime.timedelta(hours=hour)
+    if len(date_string) > 13:
+        the_date += datetime.timedelta(minutes=int(date_string[14:16]),
+                                       seconds=int(date_string[17:19]))
+    return the_date
+
+
+class StandInConfig:
+    """
+    Settings for the stand-in server
+
+    stations is a list of common.Station objects served in the
+    station inventory; water_cells is a set of (x, y) NLDAS cells that
+    return the water-cell error and empty_gldas_cells a set of
+    (lat, lon) GLDAS cell centers that return only -9999
+    """
+
+    def __init__(self, stations=None, latency=0.0, failure_rate=0.0,
+                 virtual_rod_rate=0.0, water_cells=None,
+                 empty_gldas_cells=None,
+                 start_date=datetime.datetime(2015, 1, 1),
+                 end_date=datetime.datetime(2021, 12, 31)):
+        self.stations = stations or []
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.virtual_rod_rate = virtual_rod_rate
+        self.water_cells = water_cells or set()
+        self.empty_gldas_cells = empty_gldas_cells or set()
+        self.start_date = start_date
+        self.end_date = end_date
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.request_counts = {}
+
+    def count(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = (
+                self.request_counts.get(endpoint, 0) + 1)
+
+    def roll(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+
+def make_chpd_csv(station_id, start_date, end_date):
+    rng = seeded_random('chpd', station_id)
+    lines = [','.join(f'"{x}"' for x in CHPD_HEADER)]
+
+    day = start_date
+    while day <= end_date:
+        row = [station_id, 'STAND IN', '31.5702', '-85.2482', '139.0',
+               f'{day:%Y-%m-%d}']
+        daily = 0
+        # a station reports nothing for a few days now and then
+        day_missing = rng.random() < 0.02
+        for hour in range(24):
+            roll = rng.random()
+            if day_missing or roll < 0.01:
+                value = '-9999'
+            elif roll < 0.9:
+                value = '0'
+            else:
+                value = str(rng.randint(1, 120))
+                daily += int(value)
+            row += [value, ' ', ' ', 'Z', ' ']
+        row += [str(daily), ' ', ' ', ' ', 'C']
+        lines.append(','.join(f'"{x}"' for x in row))
+        day += datetime.timedelta(days=1)
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_inventory(stations):
+    lines = ['StnID,Lat,Lon,Elev,State/Province,Name,WMO_ID,'
+             'Sample_Interval (min),UTC_Offset,POR_Date_Range,PCT_POR_Good,'
+             'Last_Half_POR,PCT_Last_Half_Good,Last_Qtr_POR,'
+             'PCT_Last_Qtr_Good']
+    for station in stations:
+        por = f'{station.start_date:%Y%m%d}-{station.end_date:%Y%m%d}'
+        lines.append(f'{station.station_id},{station.latitude},'
+                     f'{station.longitude},100.0,{station.state},'
+                     f'{station.station_name},,15,-6,{por}, 90.0%,{por},'
+                     f' 90.0%,{por}, 90.0%')
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_isd_history(stations):
+    """
+    Returns an isd-history.txt listing stations, whose IDs are the USAF
+    and WBAN
+    """
+    lines = ['Integrated Surface Database Station History (stand-in)']
+    lines += [''] * (HISTORY_HEADER_LINES - 3)
+    lines += ['USAF   WBAN  STATION NAME                  CTRY ST CALL  '
+              'LAT     LON      ELEV(M) BEGIN    END', '']
+    for station in stations:
+        lines.append(
+            f'{station.station_id[:6]:6} {station.station_id[6:]:5} '
+            f'{station.station_name:29} {"US":4} {station.state:2} '
+            f'{"":5} {float(station.latitude):+07.3f} '
+            f'{float(station.longitude):+08.3f} {100.0:+07.1f} '
+            f'{station.start_date:%Y%m%d} {station.end_date:%Y%m%d}')
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_global_hourly(station_id, start_date, end_date):
+    records = []
+    the_date = start_date.replace(minute=53, second=0)
+    while the_date <= end_date:
+        # some hours have no report at all, some reports have no AA1 and
+        # some fail quality control: about 15% missing, well under the
+        # 25% the update allows
+        report = hourly_values('isd', station_id, the_date, 1,
+                               ['none'] * 2 + ['no AA1'] + ['5'] * 34 +
+                               ['1'] * 3)
+        precip = hourly_values('isd precip', station_id, the_date, 1,
+                               [0, 0, 0, 0, 0, 0, 3, 8, 25])
+        if report != 'none':
+            record = {'DATE': f'{the_date:%Y-%m-%dT%H:%M:%S}',
+                      'STATION': station_id}
+            if report != 'no AA1':
+                record['AA1'] = f'01,{precip:04d},9,{report}'
+            records.append(record)
+        the_date += datetime.timedelta(hours=1)
+
+    return json.dumps(records).encode()
+
+
+@functools.lru_cache(maxsize=4096)
+def day_values(name, location, day, count, choices):
+    rng = seeded_random(name, location, day)
+    return [rng.choice(choices) for _ in range(count)]
+
+
+def hourly_values(name, location, the_date, step, choices):
+    """
+    Returns the value for the_date; values depend only on the
+    location and the date so overlapping requests agree
+    """
+    values = day_values(name, location, the_date.date(), 24 // step,
+                        tuple(choices))
+    return values[the_date.hour // step]
+
+
+def make_nldas(x_str, y_str, start_date, end_date):
+    lines = ['prod_name=NLDAS_FORA0125_H.002',
+             'param_short_name=APCPsfc',
+             f'location=NLDAS:X{x_str}-Y{y_str}',
+             'Date&Time Data']
+    the_date = start_date
+    while the_date <= end_date:
+        value = hourly_values('nldas', (x_str, y_str), the_date, 1,
+                              [0.0, 0.0, 0.0, 0.0, 0.254, 1.27, 3.81])
+        lines.append(f'{the_date:%Y-%m-%d} {the_date:%H}Z {value:.4f}')
+        the_date += datetime.timedelta(hours=1)
+    lines.append('MEAN=0.0')
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def get_gldas_cell(point):
+    """
+    Returns the (lat, lon) cell center for GEOM:POINT(lon, lat)
+    """
+    lon, lat = (float(x) for x in point[point.index('(') + 1:-1].split(','))
+    return (math.floor(lat * 4) / 4 + 0.125, math.floor(lon * 4) / 4 + 0.125)
+
+
+def make_gldas(dataset, point, start_date, end_date, empty=False):
+    lines = [f'prod_name={dataset}', f'location={point}',
+             'Date&Time Data']
+    the_date = start_date
+    while the_date <= end_date:
+        if empty:
+            lines.append(f'{the_date:%Y-%m-%dT%H:%M:%S} -9999')
+            the_date += datetime.timedelta(hours=3)
+            continue
+        value = hourly_values('gldas', point, the_date, 3,
+                              [0.0, 0.0, 0.0, 0.0, 1.0e-5, 5.0e-5])
+        lines.append(f'{the_date:%Y-%m-%dT%H:%M:%S} {value:.6e}')
+        the_date += datetime.timedelta(hours=3)
+
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def make_homr(qid):
+    id_type, station_id = qid.split(':', 1)
+    digits = ''.join(x for x in station_id if x.isdigit())[-5:].zfill(5)
+    identifiers = [{'idType': 'WBAN', 'id': digits},
+                   {'idType': 'WMO', 'id': '7' + digits[1:]},
+                   {'idType': 'COOP', 'id': digits.zfill(6)}]
+    identifiers = [x for x in identifiers if x['idType'] != id_type]
+    identifiers.append({'idType': id_type, 'id': station_id})
+    data = {'stationCollection': {'stations': [
+        {'identifiers': identifiers}]}}
+
+    return json.dumps(data).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests using the StandInConfig on the server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        config = self.server.config
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in
+                 parse_qs(parts.query, keep_blank_values=True).items()}
+
+        if config.latency:
+            time.sleep(config.latency)
+
+        endpoint = self.get_endpoint(parts.path, query)
+        config.count(endpoint)
+
+        if endpoint is None:
+            self.send(404, b'not found', head=head)
+            return
+
+        if config.roll(config.failure_rate):
+            self.send(503, b'Service Unavailable', head=head)
+            return
+
+        try:
+            body = self.get_body(endpoint, parts.path, query)
+        except (KeyError, ValueError) as e:
+            self.send(400, f'bad request: {e}'.encode(), head=head)
+            return
+
+        if body is None:
+            self.send(404, b'not found', head=head)
+        elif endpoint == 'chpd':
+            self.send_file(body, head)
+        else:
+            self.send(200, body, head=head)
+
+    def get_endpoint(self, path, query):
+        if path.startswith(CHPD_PATH + 'access/'):
+            return 'chpd'
+        if path.startswith(CHPD_PATH + 'station-inventory/'):
+            return 'inventory'
+        if path == ISD_PATH:
+            return 'global-hourly'
+        if path == LDAS_PATH:
+            if query.get('variable', '').startswith('NLDAS'):
+                return 'nldas'
+            return 'gldas'
+        if path == HOMR_PATH:
+            return 'homr'
+        return None
+
+    def get_body(self, endpoint, path, query):
+        config = self.server.config
+
+        if endpoint == 'chpd':
+            station_id = path.rsplit('/', 1)[-1][:-len('.csv')]
+            return make_chpd_csv(station_id, config.start_date,
+                                 config.end_date)
+
+        if endpoint == 'inventory':
+            filename = path[len(CHPD_PATH + 'station-inventory/'):]
+            if not filename:
+                return (f'<html><body><a href="{INVENTORY_FILENAME}">'
+                        f'{INVENTORY_FILENAME}</a></body></html>').encode()
+            if filename == INVENTORY_FILENAME:
+                return make_inventory(config.stations)
+            return None
+
+        if endpoint == 'global-hourly':
+            end_date = parse_date(query['endDate'])
+            if len(query['endDate']) == 10:
+                end_date += datetime.timedelta(hours=23)
+            return make_global_hourly(query['stations'],
+                                      parse_date(query['startDate']),
+                                      end_date)
+
+        if endpoint == 'nldas':
+            location = query['location'].split(':')[1]
+            x_str, y_str = location[1:].split('-Y')
+            if (int(x_str), int(y_str)) in config.water_cells:
+                return (b'ERROR: the requested location is over water '
+                        b'and has no data\n')
+            if config.roll(config.virtual_rod_rate):
+                return b'ERROR: did not get a virtual rod successfully\n'
+            return make_nldas(x_str, y_str, parse_date(query['startDate']),
+                              parse_date(query['endDate']))
+
+        if endpoint == 'gldas':
+            if config.roll(config.virtual_rod_rate):
+                return b'ERROR: did not get a virtual rod successfully\n'
+            dataset = query['variable'].split(':')[1]
+            start_date = parse_date(query['startDate'])
+            end_date = parse_date(query['endDate'])
+            if dataset.endswith('2.0'):
+                end_date = min(end_date, GLDAS_21_START_DATE)
+            else:
+                start_date = max(start_date, GLDAS_21_START_DATE)
+            empty = (get_gldas_cell(query['location']) in
+                     config.empty_gldas_cells)
+            return make_gldas(dataset, query['location'], start_date,
+                              end_date, empty)
+
+        if endpoint == 'homr':
+            return make_homr(query['qid'])
+
+    def send_file(self, body, head=False):
+        """
+        Sends body like a static file server: with an ETag, and only
+        the bytes asked for by a Range header unless If-Range no longer
+        matches
+        """
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        ranges = self.headers.get('Range', '')
+        if_range = self.headers.get('If-Range')
+        if not ranges.startswith('bytes=') or (if_range and
+                                               if_range != etag):
+            self.send(200, body, headers, head)
+            return
+
+        first, last = ranges[len('bytes='):].split('-')
+        first = int(first)
+        last = min(int(last), len(body) - 1) if last else len(body) - 1
+        if first >= len(body) or first > last:
+            headers['Content-Range'] = f'bytes */{len(body)}'
+            self.send(416, b'', headers, head)
+            return
+
+        headers['Content-Range'] = f'bytes {first}-{last}/{len(body)}'
+        self.send(206, body[first:last + 1], headers, head)
+
+    def send(self, status_code, body, headers=None, head=False):
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+def start_server(config, port=0):
+    """
+    Starts the stand-in server on a background thread
+
+    Returns the server; its base URL is base_url(server)
+    Stop it with server.shutdown()
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.daemon_threads = True
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def base_url(server):
+    host, port = server.server_address[0:2]
+    return f'http://{host}:{port}'
+
+
+def point_at(server):
+    """
+    Points every module that makes requests at the stand-in server
+    """
+    import common
+    import common_fill
+    import get_isd
+    import homr
+
+    url = base_url(server)
+    common.CHPD_BASE_URL = url + CHPD_PATH
+    get_isd.ISD_BASE_URL = url + ISD_PATH
+    common_fill.NLDAS_URL = url + LDAS_PATH
+    common_fill.GLDAS_URL = url + LDAS_PATH
+    homr.HOMR_URL = url + HOMR_PATH
+
+
+if __name__ == '__main__':
+    server = start_server(StandInConfig(latency=0.05), port=8000)
+    print(f'serving on {base_url(server)}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,95 @@
+"""
+Station lists indexed by the IDs the scripts join them on
+
+COOP stations match BASINS by the last 6 digits of their ID and ISD
+stations by the BASINS ID that HOMR gives for their WBAN (the last 5
+digits of their ID); D4EM files have a row for each station, with its
+ID first
+Instead of scanning a list for every station, StationRegistry builds a
+dict for each kind of ID once
+"""
+
+
+def group_by(items, key):
+    """
+    Returns {key(item): [items with that key]}, in the order of items
+    """
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return groups
+
+
+def get_coop_suffix(station_id):
+    """
+    Returns the last 6 digits of a COOP ID, which is its BASINS ID
+    """
+    return station_id[-6:]
+
+
+def get_wban(station_id):
+    """
+    Returns the WBAN of an ISD ID, which is the USAF and then the WBAN
+    """
+    return station_id[-5:]
+
+
+class StationRegistry:
+    """
+    stations is a list of common.Station from any network, d4em_rows
+    the split rows of a D4EM PREC details file (common.read_basins_file
+    for BASINS) and wban_basins_mapping the BASINS ID for each WBAN
+    (get_isd_stations.read_homr_codes)
+
+    Lookups return every match in the order of the lists, so the first
+    one is the one a scan of the list would have found first
+    """
+
+    def __init__(self, stations=(), d4em_rows=(), wban_basins_mapping=None):
+        self.stations = list(stations)
+        self.by_id = group_by(self.stations, lambda x: x.station_id)
+        self.by_coop_suffix = group_by(
+            [x for x in self.stations if x.network == 'coop'],
+            lambda x: get_coop_suffix(x.station_id))
+        self.d4em_rows = group_by(d4em_rows, lambda x: x[0])
+        self.wban_basins_mapping = wban_basins_mapping or {}
+
+    def __contains__(self, station_id):
+        return station_id in self.by_id
+
+    def __len__(self):
+        return len(self.stations)
+
+    def matches(self, station_id, network=None):
+        """
+        Returns the stations with station_id, only those in network if
+        it is given
+        """
+        return [x for x in self.by_id.get(station_id, [])
+                if network is None or x.network == network]
+
+    def get(self, station_id, network=None):
+        """
+        Returns the first station with station_id, or None
+        """
+        matches = self.matches(station_id, network)
+        return matches[0] if matches else None
+
+    def get_d4em_rows(self, station_id):
+        return self.d4em_rows.get(station_id, [])
+
+    def get_basins_id(self, station):
+        """
+        Returns the BASINS ID of a COOP or ISD station, or None if an ISD
+        station's WBAN has no BASINS station
+        """
+        if station.network == 'coop':
+            return get_coop_suffix(station.station_id)
+        return self.wban_basins_mapping.get(get_wban(station.station_id))
+
+    def get_basins_rows(self, station):
+        """
+        Returns the rows of d4em_rows for the BASINS station that matches
+        a COOP or ISD station
+        """
+        return self.get_d4em_rows(self.get_basins_id(station))
@@ -0,0 +1,238 @@
+"""
+Reads and writes the station data files plain or compressed
+
+Every data file is named as if it were plain text (USC00010008.dat,
+72030954829.json) and stored under that name, or with .gz or .zst added
+when it is compressed. Readers ask for the plain name and get whichever
+form is there; writers write the form set by COMPRESSION and remove the
+others, so a file only ever has one form
+
+Compressed files made by joining others (dat_file.concatenate) are the
+compressed parts one after another, which gzip and zstd both read as
+one file
+
+Run this file to rewrite whole directories in one form, e.g.
+python storage.py gzip O:\\data\\2021_raw_coop_data O:\\data\\raw_coop_data
+"""
+import argparse
+import contextlib
+import errno
+import gzip
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    # only needed for .zst files
+    zstandard = None
+
+
+# how data files are written: None for plain text, 'gzip' or 'zstd'
+COMPRESSION = None
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# bytes copied at a time when converting a file
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# the data files rewritten by the command line
+DATA_EXTENSIONS = ('.dat', '.csv', '.json')
+
+# files converted at the same time by the command line
+CONVERT_WORKERS = 4
+
+
+def get_path(filename, method):
+    """
+    Returns where filename is stored when compressed with method
+    """
+    return filename + SUFFIXES.get(method, '')
+
+
+def get_method(path):
+    """
+    Returns the compression of the file at path, from its name
+    """
+    for method, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return method
+    return None
+
+
+def get_filename(path):
+    """
+    Returns the plain name of the file stored at path
+    """
+    return path[:len(path) - len(SUFFIXES.get(get_method(path), ''))]
+
+
+def get_paths(filename):
+    return [filename] + [filename + x for x in SUFFIXES.values()]
+
+
+def find(filename):
+    """
+    Returns the path filename is stored at, or None if it does not exist
+    """
+    for path in get_paths(filename):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def exists(filename):
+    return find(filename) is not None
+
+
+def open_compressed(path, mode, method):
+    """
+    Opens a compressed file as binary, in mode 'r' or 'w'
+    """
+    if method == 'gzip':
+        # no time in the header, so the same data always gives the same
+        # bytes
+        return gzip.GzipFile(path, mode + 'b', compresslevel=GZIP_LEVEL,
+                             mtime=0)
+
+    if zstandard is None:
+        raise ImportError('.zst files need the zstandard package')
+    file = open(path, mode + 'b')
+    if mode == 'r':
+        # joined files have a frame for each part
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            file, read_across_frames=True, closefd=True))
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(
+        file, closefd=True)
+
+
+def open_path(path, mode='r', method=None, buffering=-1):
+    """
+    Opens the file at path compressed with method like open, in mode
+    'r', 'rb', 'w' or 'wb'
+    """
+    if method is None:
+        return open(path, mode, buffering=buffering)
+
+    file = open_compressed(path, mode[0], method)
+    if 'b' in mode:
+        return file
+    return io.TextIOWrapper(file)
+
+
+def open_file(filename, mode='r'):
+    """
+    Opens whichever form of filename there is for reading
+    """
+    path = find(filename)
+    if path is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                filename)
+    return open_path(path, mode, get_method(path))
+
+
+def remove_others(filename, path):
+    """
+    Removes every form of filename but the one at path
+    """
+    for other in get_paths(filename):
+        if other != path:
+            try:
+                os.remove(other)
+            except FileNotFoundError:
+                pass
+
+
+@contextlib.contextmanager
+def write(filename, mode='w', buffering=-1):
+    """
+    Opens filename for writing in the form set by COMPRESSION
+
+    The data goes to a temporary file that replaces every form of
+    filename once it is closed without an error
+    """
+    method = COMPRESSION
+    path = get_path(filename, method)
+    temp_file = path + '.part'
+    try:
+        with open_path(temp_file, mode, method, buffering) as file:
+            yield file
+        os.replace(temp_file, path)
+        remove_others(filename, path)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def copy(path, out_path, method):
+    """
+    Writes the contents of the file at path to out_path, compressed with
+    method
+    """
+    with open_path(path, 'rb', get_method(path)) as in_file, \
+            open_path(out_path, 'wb', method) as out_file:
+        shutil.copyfileobj(in_file, out_file, COPY_BUFFER_SIZE)
+
+
+def convert(path, method):
+    """
+    Rewrites the file at path compressed with method, leaving no other
+    form of it behind
+    Returns the new path
+    """
+    filename = get_filename(path)
+    out_path = get_path(filename, method)
+    if out_path != path:
+        temp_file = out_path + '.part'
+        try:
+            copy(path, temp_file, method)
+            os.replace(temp_file, out_path)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    remove_others(filename, out_path)
+    return out_path
+
+
+def convert_directory(directory, method, workers=CONVERT_WORKERS):
+    """
+    Converts every data file in directory to method
+    Returns the number of files and their total bytes before and after
+    """
+    filenames = sorted({get_filename(entry.path)
+                        for entry in os.scandir(directory)
+                        if entry.is_file() and
+                        get_filename(entry.name).endswith(DATA_EXTENSIONS)})
+    paths = [find(x) for x in filenames]
+
+    def convert_one(path):
+        before = os.path.getsize(path)
+        return before, os.path.getsize(convert(path, method))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = list(executor.map(convert_one, paths))
+
+    return (len(sizes), sum(x[0] for x in sizes), sum(x[1] for x in sizes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rewrites the data files in directories compressed, '
+                    'or plain')
+    parser.add_argument('method', choices=['plain'] + list(SUFFIXES))
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('--workers', type=int, default=CONVERT_WORKERS,
+                        help='files converted at the same time')
+    args = parser.parse_args()
+
+    method = None if args.method == 'plain' else args.method
+    for directory in args.directories:
+        count, before, after = convert_directory(directory, method,
+                                                 args.workers)
+        print(f'{directory}: {count} files, {before / 1024 ** 2:.1f} MB '
+              f'-> {after / 1024 ** 2:.1f} MB')
@@ -1,15 +1,33 @@
-import csv
+import argparse
 import datetime
 import os
-import shutil
+import time
+
+import requests
 
 import common
+import common_http
+import dat_file
 import get_coop_stations
 import get_coop_precip
 import fill_coop_data
 import fill_isd_data
 import common_fill
 import get_isd
+import inventory_diff
+import isd_history
+import journal
+import station_registry
+import storage
+
+
+# number of times the stations that failed are retried at the end of a run
+RETRY_ROUNDS = 2
+
+# errors that mean a station can probably be finished later, including
+# the NLDAS errors other than water cells
+RETRYABLE_ERRORS = common_http.RETRYABLE_ERRORS + (
+    requests.RequestException, common_fill.LdasError)
 
 
 def make_directory(year, short_dir):
@@ -30,27 +48,30 @@ def make_directories(year):
 
 
 def get_updated_stations(initial_stations, new_stations):
-    initial_ids = [x.station_id for x in initial_stations]
-    updated_stations = []
-
     for new_station in new_stations:
         new_station.start_date_to_use = common.get_start_date_to_use(
             new_station)
         new_station.end_date_to_use = common.get_end_date_to_use(
             new_station)
 
-        if new_station.station_id in initial_ids:
-            matching_station = get_matching_station(
-                initial_stations, new_station)
-            matching_station.end_date_to_use = common.get_end_date_to_use(matching_station)
-            if new_station.end_date_to_use == matching_station.end_date_to_use:
+    diff = inventory_diff.diff_stations(
+        initial_stations, new_stations, common.get_end_date_to_use)
+    print(f'Station inventory changes: {diff.summary()}')
+
+    updated_stations = []
+    for status, new_station, matching_station in diff.rows:
+        if matching_station:
+            matching_station.end_date_to_use = common.get_end_date_to_use(
+                matching_station)
+
+        if status == inventory_diff.UNCHANGED:
+            updated_stations.append(new_station)
+        elif status == inventory_diff.EXTENDED:
+            # there may be new data
+            if (new_station.end_date_to_use.year >
+                    matching_station.end_date_to_use.year):
                 updated_stations.append(new_station)
-            else:
-                # there may be new data
-                if (new_station.end_date_to_use.year >
-                        matching_station.end_date_to_use.year):
-                    updated_stations.append(new_station)
-        else:
+        elif status == inventory_diff.ADDED:
             if new_station.start_date_to_use >= common.EARLIEST_START_DATE:
                 if (new_station.end_date_to_use - new_station.start_date_to_use
                         >= common.TEN_YEARS):
@@ -66,13 +87,10 @@ def combine_old_new(station, match, year, station_type):
         original_filename = os.path.join(
             common.DATA_BASE_DIR, 'combined_data', match.station_id + '.dat')
         try:
-            assert os.path.exists(original_filename)
+            assert storage.exists(original_filename)
         except AssertionError:
             return False
 
-        with open(original_filename, 'r') as original_file:
-            original_data = original_file.readlines()
-
     new_filename = os.path.join(
         common.DATA_BASE_DIR, str(year) + '_filled_' + station_type + '_data',
         station.station_id + '.dat')
@@ -80,15 +98,12 @@ def combine_old_new(station, match, year, station_type):
         common.DATA_BASE_DIR, str(year) + '_combined_data',
         station.station_id + '.dat')
 
-    assert os.path.exists(new_filename)
+    assert storage.exists(new_filename)
 
-    with open(new_filename, 'r') as new_file:
-        new_data = new_file.readlines()
-
-    with open(out_filename, 'w') as out_file:
-        if match:
-            out_file.writelines(original_data)
-        out_file.writelines(new_data)
+    if match:
+        dat_file.concatenate([original_filename, new_filename], out_filename)
+    else:
+        dat_file.carry_forward(new_filename, out_filename)
 
 
 def copy_unchanged(station, year):
@@ -98,8 +113,8 @@ def copy_unchanged(station, year):
         common.DATA_BASE_DIR, str(year) + '_combined_data',
         station.station_id + '.dat')
 
-    if os.path.exists(original_filename):
-        shutil.copyfile(original_filename, out_filename)
+    if storage.exists(original_filename):
+        dat_file.carry_forward(original_filename, out_filename)
 
 
 def copy_filled_combined(station, year):
@@ -111,7 +126,7 @@ def copy_filled_combined(station, year):
         common.DATA_BASE_DIR, str(year) + '_combined_data',
         station.station_id + '.dat')
 
-    shutil.copyfile(original_filename, out_filename)
+    dat_file.carry_forward(original_filename, out_filename)
 
 def make_updated_coops():
     new_station_inv_file = get_coop_stations.download_station_inventory_file()
@@ -122,138 +137,414 @@ def make_updated_coops():
     updated_coops = get_updated_stations(initial_coops, new_coops)
     return updated_coops
 
-def update_coop_data(updated_coops):
+def get_coops_to_update(initial_coops, updated_coops):
+    """
+    Returns (updated_coop, matching_station) for the COOP stations in
+    updated_coops to update; matching_station is None for new stations
+    """
+    initial_registry = station_registry.StationRegistry(initial_coops)
+    to_update = []
+    for updated_coop in updated_coops:
+        if 25 < float(updated_coop.latitude) < 53 and -125 < float(updated_coop.longitude) < -63:
+            continue
+
+        matching_station = initial_registry.get(updated_coop.station_id)
+
+        to_update.append((updated_coop, matching_station))
+
+    return to_update
+
+
+def is_unchanged(station, matching_station):
+    """
+    True if station has no data since matching_station
+    """
+    return bool(matching_station and
+                station.end_date_to_use == matching_station.end_date_to_use)
+
+
+def get_coops_with_new_data(initial_coops, updated_coops):
+    """
+    Returns (updated_coop, matching_station) for the COOP stations in
+    updated_coops that have new data
+    """
+    return [(x, matching_station) for x, matching_station in
+            get_coops_to_update(initial_coops, updated_coops)
+            if not is_unchanged(x, matching_station)]
+
+
+def update_coop_data(updated_coops,
+                     download_workers=get_coop_precip.DOWNLOAD_WORKERS,
+                     jobs=common_fill.FILL_JOBS, append_downloads=False):
+    """
+    append_downloads only downloads what was added to each C-HPD file
+    since the copy in the original raw data, where the server allows
+    """
     initial_coops = common.get_stations('coop_stations_to_use.csv')
+    update_journal = journal.get_journal()
+
+    # download everything up front; nearly all of the time spent
+    # downloading is waiting on the server
+    with_new_data = get_coops_with_new_data(initial_coops, updated_coops)
+    to_download = []
+    for station, matching_station in with_new_data:
+        # the same dependencies prepare_coop_station checks, so it does
+        # not download the station again
+        dependencies = get_dependencies('coop', 'download', station,
+                                        matching_station)
+        reason = update_journal.stale_reason(
+            'coop', station.station_id, 'download', **dependencies)
+        if (reason == journal.NEVER_RUN and
+                storage.exists(get_raw_filename(station, 'coop'))):
+            # downloaded before the journal was kept
+            update_journal.record('coop', station.station_id, 'download',
+                                  **dependencies)
+        elif reason is not None:
+            to_download.append((station, matching_station))
+    for station, matching_station in to_download:
+        update_journal.begin('coop', station.station_id, 'download')
+    previous_dir = None
+    if append_downloads:
+        previous_dir = os.path.join(common.DATA_BASE_DIR,
+                                    get_prefix(True) + 'raw_coop_data')
+    failed_downloads = get_coop_precip.get_all_data(
+        [x for x, matching_station in to_download], download_workers,
+        previous_dir)
+    for station, matching_station in to_download:
+        if station.station_id in failed_downloads:
+            update_journal.fail('coop', station.station_id, 'download',
+                                repr(failed_downloads[station.station_id]))
+        else:
+            update_journal.record(
+                'coop', station.station_id, 'download',
+                **get_dependencies('coop', 'download', station,
+                                   matching_station))
 
-    for updated_coop in updated_coops:
+    # stations to retry at the end
+    failed = []
+
+    # processed stations to fill
+    to_fill = []
+
+    for updated_coop, matching_station in get_coops_to_update(
+            initial_coops, updated_coops):
         print(updated_coop.station_id)
 
-        if 25 < float(updated_coop.latitude) < 53 and -125 < float(updated_coop.longitude) < -63:
-            continue
+        if is_unchanged(updated_coop, matching_station):
+            update_journal.run(
+                'coop', updated_coop.station_id, 'combine', copy_unchanged,
+                updated_coop, common.CURRENT_END_YEAR,
+                **get_dependencies('coop', 'combine', updated_coop,
+                                   matching_station))
 
-        try:
-            matching_station = get_matching_station(
-                initial_coops, updated_coop)
-        except IndexError:
-            matching_station = None
+        else:
+            if updated_coop.station_id in failed_downloads:
+                failed.append((updated_coop.station_id, update_coop_station,
+                               (updated_coop, matching_station)))
+                continue
+
+            if run_or_queue(failed, updated_coop.station_id,
+                            prepare_coop_station, update_coop_station,
+                            updated_coop, matching_station):
+                to_fill.append((updated_coop, matching_station))
+
+    # fill every station at once, spread across jobs processes
+    failed_fills = fill_in_parallel('coop', [
+        common_fill.FillTask(
+            get_processed_filename(x, 'coop'), x, 'coop',
+            fill_coop_data.MISSING_VALUE, fill_coop_data.get_offset(x),
+            gaps_only=True)
+        for x, matching_station in to_fill], jobs)
+
+    for updated_coop, matching_station in to_fill:
+        if updated_coop.station_id in failed_fills:
+            failed.append((updated_coop.station_id, update_coop_station,
+                           (updated_coop, matching_station)))
+        else:
+            run_or_queue(failed, updated_coop.station_id, update_coop_station,
+                         update_coop_station, updated_coop, matching_station)
+
+    retry_failed(failed)
+
+    return updated_coops
+
+
+def get_raw_filename(station, network, original=False):
+    """
+    Returns the raw data file for station this year, or from the
+    original data
+    """
+    extension = '.csv' if network == 'coop' else '.json'
+    return os.path.join(
+        common.DATA_BASE_DIR, get_prefix(original) + 'raw_' + network + '_data',
+        station.station_id + extension)
+
+
+def get_processed_filename(station, network, original=False):
+    return os.path.join(
+        common.DATA_BASE_DIR,
+        get_prefix(original) + 'processed_' + network + '_data',
+        station.station_id + '.dat')
+
+
+def get_filled_filename(station, network):
+    return os.path.join(
+        common.DATA_BASE_DIR,
+        str(common.CURRENT_END_YEAR) + '_filled_' + network + '_data',
+        station.station_id + '.dat')
 
-        if matching_station and updated_coop.end_date_to_use == matching_station.end_date_to_use:
-            copy_unchanged(updated_coop, common.CURRENT_END_YEAR)
 
+def get_combined_filename(station, original=False):
+    return os.path.join(
+        common.DATA_BASE_DIR, get_prefix(original) + 'combined_data',
+        station.station_id + '.dat')
+
+
+def get_prefix(original):
+    # the directories for the original data have no year
+    return '' if original else str(common.CURRENT_END_YEAR) + '_'
+
+
+def get_dependencies(network, stage, station, matching_station=None):
+    """
+    Returns the files one stage reads and writes for station and the
+    settings that change what it writes, as the inputs, outputs and
+    params keyword arguments of journal.Journal.run
+    """
+    previous = None
+    if matching_station:
+        previous = {'start_date': matching_station.start_date_to_use,
+                    'end_date': matching_station.end_date_to_use}
+
+    if stage == 'download':
+        # the whole record for COOP; ISD asks for the dates since
+        # previous, and the dates of the station change once processed
+        return {'inputs': [],
+                'outputs': [get_raw_filename(station, network)],
+                'params': {'previous': previous}}
+
+    if stage == 'process':
+        inputs = [get_raw_filename(station, network),
+                  get_raw_filename(station, network, original=True)]
+        if network == 'coop':
+            params = {'start_date': station.start_date_to_use,
+                      'end_date': station.end_date_to_use,
+                      'previous': previous}
         else:
-            if not os.path.exists(
-                             os.path.join(common.DATA_BASE_DIR,
-                             str(common.CURRENT_END_YEAR) + '_raw_coop_data',
-                             updated_coop.station_id + '.csv')):
-                get_coop_precip.get_data(updated_coop)
-            # NAME not in header
-            # header starts with b'STATION,LATITUDE,LONGITUDE....
-            try:
-                get_coop_precip.process_data(
-                    updated_coop, updated_coop.start_date_to_use,
-                    updated_coop.end_date_to_use,
-                    old=True)
-            except FileNotFoundError:
-                pass
+            # the dates come from the raw data
+            inputs.append(get_processed_filename(station, network,
+                                                 original=True))
+            params = {'previous': previous}
+        return {'inputs': inputs,
+                'outputs': [get_processed_filename(station, network)],
+                'params': params}
+
+    if stage == 'fill':
+        if network == 'coop':
+            params = {'missing_value': fill_coop_data.MISSING_VALUE,
+                      'offset': fill_coop_data.get_offset(station)}
+        else:
+            params = {'missing_value': fill_isd_data.MISSING_VALUE,
+                      'offset': False}
+        return {'inputs': [get_processed_filename(station, network)],
+                'outputs': [get_filled_filename(station, network)],
+                'params': params}
+
+    if stage == 'combine':
+        if is_unchanged(station, matching_station):
+            inputs = [get_combined_filename(station, original=True)]
+        elif matching_station:
+            inputs = [get_combined_filename(station, original=True),
+                      get_filled_filename(station, network)]
+        else:
+            inputs = [get_filled_filename(station, network)]
+        return {'inputs': inputs,
+                'outputs': [get_combined_filename(station)],
+                'params': {'previous': previous,
+                           'unchanged': is_unchanged(station,
+                                                     matching_station)}}
 
-            if matching_station:
-                # NAME in header
-                # header starts with b'"STATION","NAME","LATITUDE","LONGITUDE"...
-                get_coop_precip.process_data(
-                    updated_coop,
-                    matching_station.end_date_to_use + datetime.timedelta(days=1),
-                    updated_coop.end_date_to_use,
-                    old=False)
+    raise ValueError(f'no stage {stage}')
 
-            else:
-                # NAME in header
-                get_coop_precip.process_data(
-                    updated_coop, updated_coop.start_date_to_use,
-                    updated_coop.end_date_to_use,
-                    old=False)
 
-            offset = fill_coop_data.get_offset(updated_coop)
-            c_filename = os.path.join(
-                common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_processed_coop_data',
-                updated_coop.station_id + '.dat')
+def prepare_coop_station(updated_coop, matching_station):
+    """
+    Downloads and processes one COOP station, skipping the stages the
+    journal says are already done
+    """
+    update_journal = journal.get_journal()
+    station_id = updated_coop.station_id
 
-            assert os.path.exists(c_filename)
+    update_journal.run('coop', station_id, 'download', download_coop_station,
+                       updated_coop,
+                       **get_dependencies('coop', 'download', updated_coop,
+                                          matching_station))
+    update_journal.run('coop', station_id, 'process', process_coop_station,
+                       updated_coop, matching_station,
+                       **get_dependencies('coop', 'process', updated_coop,
+                                          matching_station))
 
-            if 25 < float(updated_coop.latitude) < 53 and -125 < float(updated_coop.longitude) < -63:
-                fill_type = 'nldas'
-            else:
-                fill_type = 'gldas'
 
-            if fill_type == 'nldas':
-                try:
-                    common_fill.nldas_routine(
-                        c_filename, updated_coop, 'coop',
-                        fill_coop_data.MISSING_VALUE, offset)
-                except ValueError as e:
-                    if 'water' in e.args[0]:
-                        common_fill.gldas_routine(
-                            c_filename, updated_coop, 'coop',
-                            fill_coop_data.MISSING_VALUE, offset)
-                    else:
-                        print(f'try again later -- {updated_coop.station_id}')
-                        pass
-                        # probably just an error on NLDAS side; try again later
+def update_coop_station(updated_coop, matching_station):
+    """
+    Downloads, processes, fills and combines one COOP station with new
+    data, skipping the stages the journal says are already done
+    """
+    update_journal = journal.get_journal()
+    station_id = updated_coop.station_id
 
-            elif fill_type == 'gldas':
-                print('gldas')
-                common_fill.gldas_routine(
-                    c_filename, updated_coop, 'coop',
-                    fill_coop_data.MISSING_VALUE, offset)
+    prepare_coop_station(updated_coop, matching_station)
+    update_journal.run('coop', station_id, 'fill', fill_coop_station,
+                       updated_coop,
+                       **get_dependencies('coop', 'fill', updated_coop))
+    update_journal.run('coop', station_id, 'combine', combine_old_new,
+                       updated_coop, matching_station,
+                       common.CURRENT_END_YEAR, 'coop',
+                       **get_dependencies('coop', 'combine', updated_coop,
+                                          matching_station))
 
-            combine_old_new(
-                updated_coop, matching_station, common.CURRENT_END_YEAR,
-                'coop')
 
-    return updated_coops
+def download_coop_station(updated_coop):
+    get_coop_precip.get_data(updated_coop)
 
-def get_matching_station(original, new):
-    match = [a for a in original if a.station_id == new.station_id][0]
-    return match
 
+def process_coop_station(updated_coop, matching_station):
+    # NAME not in header
+    # header starts with b'STATION,LATITUDE,LONGITUDE....
+    try:
+        get_coop_precip.process_data(
+            updated_coop, updated_coop.start_date_to_use,
+            updated_coop.end_date_to_use,
+            old=True)
+    except FileNotFoundError:
+        pass
+
+    if matching_station:
+        # NAME in header
+        # header starts with b'"STATION","NAME","LATITUDE","LONGITUDE"...
+        get_coop_precip.process_data(
+            updated_coop,
+            matching_station.end_date_to_use + datetime.timedelta(days=1),
+            updated_coop.end_date_to_use,
+            old=False)
 
-def get_some_isds():
-    initial_isds = common.get_stations('isd_subset.csv')
-    stations = []
-
-    csv_filename = os.path.join('parsed_isd_history_' + str(common.CURRENT_END_YEAR) + '.csv')
-    assert os.path.exists(csv_filename)
-
-    with open(csv_filename, 'r') as csv_file:
-        station_inv_reader = csv.reader(csv_file)
-        for row in station_inv_reader:
-            if row[4] != '  ': # state
-                stations.append(common.Station(row[0] + row[1], row[2],
-                                row[4], common.make_date(row[-2]),
-                                common.make_date(row[-1]), row[6], row[7],
-                                False, False, 'isd', None, None))
-
-
-    stations_first_pass = []
-    # Rule out some stations
-    for station in stations:
-        # All stations with 'BUOY' in the station_name can be eliminated
-        if 'BUOY' in station.station_name:
-            pass
-        # Now, all stations that end before 1/1/2010 can be eliminated
-        elif station.end_date < datetime.datetime(2010, 1, 1):
-            pass
-        # All stations with less than one year of data can be eliminated
-        elif (station.end_date - station.start_date).days < 365:
-            pass
-        # Eliminate stations without lat/lon
-        elif station.latitude == '       ' or station.longitude == '       ':
-            pass
+    else:
+        # NAME in header
+        get_coop_precip.process_data(
+            updated_coop, updated_coop.start_date_to_use,
+            updated_coop.end_date_to_use,
+            old=False)
+
+
+def fill_coop_station(updated_coop):
+    offset = fill_coop_data.get_offset(updated_coop)
+    c_filename = get_processed_filename(updated_coop, 'coop')
+
+    assert storage.exists(c_filename)
+
+    common_fill.fill_station(c_filename, updated_coop, 'coop',
+                             fill_coop_data.MISSING_VALUE, offset,
+                             gaps_only=True)
+
+
+def fill_in_parallel(network, tasks, jobs=common_fill.FILL_JOBS):
+    """
+    Runs the fill stage for a list of common_fill.FillTask across jobs
+    processes, skipping the stations whose fill the journal says is
+    up to date
+    Returns the station_ids whose fill failed
+    """
+    update_journal = journal.get_journal()
+
+    tasks = [x for x in tasks if update_journal.stale_reason(
+        network, x.station.station_id, 'fill',
+        **get_dependencies(network, 'fill', x.station))]
+    stations = {x.station.station_id: x.station for x in tasks}
+    for task in tasks:
+        update_journal.begin(network, task.station.station_id, 'fill')
+
+    # stations in the same NLDAS grid cell share one request; the dates
+    # of each station are the ones processed this run
+    common_fill.plan_nldas_fills(
+        [x for x in stations.values() if common_fill.in_nldas_domain(x)])
+
+    results = common_fill.fill_stations(tasks, jobs)
+
+    failed_fills = set()
+    for station_id, result in results.items():
+        if result.ok:
+            update_journal.record(
+                network, station_id, 'fill',
+                **get_dependencies(network, 'fill', stations[station_id]))
         else:
-            stations_first_pass.append(station)
+            update_journal.fail(network, station_id, 'fill', result.error)
+            failed_fills.add(station_id)
+
+    return failed_fills
+
+
+def run_or_queue(failed, station_id, function, retry_function, *args):
+    """
+    Calls function(*args)
+    If it fails with one of RETRYABLE_ERRORS, adds retry_function to
+    failed so it is retried at the end, and returns False
+    """
+    try:
+        function(*args)
+    except RETRYABLE_ERRORS as e:
+        print(f'{station_id} failed: {e}')
+        failed.append((station_id, retry_function, args))
+        return False
 
-    return stations_first_pass
+    return True
 
-def update_isd_data():
+
+def retry_failed(failed, rounds=RETRY_ROUNDS):
+    """
+    Runs the step that failed for each station again, backing off
+    between rounds following common_http.RETRY_POLICY
+    failed is a list of (station_id, function, args)
+    Returns the ones that still fail
+    """
+    for round_number in range(rounds):
+        if not failed:
+            break
+
+        print(f'retrying {len(failed)} stations')
+        # a server that is still down has its circuit breaker open
+        time.sleep(common_http.RETRY_POLICY.delay(round_number))
+
+        still_failed = []
+        for station_id, function, args in failed:
+            try:
+                function(*args)
+            except RETRYABLE_ERRORS as e:
+                print(f'{station_id} failed again: {e}')
+                still_failed.append((station_id, function, args))
+        failed = still_failed
+
+    for station_id, function, args in failed:
+        print(f'try again later -- {station_id}')
+
+    return failed
+
+
+def get_some_isds():
+    history = isd_history.IsdHistory.load(
+        'isd-history_' + str(common.CURRENT_END_YEAR) + '.txt')
+
+    # Rule out buoys, stations that end before 1/1/2010, stations with
+    # less than one year of data and stations without lat/lon
+    return history.get_stations(
+        history.first_pass(datetime.datetime(2010, 1, 1)))
+
+
+def get_isds_to_update():
+    """
+    Returns (station, matching_station) for the ISD stations to update;
+    matching_station is None for new stations and for stations with no
+    data last time
+    """
     initial_isds = common.get_stations('isd_subset.csv')
     stations_first_pass = get_some_isds()
     updated_isds = get_updated_stations(initial_isds, stations_first_pass)
@@ -276,122 +567,225 @@ def update_isd_data():
         split_item = item.strip('\n').split(',')
         percent_missing_dict[split_item[0]] = float(split_item[1])
 
-    sufficient_data = []
-
+    initial_registry = station_registry.StationRegistry(initial_isds)
+    to_update = []
     for y in updated_isds:
-        print(y.station_id)
-
         if y.station_id in percent_missing_dict:
             if percent_missing_dict[y.station_id] > 90.0:
-                print('too much missing')
+                print(f'{y.station_id} too much missing')
                 continue
-        try:
-            matching_station = get_matching_station(initial_isds, y)
-            if (matching_station.start_date_to_use ==
-                    matching_station.end_date_to_use):
-                matching_station = None
-        except IndexError:
+        matching_station = initial_registry.get(y.station_id)
+        if matching_station and (matching_station.start_date_to_use ==
+                                 matching_station.end_date_to_use):
             matching_station = None
 
-        if matching_station:
-            if matching_station and y.end_date_to_use == matching_station.end_date_to_use:
-                copy_unchanged(y, common.CURRENT_END_YEAR)
-                continue
+        to_update.append((y, matching_station))
+
+    return to_update
 
-            get_isd.get_raw_data(
-                y.station_id,
-                matching_station.end_date_to_use + datetime.timedelta(days=1),
-                y.end_date_to_use, year=common.CURRENT_END_YEAR)
-        else:
-            get_isd.get_raw_data(
-                y.station_id, y.start_date_to_use, y.end_date_to_use,
-                year=common.CURRENT_END_YEAR)
 
-        real_start_date, real_end_date = get_isd.get_dates(
-            y.station_id, year=common.CURRENT_END_YEAR)
+def update_isd_data(jobs=common_fill.FILL_JOBS):
+    to_update = get_isds_to_update()
 
-        if real_start_date == real_end_date:
-            print('continue')
+    sufficient_data = []
+    update_journal = journal.get_journal()
+
+    # stations to retry at the end
+    failed = []
+
+    # processed stations to fill
+    to_fill = []
+
+    def prepare_station(station, matching_station):
+        if prepare_isd_station(station, matching_station):
+            if station not in sufficient_data:
+                sufficient_data.append(station)
+            to_fill.append((station, matching_station))
+
+    def update_station(station, matching_station):
+        if prepare_isd_station(station, matching_station):
+            if station not in sufficient_data:
+                sufficient_data.append(station)
+            finish_isd_station(station, matching_station)
+
+    for y, matching_station in to_update:
+        print(y.station_id)
+
+        if is_unchanged(y, matching_station):
+            update_journal.run('isd', y.station_id, 'combine',
+                               copy_unchanged, y, common.CURRENT_END_YEAR,
+                               **get_dependencies('isd', 'combine', y,
+                                                  matching_station))
             continue
 
-        if real_start_date and real_end_date:
-            y.start_date_to_use = real_start_date
-            y.end_date_to_use = real_end_date
-            get_isd.read_raw(
-                y, real_start_date, real_end_date,
-                year=common.CURRENT_END_YEAR)
-            split_isd_data, isd_years = common.read_precip(
-                    real_start_date,
-                    real_end_date,
-                    os.path.join(
-                        common.DATA_BASE_DIR,
-                        str(common.CURRENT_END_YEAR) + '_processed_isd_data',
-                        y.station_id + '.dat'))
-
-            if matching_station:
-                original_start_date, original_end_date = get_isd.get_dates(
-                    y.station_id)
-                original_isd_data, original_isd_years = common.read_precip(
-                    original_start_date,
-                    original_end_date,
-                    os.path.join(
-                        common.DATA_BASE_DIR, 'processed_isd_data',
-                        y.station_id + '.dat'
-                    ))
+        run_or_queue(failed, y.station_id, prepare_station, update_station,
+                     y, matching_station)
 
-                combined_isd_data = original_isd_data + split_isd_data
+    # fill every station at once, spread across jobs processes
+    failed_fills = fill_in_parallel('isd', [
+        common_fill.FillTask(
+            get_processed_filename(x, 'isd'), x, 'isd',
+            fill_isd_data.MISSING_VALUE, gaps_only=True)
+        for x, matching_station in to_fill], jobs)
 
-                percent_missing = get_isd.get_percent_missing(
-                    combined_isd_data, matching_station.start_date_to_use,
-                    y.end_date_to_use)
+    for y, matching_station in to_fill:
+        if y.station_id in failed_fills:
+            failed.append((y.station_id, update_station, (y, matching_station)))
+        else:
+            run_or_queue(failed, y.station_id, finish_isd_station,
+                         update_station, y, matching_station)
 
-            else:
-                percent_missing = get_isd.get_percent_missing(
-                    split_isd_data, real_start_date, real_end_date)
-            print(percent_missing)
+    retry_failed(failed)
 
-            # use if < 25% missing data -- communication with Glenn Fernandez 1/5/2021
-            if percent_missing < 25.0:
-                sufficient_data.append(y)
+    return sufficient_data
 
-                i_filename = os.path.join(
-                        common.DATA_BASE_DIR, str(common.CURRENT_END_YEAR) + '_processed_isd_data',
-                        y.station_id + '.dat')
 
-                assert os.path.exists(i_filename)
+def prepare_isd_station(station, matching_station):
+    """
+    Downloads and processes one ISD station, skipping the stages the
+    journal says are already done
+    Returns True if the station has little enough missing data to use
+    """
+    update_journal = journal.get_journal()
 
-                if 25 < float(y.latitude) < 53 and -125 < float(y.longitude) < -63:
-                    fill_type = 'nldas'
-                else:
-                    fill_type = 'gldas'
+    update_journal.run('isd', station.station_id, 'download',
+                       download_isd_station, station, matching_station,
+                       **get_dependencies('isd', 'download', station,
+                                          matching_station))
+    summary = update_journal.run('isd', station.station_id, 'process',
+                                 process_isd_station, station,
+                                 matching_station,
+                                 **get_dependencies('isd', 'process', station,
+                                                    matching_station))
+    if summary is None:
+        return False
 
-                if fill_type == 'nldas':
-                    try:
-                        common_fill.nldas_routine(i_filename, y, 'isd', fill_isd_data.MISSING_VALUE, offset=False)
-                    except ValueError as e:
-                        if 'water' in e.args[0]:
-                            common_fill.gldas_routine(i_filename, y, 'isd', fill_isd_data.MISSING_VALUE, offset=False)
-                        else:
-                            print(f'try again later -- {y.station_id}')
-                            pass
-                            # probably just an error on NLDAS side; try again later
+    station.start_date_to_use = datetime.datetime.fromisoformat(
+        summary['start_date'])
+    station.end_date_to_use = datetime.datetime.fromisoformat(
+        summary['end_date'])
 
-                elif fill_type == 'gldas':
-                    common_fill.gldas_routine(i_filename, y, 'isd', fill_isd_data.MISSING_VALUE, offset=False)
+    return is_usable(summary)
 
-                if matching_station:
-                    old_file = combine_old_new(y, matching_station, common.CURRENT_END_YEAR, 'isd')
 
-                else:
-                    copy_filled_combined(y, common.CURRENT_END_YEAR)
+def is_usable(summary):
+    """
+    True if the summary process_isd_station returned is for a station
+    with little enough missing data to use
+    """
+    # use if < 25% missing data -- communication with Glenn Fernandez 1/5/2021
+    return summary is not None and summary['percent_missing'] < 25.0
 
-    return sufficient_data
+
+def download_isd_station(station, matching_station):
+    """
+    Downloads the data that is new since matching_station
+    """
+    if matching_station:
+        get_isd.get_raw_data(
+            station.station_id,
+            matching_station.end_date_to_use + datetime.timedelta(days=1),
+            station.end_date_to_use, year=common.CURRENT_END_YEAR,
+            chunked=True)
+    else:
+        get_isd.get_raw_data(
+            station.station_id, station.start_date_to_use,
+            station.end_date_to_use, year=common.CURRENT_END_YEAR,
+            chunked=True)
 
 
+def process_isd_station(station, matching_station):
+    """
+    Processes the raw data and works out the percent missing
+    Returns the dates of the data and the percent missing, or None if
+    there is no data
+    """
+    real_start_date, real_end_date = get_isd.get_dates(
+        station.station_id, year=common.CURRENT_END_YEAR)
+
+    if real_start_date == real_end_date:
+        print('continue')
+        return None
+
+    if not (real_start_date and real_end_date):
+        return None
+
+    station.start_date_to_use = real_start_date
+    station.end_date_to_use = real_end_date
+    get_isd.read_raw(
+        station, real_start_date, real_end_date,
+        year=common.CURRENT_END_YEAR)
+    split_isd_data, isd_years = common.read_precip(
+            real_start_date,
+            real_end_date,
+            os.path.join(
+                common.DATA_BASE_DIR,
+                str(common.CURRENT_END_YEAR) + '_processed_isd_data',
+                station.station_id + '.dat'))
+
+    if matching_station:
+        original_start_date, original_end_date = get_isd.get_dates(
+            station.station_id)
+        original_isd_data, original_isd_years = common.read_precip(
+            original_start_date,
+            original_end_date,
+            os.path.join(
+                common.DATA_BASE_DIR, 'processed_isd_data',
+                station.station_id + '.dat'
+            ))
+
+        combined_isd_data = original_isd_data + split_isd_data
+
+        percent_missing = get_isd.get_percent_missing(
+            combined_isd_data, matching_station.start_date_to_use,
+            station.end_date_to_use)
+
+    else:
+        percent_missing = get_isd.get_percent_missing(
+            split_isd_data, real_start_date, real_end_date)
+    print(percent_missing)
+
+    return {'start_date': real_start_date.isoformat(),
+            'end_date': real_end_date.isoformat(),
+            'percent_missing': percent_missing}
+
+
+def finish_isd_station(station, matching_station):
+    """
+    Fills one ISD station and combines it with the previous data,
+    skipping the stages the journal says are already done
+    """
+    update_journal = journal.get_journal()
+
+    update_journal.run('isd', station.station_id, 'fill', fill_isd_station,
+                       station, **get_dependencies('isd', 'fill', station))
+
+    if matching_station:
+        update_journal.run('isd', station.station_id, 'combine',
+                           combine_old_new, station, matching_station,
+                           common.CURRENT_END_YEAR, 'isd',
+                           **get_dependencies('isd', 'combine', station,
+                                              matching_station))
+
+    else:
+        update_journal.run('isd', station.station_id, 'combine',
+                           copy_filled_combined, station,
+                           common.CURRENT_END_YEAR,
+                           **get_dependencies('isd', 'combine', station))
+
+
+def fill_isd_station(station):
+    i_filename = get_processed_filename(station, 'isd')
+
+    assert storage.exists(i_filename)
+
+    common_fill.fill_station(i_filename, station, 'isd',
+                             fill_isd_data.MISSING_VALUE, gaps_only=True)
+
 
 def read_data(filename):
 
-    with open(filename, 'r') as file:
+    with storage.open_file(filename) as file:
         precip_data = file.readlines()
 
     return [item.split() for item in precip_data]
@@ -404,7 +798,7 @@ def calculate_annual_precip(station_id, year):
         str(year) + '_combined_data',
         station_id + '.dat')
 
-    if os.path.exists(filename):
+    if storage.exists(filename):
 
         data = read_data(filename)
 
@@ -428,12 +822,102 @@ def format_date(date):
     return f"'{date.year}/{date.month:02d}/{date.day:02d}'"
 
 
+def get_d4em_filename(year):
+    return str(year) + '_D4EM_PREC_updated.txt'
+
+
+def get_d4em_dependencies(updated_coops, updated_isds):
+    """
+    Returns the files process reads and writes and the stations it uses,
+    as the inputs, outputs and params keyword arguments of
+    journal.Journal.run
+    """
+    inputs = [get_d4em_filename(common.CURRENT_END_YEAR - 1)]
+    for station in updated_coops + updated_isds:
+        inputs.append(get_combined_filename(station))
+        if station.network == 'isd':
+            inputs += [get_combined_filename(station, original=True),
+                       get_raw_filename(station, 'isd'),
+                       get_raw_filename(station, 'isd', original=True),
+                       get_processed_filename(station, 'isd'),
+                       get_processed_filename(station, 'isd', original=True)]
+
+    stations = [(x.station_id, x.network, x.station_name, x.latitude,
+                 x.longitude, x.start_date_to_use, x.end_date_to_use)
+                for x in updated_coops + updated_isds]
+
+    return {'inputs': inputs,
+            'outputs': [get_d4em_filename(common.CURRENT_END_YEAR)],
+            'params': {'stations': stations}}
+
+
+def list_stale(network, to_update):
+    """
+    Returns (station_id, stage, reason) for each stage the update would
+    run for to_update, a list of (station, matching_station)
+    The stages after one that runs are listed too, since they run again
+    if its output changes
+    """
+    update_journal = journal.get_journal()
+
+    stale = []
+    for station, matching_station in to_update:
+        if is_unchanged(station, matching_station):
+            stages = ('combine',)
+        else:
+            stages = journal.STAGES[:journal.STAGES.index('combine') + 1]
+
+        earlier = None
+        for stage in stages:
+            reason = update_journal.stale_reason(
+                network, station.station_id, stage,
+                **get_dependencies(network, stage, station, matching_station))
+            if reason is None and earlier:
+                reason = f'after {earlier}'
+            if reason is not None:
+                stale.append((station.station_id, stage, reason))
+                earlier = earlier or stage
+
+            # ISD stations with too much missing data stop after process
+            if (network == 'isd' and stage == 'process' and not earlier and
+                    not is_usable(update_journal.get(
+                        network, station.station_id, stage)[1])):
+                break
+
+    return stale
+
+
+def print_stale(updated_coops):
+    """
+    Prints the stages the update would run and why, without running them
+    """
+    initial_coops = common.get_stations('coop_stations_to_use.csv')
+    first_pass_isds = get_some_isds()
+
+    stale = [('coop',) + x for x in list_stale(
+        'coop', get_coops_to_update(initial_coops, updated_coops))]
+    stale += [('isd',) + x for x in list_stale('isd', get_isds_to_update())]
+
+    reason = journal.get_journal().stale_reason(
+        'all', 'D4EM', 'd4em',
+        **get_d4em_dependencies(updated_coops, first_pass_isds))
+    if reason is None and stale:
+        reason = 'after the stations'
+    if reason is not None:
+        stale.append(('all', 'D4EM', 'd4em', reason))
+
+    for network, station_id, stage, reason in stale:
+        print(f'{network:<6}{station_id:<14}{stage:<10}{reason}')
+    print(f'{len(stale)} stages to run')
+
+
 def process(updated_coops, updated_isds):
     new_d4em_processed_data = []
-    with open(str(common.CURRENT_END_YEAR - 1) + '_D4EM_PREC_updated.txt', 'r') as file:
+    with open(get_d4em_filename(common.CURRENT_END_YEAR - 1), 'r') as file:
         d4em_data = file.readlines()
 
     split_data = [x.split('\t') for x in d4em_data[1:]]
+    d4em_registry = station_registry.StationRegistry(d4em_rows=split_data)
     new_d4em_processed_data.append(d4em_data[0])
 
     updated_stations = updated_coops + updated_isds
@@ -442,7 +926,7 @@ def process(updated_coops, updated_isds):
     for updated_station in updated_stations:
         print(updated_station.station_id)
         try:
-            match = [x for x in split_data if x[0] == updated_station.station_id][0]
+            match = d4em_registry.get_d4em_rows(updated_station.station_id)[0]
             match_start = match[8].strip("'").split('/')
             match_start_date = datetime.datetime(int(match_start[0]),
                                 int(match_start[1]),
@@ -458,11 +942,11 @@ def process(updated_coops, updated_isds):
                      updated_station.station_name + '\n']
 
         if updated_station.network == 'isd':
-            if not os.path.exists(
+            if not storage.exists(
                     os.path.join(common.DATA_BASE_DIR,
                                  str(common.CURRENT_END_YEAR) + '_combined_data',
                                  updated_station.station_id + '.dat')):
-                if not os.path.exists(
+                if not storage.exists(
                         os.path.join(common.DATA_BASE_DIR,
                                  'combined_data', updated_station.station_id + '.dat')):
                     continue
@@ -486,7 +970,7 @@ def process(updated_coops, updated_isds):
                         common.DATA_BASE_DIR,
                         str(common.CURRENT_END_YEAR) + '_processed_isd_data',
                         updated_station.station_id + '.dat')
-                if os.path.exists(new_filename):
+                if storage.exists(new_filename):
                     split_isd_data, isd_years = common.read_precip(
                         real_start_date,
                         real_end_date, new_filename
@@ -572,33 +1056,55 @@ def process(updated_coops, updated_isds):
             new_d4em_processed_data.append('\t'.join(match))
 
 
-    with open(str(common.CURRENT_END_YEAR) + '_D4EM_PREC_updated.txt', 'w') as file:
+    with open(get_d4em_filename(common.CURRENT_END_YEAR), 'w') as file:
         file.writelines(new_d4em_processed_data)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=common_fill.FILL_JOBS,
+                        help='number of processes filling stations')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='list the stages that would run and why, '
+                             'without running them')
+    parser.add_argument('--copy-files', action='store_true',
+                        help='copy the files carried forward from last '
+                             'year instead of linking them')
+    parser.add_argument('--compress', choices=list(storage.SUFFIXES),
+                        help='write the data files compressed; files '
+                             'already there are read either way')
+    parser.add_argument('--append-downloads', action='store_true',
+                        help='download only the data added to each C-HPD '
+                             'file since the original raw data')
+    args = parser.parse_args()
+
+    if args.copy_files:
+        dat_file.CARRY_FORWARD_METHODS = ('copy',)
+    storage.COMPRESSION = args.compress
+
     make_directories(common.CURRENT_END_YEAR)
 
     updated_coop_stations = make_updated_coops()
 
-    # we are at the mercy of their server
-    # you may need to call this function multiple times but you don't
-    # need to start from the beginning. You can start at, for example,
-    # the COOP in index position 712 by calling the function
-    # with update_coop_data(updated_coop_stations[712:])
+    if args.dry_run:
+        print_stale(updated_coop_stations)
+        raise SystemExit
 
-    # to get the position of the most recent coop,
-    # use:
-    # for idx, x in enumerate(updated_coop_stations):
-    #     if x.station_id == 'USC00218280':
-    #         print(idx)
+    # we are at the mercy of their server
+    # each station's progress is recorded in the journal in
+    # DATA_BASE_DIR (see journal.py), so if this stops part way just
+    # run it again: every station picks up from the last stage it
+    # finished. Stages only run again once the files they read or the
+    # settings they use change; use --dry-run to see which will.
+    # Run journal.py to see which stations failed and why.
 
-    update_coop_data(updated_coop_stations)
+    update_coop_data(updated_coop_stations, jobs=args.jobs,
+                     append_downloads=args.append_downloads)
 
-    updated_isds = update_isd_data()
+    updated_isds = update_isd_data(jobs=args.jobs)
     first_pass_isds = get_some_isds()
 
-    process(updated_coop_stations, first_pass_isds)
-
-
-
+    journal.get_journal().run(
+        'all', 'D4EM', 'd4em', process, updated_coop_stations,
+        first_pass_isds,
+        **get_d4em_dependencies(updated_coop_stations, first_pass_isds))